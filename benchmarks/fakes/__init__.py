@@ -0,0 +1,98 @@
+"""
+In-process stand-ins for the services the bot talks to, with configurable latency and fault injection
+"""
+
+import asyncio
+import random
+import socket
+import threading
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+
+import uvicorn
+from fastapi.responses import HTMLResponse, JSONResponse
+
+
+class Faults:
+    """
+    The faults a fake injects into every request: a fixed latency, and a chance to answer with an error, to answer
+    with something that is not json or to not answer within `hang` seconds
+    """
+
+    def __init__(self, latency: float = 0, error_rate: float = 0, garbage_rate: float = 0, hang_rate: float = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.garbage_rate = garbage_rate
+        self.hang_rate = hang_rate
+        self.hang = 60
+
+    async def inject(self):
+        """
+        Returns the response of an injected fault, or None when the request should be handled
+        """
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        draw = random.random()
+        if draw < self.hang_rate:
+            await asyncio.sleep(self.hang)
+        draw -= self.hang_rate
+        if draw < self.error_rate:
+            return JSONResponse({"detail": "Service unavailable"}, status_code=503)
+        draw -= self.error_rate
+        if draw < self.garbage_rate:
+            return HTMLResponse("<html><body>Bad gateway</body></html>")
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def serve(app, port: int = None, lifespan: str = "off"):
+    """
+    Run an ASGI app on a local port for the duration of the context, yields the host and port
+    """
+    port = port or free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan=lifespan))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    try:
+        yield f"127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        await task
+
+
+@contextmanager
+def serve_in_thread(*apps):
+    """
+    Run ASGI apps on local ports in a thread with its own event loop, yields their hosts and ports. Needed for
+    services that are called with blocking clients, such as spotipy, from the event loop of the bot
+    """
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    hosts = []
+
+    async def run(stopped: asyncio.Event) -> None:
+        try:
+            async with AsyncExitStack() as stack:
+                for app in apps:
+                    hosts.append(await stack.enter_async_context(serve(app)))
+                ready.set()
+                await stopped.wait()
+        finally:
+            ready.set()
+
+    stopped = asyncio.Event()
+    thread = threading.Thread(target=loop.run_until_complete, args=(run(stopped),), daemon=True)
+    thread.start()
+    ready.wait()
+    try:
+        yield hosts
+    finally:
+        loop.call_soon_threadsafe(stopped.set)
+        thread.join()
+        loop.close()
@@ -0,0 +1,217 @@
+"""
+A stand-in for the parts of LNbits the bot uses: wallets, invoices and payments, the usermanager and the lnurlp
+extension. Payments between wallets of the fake settle immediately and call the webhook of the invoice.
+"""
+
+import asyncio
+import hashlib
+import secrets
+from collections import Counter
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from . import Faults
+
+
+class FakeLNbits:
+    # the bot registers webhooks on its default address
+    BOT_ADDRESS = "http://127.0.0.1:7000"
+
+    def __init__(self, faults: Faults = None, webhook_host: str = None):
+        self.faults = faults or Faults()
+        self.calls = Counter()
+        self.users = {}
+        self.wallets = {}
+        self.invoices = {}
+        self.bolt11 = {}
+        self.links = {}
+        self.webhooks = []
+        self.webhook_host = webhook_host
+        self._webhook_client = None
+        self.app = self._create_app()
+
+    def create_wallet(self, userid: str, name: str, balance: int = 0) -> dict:
+        wallet = {
+            "id": secrets.token_hex(16),
+            "user": userid,
+            "name": name,
+            "inkey": secrets.token_hex(16),
+            "adminkey": secrets.token_hex(16),
+            "balance": balance * 1000,
+        }
+        self.wallets[wallet["id"]] = wallet
+        return wallet
+
+    def wallet_by_key(self, key: str, admin: bool = False) -> dict:
+        for wallet in self.wallets.values():
+            if wallet["adminkey"] == key or (not admin and wallet["inkey"] == key):
+                return wallet
+        return None
+
+    def fund(self, key: str, sats: int) -> None:
+        self.wallet_by_key(key)["balance"] += sats * 1000
+
+    async def _webhook(self, url: str, payload: dict) -> None:
+        if self.webhook_host is not None and url.startswith(self.BOT_ADDRESS):
+            url = f"http://{self.webhook_host}{url[len(self.BOT_ADDRESS):]}"
+        if self._webhook_client is None:
+            self._webhook_client = httpx.AsyncClient(timeout=30)
+        try:
+            await self._webhook_client.post(url, json=payload)
+            self.webhooks.append(url)
+        except httpx.HTTPError:
+            pass
+
+    def _create_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.middleware("http")
+        async def inject_faults(request: Request, call_next):
+            response = await self.faults.inject()
+            if response is not None:
+                self.calls["injected faults"] += 1
+                return response
+            response = await call_next(request)
+            route = request.scope.get("route")
+            self.calls[f"{request.method} {route.path if route is not None else request.url.path}"] += 1
+            return response
+
+        def unauthorized():
+            return JSONResponse({"detail": "Invalid key"}, status_code=401)
+
+        @app.get("/api/v1/wallet")
+        async def get_wallet(request: Request):
+            wallet = self.wallet_by_key(request.headers.get("X-Api-Key"))
+            if wallet is None:
+                return unauthorized()
+            return {"id": wallet["id"], "name": wallet["name"], "balance": wallet["balance"]}
+
+        @app.post("/api/v1/payments")
+        async def payments(request: Request):
+            data = await request.json()
+            if not data["out"]:
+                wallet = self.wallet_by_key(request.headers.get("X-Api-Key"))
+                if wallet is None:
+                    return unauthorized()
+                payment_hash = hashlib.sha256(secrets.token_bytes(32)).hexdigest()
+                self.invoices[payment_hash] = {
+                    "wallet": wallet["id"],
+                    "amount": data["amount"],
+                    "bolt11": f"lnbcrt{data['amount']}n1{payment_hash}",
+                    "webhook": data.get("webhook"),
+                    "extra": data.get("extra", {}),
+                    "paid": False,
+                }
+                self.bolt11[self.invoices[payment_hash]["bolt11"]] = payment_hash
+                return {"payment_hash": payment_hash, "payment_request": self.invoices[payment_hash]["bolt11"]}
+
+            wallet = self.wallet_by_key(request.headers.get("X-Api-Key"), admin=True)
+            if wallet is None:
+                return unauthorized()
+            payment_hash = self.bolt11.get(data["bolt11"])
+            if payment_hash is None:
+                return JSONResponse({"detail": "Invoice not found."}, status_code=520)
+            invoice = self.invoices[payment_hash]
+            if invoice["paid"]:
+                return JSONResponse(
+                    {"detail": "(sqlite3.IntegrityError) UNIQUE constraint failed: apipayments.checking_id"},
+                    status_code=520,
+                )
+            if wallet["balance"] < invoice["amount"] * 1000:
+                return JSONResponse({"detail": "Insufficient balance."}, status_code=520)
+
+            wallet["balance"] -= invoice["amount"] * 1000
+            self.wallets[invoice["wallet"]]["balance"] += invoice["amount"] * 1000
+            invoice["paid"] = True
+            if invoice["webhook"] is not None:
+                payload = {"payment_hash": payment_hash, "amount": invoice["amount"] * 1000, "extra": invoice["extra"]}
+                asyncio.create_task(self._webhook(invoice["webhook"], payload))
+            return {"payment_hash": payment_hash, "checking_id": payment_hash}
+
+        @app.get("/api/v1/payments/{payment_hash}")
+        async def check_payment(payment_hash: str):
+            invoice = self.invoices.get(payment_hash)
+            if invoice is None:
+                return JSONResponse({"detail": "Payment does not exist."}, status_code=404)
+            return {"paid": invoice["paid"]}
+
+        @app.get("/usermanager/api/v1/users")
+        async def get_users():
+            return list(self.users.values())
+
+        @app.post("/usermanager/api/v1/users")
+        async def create_user(request: Request):
+            data = await request.json()
+            user = {"id": secrets.token_hex(16), "name": data["user_name"], "admin": data["admin_id"]}
+            self.users[user["id"]] = user
+            self.create_wallet(user["id"], data["wallet_name"])
+            return user
+
+        @app.put("/usermanager/api/v1/users/{userid}")
+        async def update_user(userid: str, request: Request):
+            data = await request.json()
+            if userid not in self.users:
+                return JSONResponse({"detail": "User does not exist."}, status_code=404)
+            self.users[userid]["name"] = data["user_name"]
+            for wallet in self.wallets.values():
+                if wallet["user"] == userid:
+                    wallet["name"] = data["wallet_name"]
+            return self.users[userid]
+
+        @app.delete("/usermanager/api/v1/users/{userid}")
+        async def delete_user(userid: str):
+            self.users.pop(userid, None)
+            return {}
+
+        @app.get("/usermanager/api/v1/wallets")
+        async def get_wallets():
+            return list(self.wallets.values())
+
+        @app.get("/usermanager/api/v1/wallets/{userid}")
+        async def get_user_wallets(userid: str):
+            return [wallet for wallet in self.wallets.values() if wallet["user"] == userid]
+
+        @app.post("/usermanager/api/v1/extensions")
+        async def enable_extension(extension: str, userid: str, active: bool):
+            return {"extension": "updated"}
+
+        @app.get("/lnurlp/api/v1/links")
+        async def get_links(request: Request):
+            wallet = self.wallet_by_key(request.headers.get("X-Api-Key"))
+            if wallet is None:
+                return unauthorized()
+            return [link for link in self.links.values() if link["wallet"] == wallet["id"]]
+
+        @app.post("/lnurlp/api/v1/links")
+        async def create_link(request: Request):
+            wallet = self.wallet_by_key(request.headers.get("X-Api-Key"), admin=True)
+            if wallet is None:
+                return unauthorized()
+            data = await request.json()
+            username = data.get("username")
+            if username is not None and any(link["username"] == username for link in self.links.values()):
+                return JSONResponse({"detail": "Username already exists. Try a different one."}, status_code=400)
+            link = {
+                "id": secrets.token_urlsafe(4),
+                "wallet": wallet["id"],
+                "username": username,
+                "lnurl": "LNURL1" + secrets.token_hex(20).upper(),
+                **data,
+            }
+            self.links[link["id"]] = link
+            return link
+
+        @app.get("/lnurlp/api/v1/links/{linkid}")
+        async def get_link(linkid: str):
+            if linkid not in self.links:
+                return JSONResponse({"detail": "Pay link does not exist."}, status_code=404)
+            return self.links[linkid]
+
+        @app.delete("/lnurlp/api/v1/links/{linkid}")
+        async def delete_link(linkid: str):
+            self.links.pop(linkid, None)
+            return {}
+
+        return app
@@ -0,0 +1,93 @@
+"""
+A stand-in for the parts of the Spotify Web API spotipy calls for the bot: search, tracks, playlists, the queue and
+the currently playing track.
+"""
+
+from collections import Counter
+
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+from . import Faults
+
+
+def make_track(number: int) -> dict:
+    track_id = f"BenchTrack{number:012d}"
+    return {
+        "id": track_id,
+        "uri": f"spotify:track:{track_id}",
+        "name": f"Track {number}",
+        "duration_ms": 180000 + number % 60 * 1000,
+        "artists": [{"name": f"Artist {number % 97}"}],
+        "album": {"name": f"Album {number % 31}", "images": []},
+    }
+
+
+class FakeSpotify:
+    def __init__(self, faults: Faults = None, catalog_size: int = 1000):
+        self.faults = faults or Faults()
+        self.calls = Counter()
+        self.catalog = [make_track(number) for number in range(catalog_size)]
+        self.tracks = {track["id"]: track for track in self.catalog}
+        self.queue = []
+        self.app = self._create_app()
+
+    def _create_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.middleware("http")
+        async def inject_faults(request: Request, call_next):
+            response = await self.faults.inject()
+            if response is not None:
+                self.calls["injected faults"] += 1
+                return response
+            response = await call_next(request)
+            route = request.scope.get("route")
+            self.calls[f"{request.method} {route.path if route is not None else request.url.path}"] += 1
+            return response
+
+        @app.get("/v1/search")
+        async def search(q: str, limit: int = 10, offset: int = 0):
+            words = q.lower().split()
+            items = [
+                track
+                for track in self.catalog
+                if all(word in f"{track['artists'][0]['name']} {track['name']}".lower() for word in words)
+            ]
+            return {"tracks": {"items": items[offset : offset + limit], "total": len(items)}}
+
+        # spotipy asks for the batch with a trailing slash
+        @app.get("/v1/tracks/")
+        async def tracks(ids: str):
+            return {"tracks": [self.tracks.get(track_id) for track_id in ids.split(",")]}
+
+        @app.get("/v1/tracks/{track_id}")
+        async def track(track_id: str):
+            return self.tracks[track_id]
+
+        @app.get("/v1/me/player/currently-playing")
+        async def currently_playing():
+            return {"is_playing": True, "progress_ms": 60000, "item": self.catalog[0]}
+
+        @app.get("/v1/me/player/queue")
+        async def get_queue():
+            return {
+                "currently_playing": self.catalog[0],
+                "queue": [self.tracks[uri.split(":")[2]] for uri in self.queue],
+            }
+
+        @app.post("/v1/me/player/queue")
+        async def add_to_queue(uri: str):
+            self.queue = (self.queue + [uri])[-20:]
+            return Response(status_code=204)
+
+        @app.get("/v1/playlists/{playlist_id}")
+        async def playlist(playlist_id: str):
+            return {"id": playlist_id, "name": f"Playlist {playlist_id}"}
+
+        @app.get("/v1/playlists/{playlist_id}/tracks")
+        async def playlist_items(playlist_id: str, limit: int = 100, offset: int = 0):
+            items = [{"track": track} for track in self.catalog[offset : offset + limit]]
+            return {"items": items, "total": len(self.catalog), "offset": offset, "limit": limit}
+
+        return app
@@ -0,0 +1,115 @@
+"""
+A stand-in for the Telegram Bot API. Every method of the bot succeeds, sent messages are kept per chat so that a load
+driver can find the buttons it should click.
+"""
+
+import itertools
+import json
+from collections import Counter, defaultdict
+from email.parser import BytesParser
+from email.policy import default
+from time import time
+from urllib.parse import parse_qsl
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from . import Faults
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Jukebox", "username": "Jukebox_Bench_bot"}
+
+
+def parse_params(headers, body: bytes) -> dict:
+    """
+    Parse the parameters of a Bot API call, sent as json, as a form or as multipart when files are uploaded
+    """
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=default).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        return {
+            part.get_param("name", header="content-disposition"): part.get_content() for part in message.iter_parts()
+        }
+    return dict(parse_qsl(body.decode("utf-8")))
+
+
+class FakeTelegram:
+    def __init__(self, faults: Faults = None):
+        self.faults = faults or Faults()
+        self.calls = Counter()
+        self.messages = defaultdict(list)
+        self._message_ids = itertools.count(1)
+        self.app = self._create_app()
+
+    def chat(self, chat_id: int) -> dict:
+        return {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private", "title": "Bench"}
+
+    def find_message(self, chat_id: int, prefix: str, after: int = 0) -> dict:
+        """
+        Returns the first message in the chat with a text that starts with prefix and an id greater than after
+        """
+        for message in list(self.messages[chat_id]):
+            if message["message_id"] > after and message.get("text", "").startswith(prefix):
+                return message
+        return None
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time()),
+            "chat": self.chat(chat_id),
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "photo" in params:
+            message["photo"] = [
+                {"file_id": f"photo{message['message_id']}", "file_unique_id": "u", "width": 1, "height": 1}
+            ]
+        if "reply_markup" in params:
+            reply_markup = params["reply_markup"]
+            message["reply_markup"] = json.loads(reply_markup) if isinstance(reply_markup, str) else reply_markup
+        self.messages[chat_id].append(message)
+        return message
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "sendPhoto"):
+            return self._message(params)
+        if method == "editMessageText":
+            chat_id = int(params["chat_id"])
+            return {
+                "message_id": int(params["message_id"]),
+                "date": int(time()),
+                "chat": self.chat(chat_id),
+                "from": BOT_USER,
+                "text": params["text"],
+            }
+        if method == "getChatAdministrators":
+            return [{"status": "creator", "user": {"id": 1000, "is_bot": False, "first_name": "Owner"}}]
+        return True
+
+    def _create_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/bot{token}/{method}")
+        async def call(method: str, request: Request):
+            self.calls[method] += 1
+            response = await self.faults.inject()
+            if response is not None:
+                return JSONResponse(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests",
+                        "parameters": {"retry_after": 1},
+                    },
+                    status_code=429,
+                )
+
+            return {"ok": True, "result": self._result(method, parse_params(request.headers, await request.body()))}
+
+        return app
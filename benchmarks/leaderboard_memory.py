@@ -0,0 +1,58 @@
+"""
+Compare the memory that a group uses for the tracks it played: the legacy lastplayed hash, which kept every title that
+was ever played, and the leaderboards with the recently played tracks, which are trimmed. Every play is a track that
+did not play before, the worst case for both.
+
+The benchmark writes to the redis database of the bot and removes the keys it wrote afterwards, the global
+leaderboards included. Run it against a disposable redis server.
+
+Usage: python -m benchmarks.leaderboard_memory [--plays 20000] [--step 2000]
+"""
+
+import argparse
+from time import time
+
+from lightning_jukebox_bot.application import leaderboard, redis
+
+CHAT_ID = -1000000001
+
+
+def memory(pattern: str) -> tuple:
+    """
+    The entries and the bytes of the keys that match the pattern
+    """
+    entries = size = 0
+    for key in redis.cache.scan_iter(pattern):
+        kind = redis.cache.type(key)
+        entries += redis.cache.hlen(key) if kind == b"hash" else redis.cache.zcard(key)
+        size += redis.cache.memory_usage(key) or 0
+    return entries, size
+
+
+def cleanup() -> None:
+    for pattern in [f"lastplayed:{CHAT_ID}", f"top:{CHAT_ID}:*", f"played:{CHAT_ID}", "top:plays", "top:titles"]:
+        for key in redis.cache.scan_iter(pattern):
+            redis.cache.delete(key)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the memory of the played tracks of a group")
+    parser.add_argument("--plays", type=int, default=20000)
+    parser.add_argument("--step", type=int, default=2000)
+    args = parser.parse_args()
+
+    cleanup()
+    try:
+        print(f"{'plays':>8} {'lastplayed entries':>20} {'bytes':>10} {'leaderboards entries':>22} {'bytes':>10}")
+        for i in range(1, args.plays + 1):
+            uri = f"spotify:track:{i:022d}"
+            title = f"Artist {i} - Title of the track number {i}"
+            redis.cache.hset(f"lastplayed:{CHAT_ID}", title, int(time()))
+            leaderboard.helper.record_play(CHAT_ID, uri, title)
+            if i % args.step == 0:
+                [legacy_entries, legacy] = memory(f"lastplayed:{CHAT_ID}")
+                [entries, size] = memory(f"top:{CHAT_ID}:*")
+                [played_entries, played] = memory(f"played:{CHAT_ID}")
+                print(f"{i:>8} {legacy_entries:>20} {legacy:>10} {entries + played_entries:>22} {size + played:>10}")
+    finally:
+        cleanup()
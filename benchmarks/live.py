@@ -0,0 +1,119 @@
+"""
+Benchmark the live feed of the web jukebox: simulated listeners of the groups are subscribed to the hub of this
+process, messages are published to redis and the time until every listener of the group has written a message is
+measured. The listeners are WebSockets in memory that are served by the same code as the /live endpoint, so the
+benchmark measures the hub and the writers, not the network.
+
+The benchmark publishes to the redis database of the bot and removes the state keys it wrote afterwards. Run it
+against a disposable redis server.
+
+Usage: python -m benchmarks.live [--listeners 10000] [--groups 1] [--messages 200] [--rate 20]
+"""
+
+import argparse
+import asyncio
+import gc
+import tracemalloc
+from collections import Counter
+from time import perf_counter
+
+from lightning_jukebox_bot.application import live, redis
+
+CHAT_ID = -1000000001
+
+
+class Socket:
+    """
+    A WebSocket of a listener that stays connected until it is closed and records the messages it was sent
+    """
+
+    def __init__(self, delivered: Counter, done: dict, listeners: int):
+        self.delivered = delivered
+        self.done = done
+        self.listeners = listeners
+        self.disconnected = asyncio.Event()
+
+    async def receive(self) -> dict:
+        await self.disconnected.wait()
+        return {"type": "websocket.disconnect"}
+
+    async def send_text(self, text: str) -> None:
+        self.delivered[text] += 1
+        if self.delivered[text] == self.listeners:
+            self.done[text] = perf_counter()
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def cleanup(groups: int) -> None:
+    for group in range(groups):
+        for key in redis.cache.scan_iter(f"live:{CHAT_ID - group}:*"):
+            redis.cache.delete(key)
+
+
+async def main(args) -> None:
+    live.start()
+    delivered = Counter()
+    done = {}
+    per_group = args.listeners // args.groups
+    sockets = [Socket(delivered, done, per_group) for _ in range(per_group * args.groups)]
+
+    gc.collect()
+    tracemalloc.start()
+    start = perf_counter()
+    tasks = [asyncio.create_task(live.serve(socket, CHAT_ID - i % args.groups)) for i, socket in enumerate(sockets)]
+    # the subscriptions of the hub are confirmed by redis before the first message
+    channels = [f"live:{CHAT_ID - group}" for group in range(args.groups)]
+    while live.hub.listeners() < len(sockets) or any(count == 0 for [_, count] in redis.cache.pubsub_numsub(*channels)):
+        await asyncio.sleep(0.01)
+    elapsed = perf_counter() - start
+    [size, _] = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"subscribed       {len(sockets)} listeners to {args.groups} groups in {elapsed:.2f} s  "
+        f"{size / len(sockets):.0f} B per listener"
+    )
+
+    # published at a steady rate, the groups take turns
+    sent = {}
+    start = perf_counter()
+    for number in range(args.messages):
+        chat_id = CHAT_ID - number % args.groups
+        published = perf_counter()
+        sent[live.publish(chat_id, live.ADDED, user="bench", titles=[f"Track {number}"])] = published
+        await asyncio.sleep(max(0.0, start + (number + 1) / args.rate - perf_counter()))
+    deadline = perf_counter() + 10
+    while len(done) < len(sent) and perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = perf_counter() - start
+
+    latencies = [done[message] - sent[message] for message in sent if message in done]
+    deliveries = sum(delivered.values())
+    print(
+        f"fan-out          {len(latencies)}/{len(sent)} messages reached every listener  "
+        f"p50 {percentile(latencies, 0.5) * 1000:.1f} ms  p99 {percentile(latencies, 0.99) * 1000:.1f} ms  "
+        f"max {max(latencies) * 1000:.1f} ms"
+    )
+    print(f"deliveries       {deliveries} in {elapsed:.1f} s  {deliveries / elapsed:.0f}/s")
+
+    for socket in sockets:
+        socket.disconnected.set()
+    await asyncio.gather(*tasks)
+    await live.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the fan-out of the live feed to many listeners")
+    parser.add_argument("--listeners", type=int, default=10000)
+    parser.add_argument("--groups", type=int, default=1)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=20, help="messages published per second")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    finally:
+        cleanup(args.groups)
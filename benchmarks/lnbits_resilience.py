@@ -0,0 +1,89 @@
+"""
+Run the LNbits client against a local LNbits stand-in that injects faults, and report how the calls fare: how many
+succeed, their latency, the retries and the state of the circuit breaker.
+
+Usage: python -m benchmarks.lnbits_resilience [--calls 200] [--concurrency 20] [--timeout 2]
+"""
+
+import argparse
+import asyncio
+import statistics
+from time import monotonic
+
+from lightning_jukebox_bot.application import lnbits, metrics
+from lightning_jukebox_bot.application.lnbits import LNbits, LNbitsUnavailable
+
+from .fakes import Faults, serve
+from .fakes.lnbits import FakeLNbits
+
+SCENARIOS = {
+    "healthy": Faults(),
+    "slow": Faults(latency=0.2),
+    "flaky": Faults(error_rate=0.3),
+    "garbage": Faults(garbage_rate=0.2),
+    "hanging": Faults(hang_rate=0.1),
+    "down": Faults(error_rate=1),
+}
+
+
+def percentile(values: list, fraction: float) -> float:
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_scenario(name: str, faults: Faults, calls: int, concurrency: int) -> None:
+    fake = FakeLNbits()
+    # the counters of the registry are shared by the scenarios
+    before = metrics.get_dependency_stats("lnbits").get("getBalance", {})
+    wallet = fake.create_wallet("bench", "bench", balance=1000)
+
+    async with serve(fake.app) as host:
+        client = LNbits("http", host, "adminkey", "invoicekey", "usrkey")
+        fake.faults = faults
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = {"ok": [], "unavailable": []}
+
+        async def call() -> None:
+            async with semaphore:
+                start = monotonic()
+                try:
+                    await client.getBalance(wallet["inkey"])
+                    latencies["ok"].append(monotonic() - start)
+                except LNbitsUnavailable:
+                    latencies["unavailable"].append(monotonic() - start)
+
+        start = monotonic()
+        await asyncio.gather(*[call() for _ in range(calls)])
+        elapsed = monotonic() - start
+        await client.aclose()
+
+    stats = client.get_stats()
+    opstats = stats["operations"]["getBalance"]
+    retries = opstats["retries"] - before.get("retries", 0)
+    rejected = opstats["rejected"] - before.get("rejected", 0)
+    ok = latencies["ok"]
+    print(
+        f"{name:<8} {len(ok):>5} ok {len(latencies['unavailable']):>5} unavailable  "
+        f"{calls / elapsed:8.1f} calls/s  "
+        f"ok p50 {percentile(ok, 0.5) * 1000:7.1f} ms p99 {percentile(ok, 0.99) * 1000:7.1f} ms  "
+        f"failed p50 {statistics.median(latencies['unavailable'] or [0]) * 1000:7.1f} ms  "
+        f"retries {retries:>4} rejected {rejected:>4} requests {sum(fake.calls.values()):>5}  "
+        f"breaker {stats['state']}"
+    )
+
+
+async def main(args) -> None:
+    lnbits.DEFAULT_TIMEOUT = args.timeout
+    for name, faults in SCENARIOS.items():
+        faults.hang = args.timeout * 2
+        await run_scenario(name, faults, args.calls, args.concurrency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the LNbits client against injected faults")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=2, help="time budget of a call in seconds")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,284 @@
+"""
+End-to-end load benchmark of the bot. The real FastAPI app runs against local stand-ins for LNbits, Spotify and the
+Telegram Bot API, and a driver replays synthetic traffic:
+
+- telegram: a webhook update with /add, a click on the first search result and payment of the invoice
+- web: /search and /add of the web jukebox, and payment of the invoice
+
+A flow is done when the bot announces the paid track in the group. For every scenario the throughput, the p50 and
+p99 latency of a flow and the calls that reached the fake services are reported.
+
+With --player fake the groups play on the fake player of the bot instead of the fake Spotify, with the same latency.
+
+The app uses the redis database of the bot, run the benchmark against a disposable redis server.
+
+Usage: python -m benchmarks.load [--flows 50] [--concurrency 10] [--latency 0.02] [--error-rate 0] [--player spotify]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from collections import Counter
+from time import monotonic, time
+
+import httpx
+
+from .fakes import Faults, free_port, serve, serve_in_thread
+from .fakes.lnbits import FakeLNbits
+from .fakes.spotify import FakeSpotify
+from .fakes.telegram import FakeTelegram
+
+BOT_ID = 424242
+OWNER_ID = 1000
+CHAT_ID = -1000000000
+USER_ID = 2000000
+
+SCOPE = "user-read-currently-playing user-modify-playback-state user-read-playback-state"
+
+
+def write_settings(app_port: int, hosts: dict, player: str, latency: float) -> str:
+    settings = {
+        "port": app_port,
+        "domain": "jukebox.bench",
+        "bot_token": f"{BOT_ID}:bench",
+        "bot_id": BOT_ID,
+        "bot_ipaddr": "127.0.0.1",
+        "telegram_base_url": f"http://{hosts['telegram']}/bot",
+        "spotify_api_prefix": f"http://{hosts['spotify']}/v1/",
+        "lnbits_protocol": "http",
+        "lnbits_host": hosts["lnbits"],
+        "lnbits_adminkey": "bench",
+        "lnbits_hostkey": "bench",
+        "lnbits_userkey": "bench",
+        "superadmin": [OWNER_ID],
+        "player": player,
+        "fake_player_latency": latency,
+        # the flood limits of telegram would dominate the measurement
+        "telegram_global_rate": 100000,
+        "telegram_group_rate": 6000000,
+        "telegram_group_burst": 100000,
+        "telegram_private_rate": 100000,
+    }
+    file = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+    # json is valid yaml
+    json.dump(settings, file)
+    file.close()
+    return file.name
+
+
+def seed_groups(cache, chats: list) -> None:
+    """
+    Connect a fake spotify player to every group
+    """
+    token = {
+        "access_token": "bench",
+        "token_type": "Bearer",
+        "expires_in": 3600,
+        "refresh_token": "bench",
+        "scope": SCOPE,
+        "expires_at": int(time()) + 365 * 24 * 3600,
+    }
+    for index, chat_id in enumerate(chats):
+        owner = OWNER_ID + index
+        cache.hset(
+            f"group:{chat_id}",
+            mapping={
+                "owner": owner,
+                "authmanager": json.dumps({"chat_id": chat_id, "client_id": "bench", "client_secret": "bench"}),
+            },
+        )
+        cache.set(f"spotify_token:{chat_id}", json.dumps(token))
+
+
+def percentile(values: list, fraction: float) -> float:
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Driver:
+    def __init__(self, app_host: str, fakes: dict, secret: str, timeout: float):
+        self.client = httpx.AsyncClient(base_url=f"http://{app_host}", timeout=timeout)
+        self.fakes = fakes
+        self.secret = secret
+        self.timeout = timeout
+        self.payer = fakes["lnbits"].create_wallet("payer", "payer", balance=10**9)
+        self.update_id = 0
+        self.message_id = 0
+
+    async def wait_for(self, chat_id: int, predicate, after: int = 0) -> dict:
+        """
+        Poll the fake telegram until the bot sent a matching message to the chat
+        """
+        deadline = monotonic() + self.timeout
+        while monotonic() < deadline:
+            for message in list(self.fakes["telegram"].messages[chat_id]):
+                if message["message_id"] > after and predicate(message.get("text", "")):
+                    return message
+            await asyncio.sleep(0.005)
+        raise TimeoutError(f"No message in chat {chat_id} after {self.timeout}s")
+
+    async def post_update(self, update: dict) -> None:
+        self.update_id += 1
+        update["update_id"] = self.update_id
+        response = await self.client.post(
+            "/jukebox/telegram", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": self.secret}
+        )
+        response.raise_for_status()
+
+    def user(self, userid: int) -> dict:
+        return {"id": userid, "is_bot": False, "first_name": "Bench", "username": f"bench{userid}"}
+
+    def last_message_id(self, chat_id: int) -> int:
+        messages = self.fakes["telegram"].messages[chat_id]
+        return messages[-1]["message_id"] if len(messages) > 0 else 0
+
+    async def pay(self, payment_hash: str) -> None:
+        bolt11 = self.fakes["lnbits"].invoices[payment_hash]["bolt11"]
+        response = await self.client.post(
+            f"http://{self.fakes['lnbits_host']}/api/v1/payments",
+            json={"out": True, "bolt11": bolt11},
+            headers={"X-Api-Key": self.payer["adminkey"]},
+        )
+        response.raise_for_status()
+
+    async def telegram_flow(self, chat_id: int, userid: int, number: int) -> None:
+        user = self.user(userid)
+        chat = self.fakes["telegram"].chat(chat_id)
+        after = self.last_message_id(chat_id)
+
+        # /add in the group
+        self.message_id += 1
+        query = f"Track {number}"
+        await self.post_update(
+            {
+                "message": {
+                    "message_id": self.message_id,
+                    "date": int(time()),
+                    "chat": chat,
+                    "from": user,
+                    "text": f"/add {query}",
+                    "entities": [{"type": "bot_command", "offset": 0, "length": 4}],
+                }
+            }
+        )
+        results = await self.wait_for(chat_id, lambda text: text == f"Results for '{query}'", after)
+
+        # click the first result
+        button = results["reply_markup"]["inline_keyboard"][0][0]
+        await self.post_update(
+            {
+                "callback_query": {
+                    "id": str(self.update_id),
+                    "from": user,
+                    "chat_instance": str(chat_id),
+                    "data": button["callback_data"],
+                    "message": results,
+                }
+            }
+        )
+        invoice = await self.wait_for(chat_id, lambda text: text.startswith(f"@{user['username']} add '"), after)
+
+        # pay the invoice from another wallet
+        url = invoice["reply_markup"]["inline_keyboard"][0][0]["url"]
+        await self.pay(url.split("payment_hash=")[1])
+        await self.wait_for(chat_id, lambda text: text.endswith("was added to the queue."), invoice["message_id"])
+
+    async def web_flow(self, chat_id: int, userid: int, number: int) -> None:
+        after = self.last_message_id(chat_id)
+
+        response = await self.client.post(f"/jukebox/web/{chat_id}/search", json={"query": f"Track {number}"})
+        results = response.json()["results"]
+
+        response = await self.client.get(f"/jukebox/web/{chat_id}/add", params={"track_id": results[0]["track_id"]})
+        payment_hash = response.json()["payment_url"].split("payment_hash=")[1]
+
+        await self.pay(payment_hash)
+        await self.wait_for(chat_id, lambda text: text.endswith("was added to the queue."), after)
+
+    async def run(self, name: str, flow, chats: list, flows: int) -> None:
+        calls = {service: Counter(self.fakes[service].calls) for service in ("lnbits", "spotify", "telegram")}
+        latencies = []
+        failures = Counter()
+        numbers = iter(range(flows))
+
+        # every chat runs its flows one after the other, the chats run in parallel
+        async def worker(chat_id: int) -> None:
+            for number in numbers:
+                start = monotonic()
+                try:
+                    await flow(chat_id, USER_ID + number, number)
+                    latencies.append(monotonic() - start)
+                except Exception as e:
+                    failures[type(e).__name__] += 1
+
+        start = monotonic()
+        await asyncio.gather(*[worker(chat_id) for chat_id in chats])
+        elapsed = monotonic() - start
+
+        print(
+            f"{name:<9} {len(latencies):>5} flows {sum(failures.values()):>4} failed  "
+            f"{len(latencies) / elapsed:7.1f} flows/s  "
+            f"p50 {percentile(latencies, 0.5) * 1000:7.1f} ms  p99 {percentile(latencies, 0.99) * 1000:7.1f} ms"
+        )
+        if len(failures) > 0:
+            print(f"          failures: {dict(failures)}")
+        for service, before in calls.items():
+            counts = Counter(self.fakes[service].calls)
+            counts.subtract(before)
+            counts = {call: count for call, count in sorted(counts.items()) if count > 0}
+            print(f"          {service}: {sum(counts.values())} calls {counts}")
+
+
+async def main(args) -> None:
+    faults = Faults(latency=args.latency, error_rate=args.error_rate)
+    fakes = {
+        "lnbits": FakeLNbits(faults),
+        "spotify": FakeSpotify(faults),
+        "telegram": FakeTelegram(faults),
+    }
+    app_port = free_port()
+    fakes["lnbits"].webhook_host = f"127.0.0.1:{app_port}"
+
+    with serve_in_thread(fakes["lnbits"].app, fakes["spotify"].app, fakes["telegram"].app) as hosts:
+        hosts = dict(zip(("lnbits", "spotify", "telegram"), hosts))
+        fakes["lnbits_host"] = hosts["lnbits"]
+
+        # the settings are read when the app is imported
+        os.environ["JUKEBOX_SETTINGS_FILE"] = write_settings(app_port, hosts, args.player, args.latency)
+        from lightning_jukebox_bot.app import app
+        from lightning_jukebox_bot.application import redis
+        from lightning_jukebox_bot.settings import const
+
+        chats = [CHAT_ID - index for index in range(args.concurrency)]
+        seed_groups(redis.cache, chats)
+
+        async with serve(app, app_port, lifespan="on") as app_host:
+            driver = Driver(app_host, fakes, const.TG_SECRET, args.timeout)
+            print(
+                f"{args.flows} flows per scenario in {args.concurrency} groups, "
+                f"fake latency {args.latency * 1000:.0f} ms, error rate {args.error_rate:.0%}, {args.player} player"
+            )
+            if args.scenario in ("telegram", "all"):
+                await driver.run("telegram", driver.telegram_flow, chats, args.flows)
+            if args.scenario in ("web", "all"):
+                await driver.run("web", driver.web_flow, chats, args.flows)
+            await driver.client.aclose()
+
+        os.unlink(os.environ["JUKEBOX_SETTINGS_FILE"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark against fake LNbits, Spotify and Telegram")
+    parser.add_argument("--scenario", choices=["telegram", "web", "all"], default="all")
+    parser.add_argument("--flows", type=int, default=50, help="flows per scenario")
+    parser.add_argument("--concurrency", type=int, default=10, help="groups that run flows in parallel")
+    parser.add_argument("--latency", type=float, default=0.02, help="latency of the fake services in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of calls the fakes fail")
+    parser.add_argument("--player", choices=["spotify", "fake"], default="spotify", help="the player of the groups")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds a step of a flow may take")
+    sys.exit(asyncio.run(main(parser.parse_args())))
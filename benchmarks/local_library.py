@@ -0,0 +1,97 @@
+"""
+Benchmark the index of the local player: a full scan of a generated library, a rescan without changes, a rescan after
+a share of the files changed or was removed, and the latency of searches like the ones of /add.
+
+The files are empty and named "Artist - Title.mp3" in a directory per artist and album, so the tags come from the
+file names. The library and the index are written to a temporary directory that is removed afterwards.
+
+Usage: python -m benchmarks.local_library [--files 100000] [--searches 2000] [--changed 0.01]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+from time import perf_counter, time
+
+from lightning_jukebox_bot.application.players import local
+
+ARTISTS = 5000
+ALBUMS_PER_ARTIST = 4
+WORDS = ["love", "night", "fire", "dream", "rain", "heart", "city", "light", "river", "gold", "blue", "wild"]
+
+
+def title(number: int) -> str:
+    rng = random.Random(number)
+    return " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, 3))) + f" {number}"
+
+
+def create_library(root: str, files: int) -> list:
+    paths = []
+    for number in range(files):
+        artist = f"Artist {number % ARTISTS}"
+        album = os.path.join(root, artist, f"Album {number // ARTISTS % ALBUMS_PER_ARTIST}")
+        os.makedirs(album, exist_ok=True)
+        path = os.path.join(album, f"{artist} - {title(number)}.mp3")
+        open(path, "w").close()
+        paths.append(path)
+    return paths
+
+
+def timed(func) -> tuple:
+    start = perf_counter()
+    result = func()
+    return perf_counter() - start, result
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark indexing and searching a local music library")
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--searches", type=int, default=2000)
+    parser.add_argument("--changed", type=float, default=0.01, help="share of the files changed before the rescan")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        root = os.path.join(directory, "music")
+        [elapsed, paths] = timed(lambda: create_library(root, args.files))
+        print(f"created {len(paths)} files in {elapsed:.1f} s")
+
+        library = local.Library(root, os.path.join(directory, "library.sqlite"))
+        [elapsed, counts] = timed(library.scan)
+        print(f"full scan        {elapsed:7.2f} s  {args.files / elapsed:9.0f} files/s  {counts}")
+
+        [elapsed, counts] = timed(library.scan)
+        print(f"unchanged rescan {elapsed:7.2f} s  {args.files / elapsed:9.0f} files/s  {counts}")
+
+        # touch a share of the files and remove as many
+        rng = random.Random(42)
+        changed = rng.sample(paths, int(len(paths) * args.changed))
+        later = time() + 60
+        for path in changed[: len(changed) // 2]:
+            os.utime(path, (later, later))
+        for path in changed[len(changed) // 2 :]:
+            os.remove(path)
+        [elapsed, counts] = timed(library.scan)
+        print(f"changed rescan   {elapsed:7.2f} s  {args.files / elapsed:9.0f} files/s  {counts}")
+
+        queries = []
+        for _ in range(args.searches):
+            number = rng.randrange(args.files)
+            queries.append(rng.choice([f"artist {number % ARTISTS}", title(number), rng.choice(WORDS)[:3]]))
+        latencies = []
+        results = 0
+        for query in queries:
+            [elapsed, rows] = timed(lambda: library.search(query, 10))
+            latencies.append(elapsed)
+            results += len(rows)
+        print(
+            f"search           {len(queries)} queries  p50 {percentile(latencies, 0.5) * 1000:.2f} ms  "
+            f"p99 {percentile(latencies, 0.99) * 1000:.2f} ms  max {max(latencies) * 1000:.2f} ms  "
+            f"{results / len(queries):.1f} results per query"
+        )
+        print(f"index size       {os.path.getsize(os.path.join(directory, 'library.sqlite')) / 2**20:.1f} MiB")
@@ -0,0 +1,60 @@
+import hmac
+
+from fastapi import APIRouter
+from fastapi.requests import Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from lightning_jukebox_bot.application import analytics, profiler, tracing
+from lightning_jukebox_bot.settings import config
+
+router = APIRouter(prefix="/admin")
+
+
+def authorized(request: Request) -> bool:
+    """
+    The admin endpoints require the admin token as bearer token, they are off when no token is configured
+    """
+    if config.admin_token is None:
+        return False
+    return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {config.admin_token}")
+
+
+@router.get("/profile")
+async def profile(request: Request, seconds: int = 10, stacks: bool = False):
+    """
+    Profile the bot on live traffic and return the summary, or the collapsed stacks for a flamegraph
+    """
+    if not authorized(request):
+        return JSONResponse({"success": False}, status_code=403)
+
+    session = profiler.start(seconds)
+    if session is None:
+        return JSONResponse({"success": False, "detail": "A profile is running already"}, status_code=409)
+
+    result = await session
+    return PlainTextResponse(result.collapsed() if stacks else result.summary())
+
+
+@router.get("/traces")
+async def traces(request: Request):
+    """
+    The traces that were slower than trace_slow_threshold, the latest last
+    """
+    if not authorized(request):
+        return JSONResponse({"success": False}, status_code=403)
+
+    return {"success": True, "traces": tracing.get_slow_traces()}
+
+
+@router.get("/analytics/{chat_id}")
+async def group_analytics(request: Request, chat_id: int, period: str = "week"):
+    """
+    The tracks, sats and unique requesters of a group per hour of the last day, or per day of the last week or month
+    """
+    if not authorized(request):
+        return JSONResponse({"success": False}, status_code=403)
+
+    if period not in analytics.helper.PERIODS:
+        return JSONResponse({"success": False, "detail": "Unknown period"}, status_code=400)
+
+    return {"success": True, **analytics.helper.get_report(chat_id, period)}
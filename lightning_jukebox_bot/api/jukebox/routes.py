@@ -1,11 +1,15 @@
+import hmac
+import json
+import logging
 import re
 
-import spotipy
 from fastapi import APIRouter
 from fastapi.requests import Request
+from fastapi.responses import JSONResponse
 from telegram import Update
 
-from lightning_jukebox_bot.application import invoicing, spotify, telegram, users
+from lightning_jukebox_bot.application import invoicing, players, telegram, users
+from lightning_jukebox_bot.settings import const
 from lightning_jukebox_bot.ui.templates import templates
 
 from . import web
@@ -13,11 +17,27 @@ from . import web
 router = APIRouter(prefix="/jukebox")
 router.include_router(web.router)
 
+logger = logging.getLogger(__name__)
+
 
 @router.post("/telegram")
 async def telegram_callback(request: Request):
-    """Handle incoming Telegram updates by putting them into the `update_queue`"""
-    await telegram.app.update_queue.put(Update.de_json(data=await request.json(), bot=telegram.app.bot))
+    """
+    Handle incoming Telegram updates by handing them to the ingestion stage. When it is full, the update is refused
+    with a 429 so that Telegram delivers it again later
+    """
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, const.TG_SECRET):
+        logger.warning("Telegram callback with an invalid secret token")
+        return JSONResponse({"success": False}, status_code=403)
+
+    if telegram.ingest.saturated():
+        return JSONResponse({"success": False}, status_code=429, headers={"Retry-After": "1"})
+
+    update = Update.de_json(data=json.loads(await request.body()), bot=telegram.app.bot)
+    if not telegram.ingest.submit(update):
+        return JSONResponse({"success": False}, status_code=429, headers={"Retry-After": "1"})
+
     return {"success": True}
 
 
@@ -32,9 +52,12 @@ async def lnbits_lnurlp_callback(request: Request):
     if re.search("^[0-9]+$", tg_userid):
         obj = await request.json()
         amount = int(obj["amount"] / 1000)
-        await telegram.app.bot.send_message(
+        # anyone can post to the callback, the balance is read from lnbits again instead of trusting the amount
+        users.helper.invalidate_balance(int(tg_userid))
+        telegram.sender.send_message(
             chat_id=int(tg_userid),
             text=f"Received {amount} sats. Type /stack to view your sats stack.",
+            priority=telegram.sender.PRIORITY_PAYMENT,
         )
     return {"success": True}
 
@@ -77,18 +100,15 @@ async def jukebox_status(request: Request):
 
     chat_id = request.query_params["chat_id"]
 
-    auth_manager = await spotify.helper.get_auth_manager(chat_id)
-    if auth_manager is None:
+    player = await players.get_player(chat_id)
+    if player is None:
         return {"title": "Nothing is playing at the moment."}
 
-    # create spotify instance
-    sp = spotipy.Spotify(auth_manager=auth_manager)
-
     # get the current track
-    track = sp.current_user_playing_track()
+    nowplaying = await player.now_playing()
     title = "Nothing is playing at the moment"
-    if track:
-        title = spotify.helper.get_track_title(track["item"])
+    if nowplaying is not None and nowplaying.track is not None:
+        title = nowplaying.track.title
     return {"title": title}
 
 
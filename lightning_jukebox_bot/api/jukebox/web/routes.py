@@ -1,11 +1,20 @@
 import logging
 import re
 
-import spotipy
-from fastapi import APIRouter
+from fastapi import APIRouter, WebSocket
 from fastapi.requests import Request
-
-from lightning_jukebox_bot.application import invoicing, spotify, users
+from fastapi.responses import StreamingResponse
+
+from lightning_jukebox_bot.application import (
+    invoicing,
+    leaderboard,
+    live,
+    players,
+    playqueue,
+    redis,
+    spotify,
+    users,
+)
 from lightning_jukebox_bot.application.telegram import app
 from lightning_jukebox_bot.application.telegram.util import check_invoice_callback
 from lightning_jukebox_bot.application.users.helper import User
@@ -22,9 +31,8 @@ async def web_home(request: Request, chat_id: int):
     if chat_id is None:
         return {"success": False, "message": "Incomplete request."}
 
-    # get spotify auth manager
-    auth_manager = await spotify.helper.get_auth_manager(chat_id)
-    if auth_manager is None:
+    # the page is only there for groups with a player
+    if await players.get_player(chat_id) is None:
         return {"success": False, "message": "Incomplete request."}
 
     return templates.TemplateResponse(request, "jukebox/web/index.html.jinja", context={"title": "Add Music"})
@@ -33,7 +41,6 @@ async def web_home(request: Request, chat_id: int):
 @router.post("/search")
 async def web_search(request: Request):
     chat_id = request.path_params["chat_id"]
-    print("Web search")
 
     # validate that chat_id is present
     if chat_id is None:
@@ -48,7 +55,7 @@ async def web_search(request: Request):
     # get form
     form = await request.json()
 
-    print("Web search for ", form)
+    logger.debug(f"Web search for {form}")
     # validate that form is present
     if form is None:
         return {"status": 400, "message": "Incomplete request form is None"}
@@ -64,46 +71,40 @@ async def web_search(request: Request):
     if not re.search("^[A-Za-z0-9 ]+$", query):
         return {"status": 400, "message": "Incomplete request query is invalid"}
 
-    # get spotify auth manager
-    auth_manager = await spotify.helper.get_auth_manager(chat_id)
-    if auth_manager is None:
-        return {"status": 400, "message": "Incomplete request auth manager is None"}
-
-    # create spotify instance
-    sp = spotipy.Spotify(auth_manager=auth_manager)
-    if sp is None:
-        return {"status": 400, "message": "Incomplete response sp is none"}
+    # get the player
+    player = await players.get_player(chat_id)
+    if player is None:
+        return {"status": 400, "message": "Incomplete request player is None"}
 
     # search for tracks
     numtries: int = 3
     while numtries > 0:
         try:
-            result = sp.search(query)
-        except spotipy.exceptions.SpotifyException:
+            result = await player.search(query)
+        except players.PlayerUnavailable:
             numtries -= 1
             if numtries == 0:
-                logger.error("Spotify returned and exception, not returning search result")
+                logger.error("Player returned an exception, not returning search result")
                 return {"status": 400, "message": "Search currently unavailable"}
-            logger.warning("Spotify returned and exception, retrying")
+            logger.warning("Player returned an exception, retrying")
             continue
         break
 
     # create a list of max five items
-    if len(result["tracks"]["items"]) == 0:
+    if len(result) == 0:
         return {"status": 200, "results": []}
 
     tracktitles = {}
     results = []
 
-    for item in result["tracks"]["items"]:
-        title = spotify.helper.get_track_title(item)
-        track_id = item["uri"]
-        result = re.search("^spotify:track:([A-Z0-9a-z]+)$", track_id)
-        if not result:
+    for track in result:
+        title = track.title
+        # strip the prefix of the player from the track id
+        if not track.uri.startswith(player.uri_prefix):
+            continue
+        track_id = track.uri[len(player.uri_prefix) :]
+        if not re.search("^[A-Z0-9a-z]+$", track_id):
             continue
-
-        # strip spotify from the track id
-        track_id = result.groups()[0]
 
         if title not in tracktitles:
             tracktitles[title] = 1
@@ -116,6 +117,57 @@ async def web_search(request: Request):
     return {"status": 200, "results": results}
 
 
+@router.get("/queue")
+async def web_queue(chat_id: int, count: int = 25, offset: int = 0):
+    """
+    The upcoming tracks of the group, in the order they are played
+    """
+    result = playqueue.helper.get_queue(chat_id, min(max(count, 1), 100), max(offset, 0))
+    for entry in result["entries"]:
+        # the requester stays private
+        del entry["userid"]
+    return {"status": 200, **result}
+
+
+@router.get("/top")
+async def web_top(chat_id: int, board: str = leaderboard.helper.PLAYS):
+    """
+    The leaderboard of the group, the most played tracks or the tracks with the most sats paid
+    """
+    if board not in leaderboard.helper.BOARDS:
+        return {"status": 400, "message": "Unknown leaderboard"}
+
+    return {"status": 200, "board": board, "tracks": leaderboard.helper.get_top(chat_id, board, 25)}
+
+
+@router.websocket("/live")
+async def web_live(websocket: WebSocket, chat_id: int):
+    """
+    What plays, the upcoming tracks and the tracks that were added, pushed as JSON messages when they change
+    """
+    if not redis.cache.exists(f"group:{chat_id}"):
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    await live.serve(websocket, chat_id)
+
+
+@router.get("/live")
+async def web_live_events(chat_id: int):
+    """
+    The messages of the live WebSocket as server-sent events, for browsers and radio sites that use an EventSource
+    """
+    if not redis.cache.exists(f"group:{chat_id}"):
+        return {"status": 404, "message": "Unknown jukebox"}
+
+    return StreamingResponse(
+        live.events(chat_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get("/add")
 async def web_add(request: Request):
     chat_id = request.path_params["chat_id"]
@@ -138,40 +190,49 @@ async def web_add(request: Request):
         logger.info("track_id is None")
         return {"status": 400, "message": "Incomplete request"}
 
-    # vaidate track id is spotify track
+    # vaidate track id is the id of a track without the prefix of the player
     # spotify:track:1532ejaMFnQPcHD9BAeqwr
     if not re.search("^[A-Za-z0-9]+$", track_id):
         logger.warning("track_id does not match regular expression")
         return {"status": 400, "message": "Incomplete request"}
 
-    # add spotify prefix to the track_id
-    track_id = f"spotify:track:{track_id}"
-
-    # get spotify auth manager
-    auth_manager = await spotify.helper.get_auth_manager(chat_id)
-    if auth_manager is None:
-        logger.warning("Auth_manager is NULL")
+    # get the player
+    player = await players.get_player(chat_id)
+    if player is None:
+        logger.warning("Player is None")
         return {"status": 400, "message": "Incomplete request"}
 
-    # create spotify instance
-    sp = spotipy.Spotify(auth_manager=auth_manager)
-
-    if sp is None:
-        logger.warning("sp is None")
-        return {"status": 400, "message": "Incomplete request"}
+    # add the prefix of the player to the track_id
+    track_id = f"{player.uri_prefix}{track_id}"
 
-    track = sp.track(track_id)
-    track_len = track["duration_ms"] / 1000
+    try:
+        track = await player.track(track_id)
+    except players.PlayerUnavailable:
+        return {"status": 400, "message": "Player currently unavailable"}
+    if track is None:
+        return {"status": 400, "message": "Unknown track"}
+    track_len = track.duration
+
+    # tracks that were requested or played recently are handled by the policy of the group
+    warning = None
+    policy = None
+    if len(playqueue.helper.claim(chat_id, [track_id])) > 0:
+        policy = playqueue.helper.get_duplicate_policy(chat_id)
+        warning = f"Track was requested or played in the last {config.duplicate_window // 60} minutes"
+        if policy == playqueue.helper.REJECT:
+            return {"status": 409, "message": warning}
 
     amount_to_pay = int(await spotify.helper.get_price(chat_id))
     if track_len > 600:
         amount_to_pay = 10 * amount_to_pay
+    if policy == playqueue.helper.PREMIUM:
+        amount_to_pay = config.duplicate_premium * amount_to_pay
     #        if ( track_len > 1800 ):
     #            amount_to_pay = 10 * amount_
     #        elif ( track_len > 600 ):
     #            amount_to_pay = amount_to_pay * 1.0166428 ** (track_len - 300)
     recipient = await users.helper.get_group_owner(chat_id)
-    invoice_title = f"'{spotify.helper.get_track_title(track)}'"
+    invoice_title = f"'{track.title}'"
     invoice = await invoicing.helper.create_invoice(recipient, amount_to_pay, invoice_title)
     if invoice is None:
         return {"status": 400, "message": "Payments not available"}
@@ -179,7 +240,7 @@ async def web_add(request: Request):
     invoice.user = User(80, "Web user")
     invoice.title = invoice_title
     invoice.recipient = recipient
-    logger.info("recipient when creating invoice: " + recipient.to_json())
+    logger.debug(f"Recipient of the invoice is {recipient.userid}")
     invoice.spotify_uri_list = [track_id]
     invoice.title = invoice_title
     invoice.chat_id = chat_id
@@ -188,9 +249,10 @@ async def web_add(request: Request):
     # save the invoice
     await invoicing.helper.save_invoice(invoice)
 
-    app.job_queue.run_once(check_invoice_callback, 15, data=invoice)
+    app.job_queue.run_once(check_invoice_callback, invoicing.helper.CHECK_INTERVAL, data=invoice)
 
     return {
         "status": 200,
         "payment_url": f"https://{config.domain}/jukebox/payinvoice?payment_hash={invoice.payment_hash}",
+        "warning": warning,
     }
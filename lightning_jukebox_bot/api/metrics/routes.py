@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+
+from lightning_jukebox_bot.application import invoicing, metrics, telegram
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def get_metrics():
+    """
+    Metrics in the Prometheus text format. The gauges are sampled when the metrics are scraped
+    """
+    metrics.pending_invoices.set(value=invoicing.helper.count_pending_invoices())
+    metrics.queue_depth.set("jobs", value=len(telegram.app.job_queue.jobs()))
+    metrics.queue_depth.set("updates", value=telegram.ingest.size())
+    metrics.queue_depth.set("outbound", value=telegram.sender.size())
+    metrics.command_store_size.set(value=len(telegram.helper.arf))
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,19 @@
+from fastapi import APIRouter, WebSocket
+
+from lightning_jukebox_bot.application import players
+
+router = APIRouter()
+
+
+@router.websocket("/player/{jukebox_id}")
+async def player_socket(websocket: WebSocket, jukebox_id: str):
+    """
+    The WebSocket of the music players of a group, the jukebox id is the token of the /player command
+    """
+    chat_id = players.remote.get_chat_id(jukebox_id)
+    if chat_id is None:
+        await websocket.close(code=players.remote.POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    await players.remote.controller.serve(websocket, chat_id)
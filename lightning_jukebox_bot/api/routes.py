@@ -1,7 +1,10 @@
 from fastapi import APIRouter
 
-from . import jukebox, spotify
+from . import admin, jukebox, metrics, player, spotify
 
 router = APIRouter()
 router.include_router(spotify.router)
 router.include_router(jukebox.router)
+router.include_router(metrics.router)
+router.include_router(admin.router)
+router.include_router(player.router)
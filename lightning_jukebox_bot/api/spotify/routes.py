@@ -51,7 +51,7 @@ async def spotify_callback(request: Request):
         if auth_manager is not None:
             auth_manager.get_access_token(code)
             await users.helper.set_group_owner(chatid, userid)
-            await telegram.app.bot.send_message(
+            await telegram.sender.send_message(
                 chat_id=userid,
                 text="Spotify connected to the chat. All revenues of requested tracks are coming your way. "
                 "Execute the /decouple command in the group to remove the authorisation.",
@@ -1,11 +1,23 @@
 import logging
 from contextlib import asynccontextmanager
+from time import perf_counter
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 
 from lightning_jukebox_bot import api
-from lightning_jukebox_bot.application import telegram
-from lightning_jukebox_bot.settings import config
+from lightning_jukebox_bot.application import (
+    leaderboard,
+    live,
+    metrics,
+    players,
+    stats,
+    telegram,
+    tracing,
+    watchdog,
+)
+from lightning_jukebox_bot.application.lnbits import LNbitsUnavailable
+from lightning_jukebox_bot.settings import config, const
 from lightning_jukebox_bot.ui.static import static
 
 logger = logging.getLogger(__name__)
@@ -13,6 +25,11 @@ logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
+    telegram.media.load_templates()
+    stats.helper.build_index()
+    leaderboard.helper.migrate()
+    players.start()
+
     async with telegram.app:
         logger.info(f'Jukebox url: "https://{config.domain}/jukebox/telegram"')
         logger.info(f"Jukebox IP: {config.ipaddress}")
@@ -20,13 +37,54 @@ async def lifespan(_: FastAPI):
             url=f"https://{config.domain}/jukebox/telegram",
             allowed_updates=["callback_query", "message"],
             ip_address=config.ipaddress,
+            secret_token=const.TG_SECRET,
         )
 
         await telegram.app.start()
+        await telegram.sender.start()
+        await telegram.ingest.start()
+        metrics.start()
+        watchdog.start()
+        tracing.start()
+        live.start()
         yield
+        await live.stop()
+        await tracing.stop()
+        await watchdog.stop()
+        await metrics.stop()
+        await telegram.ingest.stop()
+        await telegram.sender.stop()
         await telegram.app.stop()
+        await config.lnbits.aclose()
+    players.stop()
 
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(api.router)
 app.mount("/static", static, name="static")
+
+
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    start = perf_counter()
+    status = 500
+    with tracing.trace(f"{request.method} {request.url.path}") as root:
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # the route template keeps the ids in the path out of the labels
+            route = request.scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            metrics.http_latency.observe(request.method, route, value=perf_counter() - start)
+            metrics.http_requests.inc(request.method, route, str(status))
+            if root is not None:
+                root.name = f"{request.method} {route}"
+                root.attributes.update(path=request.url.path, status=status)
+                root.error = status >= 500
+
+
+@app.exception_handler(LNbitsUnavailable)
+async def lnbits_unavailable(_: Request, exc: LNbitsUnavailable) -> JSONResponse:
+    return JSONResponse({"success": False, "detail": str(exc)}, status_code=503, headers={"Retry-After": "30"})
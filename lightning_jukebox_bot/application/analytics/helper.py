@@ -0,0 +1,77 @@
+from time import time
+
+from lightning_jukebox_bot.application import redis
+from lightning_jukebox_bot.settings import config
+
+# seconds per bucket of a resolution
+RESOLUTIONS = {"hour": 3600, "day": 24 * 3600}
+
+# the resolution and the number of buckets of a report
+PERIODS = {"day": ("hour", 24), "week": ("day", 7), "month": ("day", 30)}
+
+
+def _retention(resolution: str) -> int:
+    """
+    Seconds a bucket is kept after it ended
+    """
+    days = config.analytics_hourly_retention if resolution == "hour" else config.analytics_daily_retention
+    return days * 24 * 3600
+
+
+def _bucketkey(chat_id: int, resolution: str, start: int) -> str:
+    return f"analytics:{chat_id}:{resolution}:{start}"
+
+
+def _userskey(chat_id: int, resolution: str, start: int) -> str:
+    return f"analytics:{chat_id}:{resolution}:{start}:users"
+
+
+def record_tracks(pipe, chat_id: int, userid: int, tracks: int, sats: int) -> None:
+    """
+    Add the tracks that a user added to the queue of a group and the sats that were paid for them to the buckets
+    of each resolution. The commands are added to the pipeline of the caller
+    """
+    now = int(time())
+    for resolution, seconds in RESOLUTIONS.items():
+        start = now - now % seconds
+        expiry = start + seconds + _retention(resolution)
+
+        key = _bucketkey(chat_id, resolution, start)
+        pipe.hincrby(key, "tracks", tracks)
+        pipe.hincrby(key, "sats", sats)
+        pipe.expireat(key, expiry)
+
+        key = _userskey(chat_id, resolution, start)
+        pipe.pfadd(key, userid)
+        pipe.expireat(key, expiry)
+
+
+def get_report(chat_id: int, period: str) -> dict:
+    """
+    Returns the tracks and sats per bucket of the period, the latest bucket last, with the totals and the number of
+    unique requesters. Reads one key per bucket
+    """
+    resolution, count = PERIODS[period]
+    seconds = RESOLUTIONS[resolution]
+    now = int(time())
+    starts = [now - now % seconds - i * seconds for i in reversed(range(count))]
+
+    pipe = redis.cache.pipeline()
+    for start in starts:
+        pipe.hmget(_bucketkey(chat_id, resolution, start), "tracks", "sats")
+    pipe.pfcount(*[_userskey(chat_id, resolution, start) for start in starts])
+    data = pipe.execute()
+
+    buckets = []
+    for start, [tracks, sats] in zip(starts, data[:-1]):
+        buckets.append({"start": start, "tracks": int(tracks or 0), "sats": int(sats or 0)})
+
+    return {
+        "chat_id": chat_id,
+        "period": period,
+        "resolution": resolution,
+        "tracks": sum(bucket["tracks"] for bucket in buckets),
+        "sats": sum(bucket["sats"] for bucket in buckets),
+        "users": data[-1],
+        "buckets": buckets,
+    }
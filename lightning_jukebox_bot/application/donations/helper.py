@@ -0,0 +1,192 @@
+import asyncio
+import json
+import logging
+import random
+import string
+from time import time
+
+from lightning_jukebox_bot.application import (
+    invoicing,
+    redis,
+    spotify,
+    stats,
+    tracing,
+    users,
+)
+from lightning_jukebox_bot.settings import config
+
+logger = logging.getLogger(__name__)
+
+# per group owner: sats that are not settled yet, recorded in total and settled in total
+PENDING_KEY = "donations:pending"
+RECORDED_KEY = "donations:recorded"
+SETTLED_KEY = "donations:settled"
+
+# the most recent settlements
+LOG_KEY = "donations:log"
+
+settle_lock = asyncio.Lock()
+settle_task = None
+
+
+def _batchkey(owner: int) -> str:
+    return f"donations:batch:{owner}"
+
+
+async def record_donation(owner: int, chat_id: int, amount_to_pay: int, reference: str) -> int:
+    """
+    Record the donation to the bot for a paid track. The donation is settled later by settle_donations.
+    Recording the same reference twice has no effect. Returns the amount recorded
+    """
+    amount: int = await spotify.helper.get_donation_fee(chat_id)
+    amount = min(amount, amount_to_pay)
+    if amount <= 0:
+        return 0
+
+    if not redis.cache.set(f"donation:{reference}", amount, nx=True, ex=7 * 24 * 3600):
+        logger.info(f"Donation for {reference} already recorded")
+        return 0
+
+    pipe = redis.cache.pipeline()
+    pipe.hincrby(PENDING_KEY, owner, amount)
+    pipe.hincrby(RECORDED_KEY, owner, amount)
+    [pending, _] = pipe.execute()
+    stats.helper.add_donation(chat_id, amount)
+
+    global settle_task
+    if pending >= config.donation_settle_threshold and (settle_task is None or settle_task.done()):
+        # the settlement outlives the payment that triggered it
+        with tracing.detached():
+            settle_task = asyncio.get_running_loop().create_task(settle_donations())
+
+    return amount
+
+
+async def _finish_batch(owner: int, batch: dict) -> None:
+    entry = {
+        "batch": batch["id"],
+        "owner": owner,
+        "amount": int(batch["amount"]),
+        "payment_hash": batch["payment_hash"],
+        "time": int(time()),
+    }
+    pipe = redis.cache.pipeline()
+    pipe.hincrby(SETTLED_KEY, owner, int(batch["amount"]))
+    pipe.lpush(LOG_KEY, json.dumps(entry))
+    pipe.ltrim(LOG_KEY, 0, 999)
+    pipe.delete(_batchkey(owner))
+    pipe.execute()
+    logger.info(f"Settled {batch['amount']} sats of donations from {owner} in batch {batch['id']}")
+
+
+async def settle_owner(jukeboxbot: users.helper.User, owner: int) -> bool:
+    """
+    Pay the donations of one owner to the bot in one payment. The batch is stored before anything is paid, so a
+    batch that was interrupted is retried with the same invoice instead of paying twice
+    """
+    batchkey = _batchkey(owner)
+    batch = {key.decode("utf-8"): value.decode("utf-8") for key, value in redis.cache.hgetall(batchkey).items()}
+
+    if not batch:
+        amount = int(redis.cache.hget(PENDING_KEY, owner) or 0)
+        if amount <= 0:
+            return True
+
+        # move the amount from pending to the batch
+        batch = {
+            "id": "".join(random.sample(string.ascii_letters, 12)),
+            "amount": amount,
+            "payment_hash": "",
+            "payment_request": "",
+        }
+        pipe = redis.cache.pipeline(transaction=True)
+        pipe.hincrby(PENDING_KEY, owner, -amount)
+        pipe.hset(batchkey, mapping=batch)
+        pipe.execute()
+
+    if batch["payment_hash"] != "":
+        # the batch might have been paid just before an interruption
+        if await config.lnbits.checkInvoice(jukeboxbot.invoicekey, batch["payment_hash"]):
+            await _finish_batch(owner, batch)
+            return True
+    else:
+        invoice = await invoicing.helper.create_invoice(
+            jukeboxbot, int(batch["amount"]), f"donations to the bot, batch {batch['id']}"
+        )
+        batch["payment_hash"] = invoice.payment_hash
+        batch["payment_request"] = invoice.payment_request
+        redis.cache.hset(
+            batchkey, mapping={"payment_hash": invoice.payment_hash, "payment_request": invoice.payment_request}
+        )
+
+    donator = await users.helper.get_or_create_user(owner)
+    invoice = invoicing.helper.Invoice(batch["payment_hash"], batch["payment_request"])
+    invoice.amount_to_pay = int(batch["amount"])
+    invoice.recipient = jukeboxbot
+    result = await invoicing.helper.pay_invoice(donator, invoice)
+    if result["result"]:
+        await _finish_batch(owner, batch)
+        return True
+
+    # a duplicate payment means the invoice was paid already
+    if await config.lnbits.checkInvoice(jukeboxbot.invoicekey, batch["payment_hash"]):
+        await _finish_batch(owner, batch)
+        return True
+
+    # the invoice could have expired, create a new one in the next round
+    logger.warning(f"Settling donations of {owner} failed: {result['detail']}")
+    redis.cache.hset(batchkey, mapping={"payment_hash": "", "payment_request": ""})
+    return False
+
+
+async def settle_donations(context=None) -> None:
+    """
+    This function settles the pending donations of all owners
+    """
+    if settle_lock.locked():
+        return
+
+    async with settle_lock:
+        owners = {int(owner) for owner, amount in redis.cache.hgetall(PENDING_KEY).items() if int(amount) > 0}
+        owners |= {int(key.decode("utf-8").split(":")[2]) for key in redis.cache.scan_iter("donations:batch:*")}
+        if len(owners) == 0:
+            return
+
+        jukeboxbot = await users.helper.get_or_create_user(config.bot_id)
+        for owner in owners:
+            try:
+                await settle_owner(jukeboxbot, owner)
+            except Exception:
+                logger.exception(f"Unhandled exception while settling donations of {owner}")
+
+
+def get_report() -> dict:
+    """
+    Returns the totals of the ledger and the owners for which recorded donations do not add up to
+    the settled, pending and in flight donations
+    """
+    pipe = redis.cache.pipeline()
+    pipe.hgetall(RECORDED_KEY)
+    pipe.hgetall(SETTLED_KEY)
+    pipe.hgetall(PENDING_KEY)
+    [recorded, settled, pending] = [{int(k): int(v) for k, v in result.items()} for result in pipe.execute()]
+
+    in_flight = {}
+    for key in redis.cache.scan_iter("donations:batch:*"):
+        amount = redis.cache.hget(key, "amount")
+        if amount is not None:
+            in_flight[int(key.decode("utf-8").split(":")[2])] = int(amount)
+
+    mismatches = []
+    for owner in set(recorded) | set(settled) | set(pending) | set(in_flight):
+        accounted = settled.get(owner, 0) + pending.get(owner, 0) + in_flight.get(owner, 0)
+        if recorded.get(owner, 0) != accounted:
+            mismatches.append({"owner": owner, "recorded": recorded.get(owner, 0), "accounted": accounted})
+
+    return {
+        "recorded": sum(recorded.values()),
+        "settled": sum(settled.values()),
+        "pending": sum(pending.values()),
+        "in_flight": sum(in_flight.values()),
+        "mismatches": mismatches,
+    }
@@ -1,21 +1,56 @@
 import json
 import logging
+from time import time
 
 import aiomqtt
-import spotipy
 from aiomqtt import MqttError
 from telegram.error import TelegramError
 
-from lightning_jukebox_bot.application import redis, spotify, telegram, users
+from lightning_jukebox_bot.application import (
+    donations,
+    live,
+    metrics,
+    players,
+    playqueue,
+    redis,
+    stats,
+    telegram,
+    users,
+)
 from lightning_jukebox_bot.application.users.helper import User
 from lightning_jukebox_bot.settings import config
 
+# version of the encoding of Invoice.encode
+INVOICE_ENCODING = b"1:"
+
+# sorted set of the payment hashes of unpaid invoices, scored by their expiry
+PENDING_KEY = "invoices:pending"
+
+# seconds between the checks of an unpaid invoice
+CHECK_INTERVAL = 15
+
+# the key of an invoice outlives the invoice at lnbits, so the last check still finds an invoice paid just before it
+# expired
+EXPIRY_GRACE = 2 * CHECK_INTERVAL
+
 
 class Invoice:
+    __slots__ = (
+        "payment_hash",
+        "payment_request",
+        "recipient",
+        "user",
+        "amount_to_pay",
+        "spotify_uri_list",
+        "title",
+        "chat_id",
+        "message_id",
+        "ttl",
+    )
+
     def __init__(self, payment_hash, payment_request=None):
         self.payment_hash = payment_hash
         self.payment_request = payment_request
-        self.rediskey = f"invoice:{self.payment_hash}"
         self.recipient = None
         self.user = None
         self.amount_to_pay = None
@@ -23,7 +58,11 @@ class Invoice:
         self.title = None
         self.chat_id = None
         self.message_id = None
-        self.ttl = 300
+        self.ttl = config.invoice_expiry
+
+    @property
+    def rediskey(self) -> str:
+        return f"invoice:{self.payment_hash}"
 
     def to_json(self):
         userdata = {
@@ -64,10 +103,60 @@ class Invoice:
         self.chat_id = data["chat_id"]
         self.message_id = data["message_id"]
 
+    def encode(self) -> bytes:
+        """
+        Compact encoding for storage in redis, the payment hash is part of the key
+        """
+        return INVOICE_ENCODING + json.dumps(
+            [
+                self.payment_request,
+                self.amount_to_pay,
+                self.recipient.userid,
+                self.recipient.username,
+                self.user.userid,
+                self.user.username,
+                self.spotify_uri_list,
+                self.title,
+                self.chat_id,
+                self.message_id,
+            ],
+            separators=(",", ":"),
+        ).encode("utf-8")
+
+    def decode(self, data: bytes) -> None:
+        """
+        Load the invoice from the output of encode, or from the legacy json format
+        """
+        assert data is not None
+        if not data.startswith(INVOICE_ENCODING):
+            self.from_json(data)
+            return
+
+        [
+            payment_request,
+            self.amount_to_pay,
+            recipient_userid,
+            recipient_username,
+            user_userid,
+            user_username,
+            self.spotify_uri_list,
+            self.title,
+            self.chat_id,
+            self.message_id,
+        ] = json.loads(data[len(INVOICE_ENCODING) :])
+
+        if self.payment_request is not None:
+            assert self.payment_request == payment_request
+        else:
+            self.payment_request = payment_request
+
+        self.recipient = User(recipient_userid, recipient_username)
+        self.user = User(user_userid, user_username)
+
 
 # Get/Create a QR code and store in filename
 async def create_invoice(user: User, amount: int, memo: str) -> Invoice:
-    lnbits_invoice = await config.lnbits.createInvoice(user.invoicekey, amount, memo, None)
+    lnbits_invoice = await config.lnbits.createInvoice(user.invoicekey, amount, memo, None, config.invoice_expiry)
     invoice = Invoice(lnbits_invoice["payment_hash"], lnbits_invoice["payment_request"])
     return invoice
 
@@ -78,6 +167,13 @@ async def pay_invoice(user: User, invoice: Invoice):
     result = await config.lnbits.payInvoice(invoice.payment_request, user.adminkey)
 
     if result["result"]:
+        # keep the cached balances up to date
+        if invoice.amount_to_pay is not None:
+            users.helper.adjust_balance(user.userid, -invoice.amount_to_pay)
+            if invoice.recipient is not None:
+                users.helper.adjust_balance(invoice.recipient.userid, invoice.amount_to_pay)
+        else:
+            users.helper.invalidate_balance(user.userid)
         return {"result": True, "detail": "Payment success"}
     else:
         retval = {"result": False, "detail": result["detail"]}
@@ -85,7 +181,19 @@ async def pay_invoice(user: User, invoice: Invoice):
 
 
 async def save_invoice(invoice: Invoice) -> None:
-    redis.cache.set(invoice.rediskey, invoice.to_json())
+    # the invoice expires at lnbits, the key a grace period later
+    ttl = config.invoice_expiry + EXPIRY_GRACE
+    pipe = redis.cache.pipeline()
+    pipe.set(invoice.rediskey, invoice.encode(), ex=ttl)
+    pipe.zadd(PENDING_KEY, {invoice.payment_hash: time() + ttl})
+    pipe.execute()
+
+
+async def update_invoice(invoice: Invoice) -> bool:
+    """
+    Store the changes of a saved invoice, returns False when it was paid, canceled or expired in the meantime
+    """
+    return redis.cache.set(invoice.rediskey, invoice.encode(), xx=True, keepttl=True) is not None
 
 
 async def delete_invoice(payment_hash: str) -> bool:
@@ -93,12 +201,26 @@ async def delete_invoice(payment_hash: str) -> bool:
         logging.error("Delete invoice called with None payment_hash")
         return False
     rediskey = f"invoice:{payment_hash}"
-    if redis.cache.delete(rediskey) == 0:
-        logging.info("Invoice already deleted")
+    pipe = redis.cache.pipeline()
+    pipe.delete(rediskey)
+    pipe.zrem(PENDING_KEY, payment_hash)
+    deleted, _ = pipe.execute()
+    if deleted == 0:
+        logging.debug("Invoice already deleted")
         return False
     return True
 
 
+def count_pending_invoices() -> int:
+    """
+    Returns the number of invoices that are neither paid, canceled nor expired
+    """
+    pipe = redis.cache.pipeline()
+    pipe.zremrangebyscore(PENDING_KEY, "-inf", time())
+    pipe.zcard(PENDING_KEY)
+    return pipe.execute()[1]
+
+
 async def invoice_paid(invoice: Invoice) -> bool:
     result = await config.lnbits.checkInvoice(invoice.recipient.invoicekey, invoice.payment_hash)
     if result:
@@ -117,63 +239,74 @@ async def get_invoice(payment_hash: str) -> Invoice:
         return None
 
     invoice = Invoice(payment_hash, None)
-    invoice.from_json(data)
-    print(invoice)
+    invoice.decode(data)
     return invoice
 
 
 async def callback_paid_invoice(invoice: Invoice):
+    """
+    Queue the tracks of an invoice that LNbits reported as paid. The report comes from an unauthenticated webhook, so
+    the payment is checked with LNbits before the tracks are queued and the balance and the donation are recorded
+    """
     if invoice is None:
         logging.error("Invoice is None")
         return
-    logging.info("callback_paid_invoice")
-    logging.info(invoice.to_json())
+    logging.debug(f"Paid invoice {invoice.payment_hash}")
 
     if invoice.chat_id is None:
         logging.error("Invoice chat_id is None")
         return
 
+    # the stored invoice only has the id of the recipient, the check needs the invoice key
+    invoice.recipient = await users.helper.get_or_create_user(invoice.recipient.userid, invoice.recipient.username)
+    if not await invoice_paid(invoice):
+        logging.warning(f"Invoice {invoice.payment_hash} was reported paid but LNbits does not know the payment")
+        return
+
     if not await delete_invoice(invoice.payment_hash):
-        logging.info("invoicehelper.delete_invoice returned False")
+        logging.debug("invoicehelper.delete_invoice returned False")
         return
 
-    auth_manager = await spotify.helper.get_auth_manager(invoice.chat_id)
-    if auth_manager is None:
-        logging.error("No auth manager after succesfull payment")
+    player = await players.get_player(invoice.chat_id)
+    if player is None:
+        logging.error("No player after succesfull payment")
         return
 
-    try:
-        logging.info(f"Trying to delete chat_id {invoice.chat_id}, messageid {invoice.message_id}")
-        await telegram.app.bot.delete_message(invoice.chat_id, invoice.message_id)
-    except TelegramError:
-        pass
+    if invoice.message_id is not None:
+        try:
+            logging.debug(f"Trying to delete chat_id {invoice.chat_id}, messageid {invoice.message_id}")
+            await telegram.app.bot.delete_message(invoice.chat_id, invoice.message_id)
+        except TelegramError:
+            pass
 
     # add to the queue and inform others
-    sp = spotipy.Spotify(auth_manager=auth_manager)
-
-    spotify.helper.add_to_queue(sp, invoice.spotify_uri_list)
-    try:
-        await telegram.app.bot.send_message(
-            chat_id=invoice.chat_id,
-            parse_mode="HTML",
-            text=f"'{invoice.title}' was added to the queue.",
-        )
-    except TelegramError:
-        logging.error("Could not  send message to the group that track was added to the queue")
+    tracks = await player.tracks(invoice.spotify_uri_list)
+    titles = [track.title if track is not None else uri for uri, track in zip(invoice.spotify_uri_list, tracks)]
+    await playqueue.helper.enqueue(
+        invoice.chat_id, invoice.user.userid, list(zip(invoice.spotify_uri_list, titles)), player
+    )
+    live.publish_added(invoice.chat_id, invoice.user.username, titles)
+    stats.helper.add_tracks(invoice.chat_id, invoice.user.userid, invoice.spotify_uri_list, invoice.amount_to_pay)
+    telegram.sender.send_message(
+        chat_id=invoice.chat_id,
+        parse_mode="HTML",
+        text=f"'{invoice.title}' was added to the queue.",
+        priority=telegram.sender.PRIORITY_PAYMENT,
+    )
 
     try:
-        async with aiomqtt.Client("localhost") as client:
-            await client.publish(f"{invoice.chat_id}/added_to_queue", payload=invoice.title)
+        with metrics.track_dependency("mqtt", "publish"):
+            async with aiomqtt.Client("localhost") as client:
+                await client.publish(f"{invoice.chat_id}/added_to_queue", payload=invoice.title)
     except MqttError:
         logging.error("Exception when publishing queue add to mqtt")
         pass
 
-    # make donation to the bot
-    jukeboxbot = await users.helper.get_or_create_user(config.bot_id)
-    donator = await users.helper.get_or_create_user(invoice.recipient.userid)
-    donation_amount: int = await spotify.helper.get_donation_fee(invoice.chat_id)
-    donation_amount = min(donation_amount, invoice.amount_to_pay)
-    donation_invoice = await create_invoice(jukeboxbot, donation_amount, "donation to the bot")
-    result = await pay_invoice(donator, donation_invoice)
+    # the payment was made outside of the bot, or by the bot before its own answer arrived
+    users.helper.invalidate_balance(invoice.recipient.userid)
+    users.helper.invalidate_balance(invoice.user.userid)
 
-    return result
+    # record the donation to the bot, it is settled in the background
+    await donations.helper.record_donation(
+        invoice.recipient.userid, invoice.chat_id, invoice.amount_to_pay, invoice.payment_hash
+    )
@@ -0,0 +1 @@
+from . import helper  # noqa: F401
@@ -0,0 +1,150 @@
+import logging
+from time import time
+
+from lightning_jukebox_bot.application import redis, stats
+from lightning_jukebox_bot.settings import config
+
+logger = logging.getLogger(__name__)
+
+# the play counts and the sats paid per track
+PLAYS = "plays"
+SATS = "sats"
+BOARDS = [PLAYS, SATS]
+
+# set once the legacy lastplayed hashes are removed
+MIGRATED_KEY = "top:migrated"
+
+# entries with a lower score after a decay are removed
+MIN_SCORE = 0.5
+
+
+def _prefix(chat_id: int) -> str:
+    """
+    The prefix of the keys of the leaderboards of a group, or of the global leaderboards without a group
+    """
+    return "top" if chat_id is None else f"top:{chat_id}"
+
+
+def _keys(chat_id: int) -> list:
+    prefix = _prefix(chat_id)
+    return [f"{prefix}:{PLAYS}", f"{prefix}:{SATS}", f"{prefix}:titles"]
+
+
+def playedkey(chat_id: int) -> str:
+    return f"played:{chat_id}"
+
+
+# decay the scores when the factor is below 1, trim the leaderboards to the size once they grew to twice the size
+# and forget the titles of the tracks that are on neither leaderboard anymore
+_compact = redis.cache.register_script("""
+    local size = tonumber(ARGV[1])
+    local factor = tonumber(ARGV[2])
+    local changed = false
+    for i = 1, 2 do
+        if factor < 1 then
+            redis.call('zunionstore', KEYS[i], 1, KEYS[i], 'WEIGHTS', factor)
+            redis.call('zremrangebyscore', KEYS[i], '-inf', '(' .. ARGV[3])
+            changed = true
+        end
+        if redis.call('zcard', KEYS[i]) > 2 * size then
+            redis.call('zremrangebyrank', KEYS[i], 0, -size - 1)
+            changed = true
+        end
+    end
+    if changed then
+        for _, uri in ipairs(redis.call('hkeys', KEYS[3])) do
+            if not redis.call('zscore', KEYS[1], uri) and not redis.call('zscore', KEYS[2], uri) then
+                redis.call('hdel', KEYS[3], uri)
+            end
+        end
+    end
+    """)
+
+# the top of a leaderboard with the titles of the tracks
+_read_top = redis.cache.register_script("""
+    local result = {}
+    local entries = redis.call('zrevrange', KEYS[1], 0, ARGV[1] - 1, 'WITHSCORES')
+    for i = 1, #entries, 2 do
+        table.insert(result, entries[i])
+        table.insert(result, entries[i + 1])
+        table.insert(result, redis.call('hget', KEYS[2], entries[i]))
+    end
+    return result
+    """)
+
+
+def _compact_boards(pipe, chat_id: int, factor: float = 1) -> None:
+    _compact(keys=_keys(chat_id), args=[config.leaderboard_size, factor, MIN_SCORE], client=pipe)
+
+
+def record_play(chat_id: int, uri: str, title: str) -> None:
+    """
+    Count a track that started playing in a group, in the leaderboards of the group and the global leaderboards
+    """
+    pipe = redis.cache.pipeline()
+    for key in [chat_id, None]:
+        [plays, _, titles] = _keys(key)
+        pipe.zincrby(plays, 1, uri)
+        pipe.hset(titles, uri, title)
+        _compact_boards(pipe, key)
+
+    # the recently played tracks
+    pipe.zadd(playedkey(chat_id), {uri: int(time())})
+    pipe.zremrangebyrank(playedkey(chat_id), 0, -config.leaderboard_recent - 1)
+    pipe.execute()
+
+
+def record_sats(pipe, chat_id: int, uris: list, sats: int) -> None:
+    """
+    Add the sats that were paid for the tracks to the leaderboards. The commands are added to the pipeline of the
+    caller, the titles are recorded when the tracks play
+    """
+    if sats <= 0 or len(uris) == 0:
+        return
+    for key in [chat_id, None]:
+        [_, board, _] = _keys(key)
+        for uri in uris:
+            pipe.zincrby(board, sats / len(uris), uri)
+        _compact_boards(pipe, key)
+
+
+def get_top(chat_id: int, board: str, count: int = 10) -> list:
+    """
+    Returns the tracks with the highest score on the leaderboard of a group, or of all groups when chat_id is None,
+    as dicts of the uri, title and score. The title is None when the track did not play yet
+    """
+    [plays, sats, titles] = _keys(chat_id)
+    data = _read_top(keys=[plays if board == PLAYS else sats, titles], args=[count])
+
+    result = []
+    for i in range(0, len(data), 3):
+        title = data[i + 2].decode("utf-8") if data[i + 2] is not None else None
+        result.append({"uri": data[i].decode("utf-8"), "title": title, "score": round(float(data[i + 1]))})
+    return result
+
+
+async def decay(context) -> None:
+    """
+    Let older plays and payments count less, the scores halve every leaderboard_half_life days. Runs daily
+    """
+    factor = 0.5 ** (1 / config.leaderboard_half_life)
+    pipe = redis.cache.pipeline(transaction=False)
+    groups = [int(chat_id) for chat_id in redis.cache.zrange(stats.helper.GROUPS_KEY, 0, -1)]
+    for chat_id in groups + [None]:
+        _compact_boards(pipe, chat_id, factor)
+    pipe.execute()
+    logger.info(f"Decayed the leaderboards of {len(groups)} groups by {factor:.3f}")
+
+
+def migrate() -> None:
+    """
+    Remove the lastplayed hashes that grew with every track ever played, once
+    """
+    if not redis.cache.set(MIGRATED_KEY, int(time()), nx=True):
+        return
+
+    count = 0
+    for key in redis.cache.scan_iter("lastplayed:*"):
+        redis.cache.unlink(key)
+        count += 1
+    logger.info(f"Removed {count} lastplayed hashes")
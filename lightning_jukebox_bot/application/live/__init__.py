@@ -0,0 +1,240 @@
+"""
+The live feed of a group for the web jukebox and the radio sites: what plays now, the upcoming tracks and who added
+which tracks. The bot publishes a change once to the redis channel of the group, the poller of the now playing
+message is the single publisher of what plays. Every process has one hub that subscribes to the channels of the
+groups it has listeners for and fans the messages out to them, so a listener costs a queue in memory and no calls to
+the player.
+
+The last nowplaying and queue messages of a group are kept in redis, a new listener gets them first. A listener that
+falls live_send_queue messages behind loses the oldest ones, the state messages are complete so it catches up with
+the next change.
+"""
+
+import asyncio
+import json
+import logging
+from time import time
+
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+from starlette.websockets import WebSocket
+
+from lightning_jukebox_bot.application import playqueue, redis
+from lightning_jukebox_bot.settings import config
+
+logger = logging.getLogger(__name__)
+
+NOWPLAYING = "nowplaying"
+QUEUE = "queue"
+ADDED = "added"
+
+# the messages that are replayed to a new listener
+STATE = [NOWPLAYING, QUEUE]
+STATE_TTL = 24 * 3600
+
+
+def _channel(chat_id: int) -> str:
+    return f"live:{chat_id}"
+
+
+def _statekey(chat_id: int, topic: str) -> str:
+    return f"{_channel(chat_id)}:{topic}"
+
+
+def publish(chat_id: int, topic: str, **fields) -> str:
+    """
+    Publish a message to the listeners of the group in all processes, returns the message
+    """
+    message = json.dumps({"topic": topic, **fields}, separators=(",", ":"))
+    pipe = redis.cache.pipeline(transaction=False)
+    if topic in STATE:
+        pipe.set(_statekey(chat_id, topic), message, ex=STATE_TTL)
+    pipe.publish(_channel(chat_id), message)
+    pipe.execute()
+    return message
+
+
+def publish_now_playing(chat_id: int, title: str, remaining: float) -> None:
+    publish(chat_id, NOWPLAYING, title=title, ends=round(time() + remaining, 1))
+
+
+def publish_queue(chat_id: int) -> None:
+    """
+    Publish the length of the queue and its first tracks, the requesters stay private
+    """
+    queue = playqueue.helper.get_queue(chat_id, config.live_queue_entries)
+    for entry in queue["entries"]:
+        del entry["userid"]
+    publish(chat_id, QUEUE, **queue)
+
+
+def publish_added(chat_id: int, username: str, titles: list) -> None:
+    publish(chat_id, ADDED, user=username, titles=titles)
+
+
+class Listener:
+    """
+    The messages waiting to be written to a listener of a group
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.messages = asyncio.Queue(maxsize=config.live_send_queue)
+
+    def put(self, message: str) -> None:
+        if self.messages.full():
+            self.messages.get_nowait()
+        self.messages.put_nowait(message)
+
+
+class Hub:
+    """
+    The listeners of the groups by chat id. The channels of groups without listeners are unsubscribed by the task
+    that reads the messages, so a listener leaves without waiting for redis
+    """
+
+    def __init__(self):
+        self.groups = {}
+        # the state messages of the subscribed groups by topic, only the first listener of a group reads redis
+        self.state = {}
+        self.channels = set()
+        # guards the groups that gain their first listener, the channels and the commands of the subscription. The
+        # first command makes the connection
+        self.lock = asyncio.Lock()
+        self.pubsub = None
+        self._reader = None
+
+    def listeners(self) -> int:
+        return sum(len(listeners) for listeners in self.groups.values())
+
+    async def subscribe(self, chat_id: int) -> Listener:
+        listener = Listener(chat_id)
+        group = self.groups.get(chat_id)
+        if group:
+            # the channel of a group with listeners stays subscribed, a group only gets its first listener in the lock
+            group.add(listener)
+        else:
+            async with self.lock:
+                self.groups.setdefault(chat_id, set()).add(listener)
+                if chat_id not in self.channels:
+                    self.channels.add(chat_id)
+                    state = redis.cache.mget([_statekey(chat_id, topic) for topic in STATE])
+                    self.state[chat_id] = {
+                        topic: message.decode("utf-8") for topic, message in zip(STATE, state) if message is not None
+                    }
+                    await self.pubsub.subscribe(_channel(chat_id))
+
+        for message in self.state.get(chat_id, {}).values():
+            listener.put(message)
+        return listener
+
+    def unsubscribe(self, listener: Listener) -> None:
+        listeners = self.groups.get(listener.chat_id, set())
+        listeners.discard(listener)
+        if len(listeners) == 0:
+            self.groups.pop(listener.chat_id, None)
+
+    def fan_out(self, chat_id: int, message: str) -> None:
+        topic = json.loads(message).get("topic")
+        if topic in STATE and chat_id in self.state:
+            self.state[chat_id][topic] = message
+        for listener in self.groups.get(chat_id, ()):
+            listener.put(message)
+
+    async def _read(self) -> None:
+        while True:
+            if not self.pubsub.subscribed:
+                await asyncio.sleep(1)
+                continue
+            try:
+                if any(chat_id not in self.groups for chat_id in self.channels):
+                    async with self.lock:
+                        # a listener may have joined while waiting for the lock
+                        unused = [chat_id for chat_id in self.channels if chat_id not in self.groups]
+                        self.channels.difference_update(unused)
+                        for chat_id in unused:
+                            self.state.pop(chat_id, None)
+                        if len(unused) > 0:
+                            await self.pubsub.unsubscribe(*[_channel(chat_id) for chat_id in unused])
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+            except (RedisError, OSError) as e:
+                # the subscriptions are renewed when the connection is made again
+                logger.error(f"Reading the live feeds failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            chat_id = int(message["channel"].decode("utf-8").split(":")[1])
+            self.fan_out(chat_id, message["data"].decode("utf-8"))
+
+    def start(self) -> None:
+        connection = redis.cache.connection_pool.connection_kwargs
+        client = aioredis.Redis(
+            host=connection.get("host", "localhost"),
+            port=connection.get("port", 6379),
+            db=connection.get("db", 0),
+            password=connection.get("password"),
+        )
+        self.pubsub = client.pubsub()
+        self._reader = asyncio.create_task(self._read())
+
+    async def stop(self) -> None:
+        self._reader.cancel()
+        self._reader = None
+        await self.pubsub.aclose()
+
+
+async def serve(websocket: WebSocket, chat_id: int) -> None:
+    """
+    Write the messages of the group to an accepted WebSocket until it disconnects, the messages of the listener are
+    ignored
+    """
+    listener = await hub.subscribe(chat_id)
+
+    async def write() -> None:
+        while True:
+            await websocket.send_text(await listener.messages.get())
+
+    writer = asyncio.create_task(write())
+    try:
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        writer.cancel()
+        hub.unsubscribe(listener)
+
+
+async def events(chat_id: int):
+    """
+    The messages of the group as server-sent events, with a comment every live_keepalive seconds so that proxies keep
+    the connection open
+    """
+    listener = await hub.subscribe(chat_id)
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(listener.messages.get(), config.live_keepalive)
+                yield f"data: {message}\n\n"
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+    finally:
+        hub.unsubscribe(listener)
+
+
+hub = None
+
+
+def start() -> None:
+    global hub
+
+    if hub is None:
+        hub = Hub()
+        hub.start()
+
+
+async def stop() -> None:
+    global hub
+
+    if hub is not None:
+        await hub.stop()
+        hub = None
@@ -1,52 +1,211 @@
+import asyncio
 import json
 import logging
+import random
+from time import monotonic
 
 import httpx
 
+from lightning_jukebox_bot.application import metrics
+
+# seconds an operation may take in total, including retries
+TIMEOUTS = {
+    "payInvoice": 30,
+    "createLnurlp": 15,
+}
+DEFAULT_TIMEOUT = 10
+
+# retries of idempotent reads
+RETRIES = 2
+RETRY_BACKOFF = 0.25
+
+# status codes of a proxy in front of an LNbits that is down
+UNAVAILABLE_STATUS = (502, 503, 504)
+
+
+class LNbitsUnavailable(Exception):
+    """
+    Raised when LNbits does not respond in time or while the circuit breaker is open. The message can be shown to users
+    """
+
+    def __init__(self, message: str = "The wallet service is not available right now, please try again in a minute."):
+        super().__init__(message)
+
+
+class CircuitBreaker:
+    """
+    The breaker opens after `threshold` failures in a row. While it is open calls fail immediately. Every
+    `reset_timeout` seconds one call is let through, the breaker closes when that call succeeds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0
+        self._state = self.CLOSED
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN:
+            # other calls keep failing fast until the trial call is done
+            self.opened_at = monotonic()
+            return True
+        return False
+
+    def success(self) -> None:
+        if self._state != self.CLOSED:
+            logging.info("LNbits is available again")
+        self.failures = 0
+        self._state = self.CLOSED
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self._state == self.OPEN or self.failures >= self.threshold:
+            if self._state != self.OPEN:
+                logging.error(f"LNbits failed {self.failures} times in a row, failing fast for {self.reset_timeout}s")
+            self._state = self.OPEN
+            self.opened_at = monotonic()
+
 
 class LNbits:
-    def __init__(self, protocol, host, admin_adminkey, admin_invoicekey, admin_usrkey):
+    def __init__(
+        self,
+        protocol,
+        host,
+        admin_adminkey,
+        admin_invoicekey,
+        admin_usrkey,
+        breaker_threshold=5,
+        breaker_reset_timeout=30,
+        max_connections=20,
+    ):
         self.protocol = protocol
         self.host = host
         self._admin_adminkey = admin_adminkey
         self._admin_invoicekey = admin_invoicekey
         self._admin_usrkey = admin_usrkey
+        self._max_connections = max_connections
+        self._client = None
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_timeout)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # one pool of connections for all calls
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self._max_connections, max_keepalive_connections=self._max_connections
+                )
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def get_stats(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "failures": self.breaker.failures,
+            "operations": metrics.get_dependency_stats("lnbits"),
+        }
+
+    async def _request(self, operation, method, url, **kwargs):
+        """
+        Do a request within the time budget of the operation and return the status code and the decoded json body,
+        the body is None only for 204 No Content. Reads are retried with jitter. Raises LNbitsUnavailable when LNbits
+        does not respond properly, also when the body is missing or not json
+        """
+        if not self.breaker.allow():
+            metrics.dependency_rejected.inc("lnbits", operation)
+            metrics.dependency_errors.inc("lnbits", operation)
+            raise LNbitsUnavailable()
+
+        attempts = 1 + RETRIES if method == "GET" else 1
+        start = monotonic()
+        deadline = start + TIMEOUTS.get(operation, DEFAULT_TIMEOUT)
+
+        for attempt in range(attempts):
+            try:
+                response = await asyncio.wait_for(
+                    self.client.request(method, url, **kwargs), timeout=deadline - monotonic()
+                )
+                if response.status_code in UNAVAILABLE_STATUS:
+                    raise LNbitsUnavailable(f"LNbits returned status {response.status_code}")
+                if response.status_code == 204:
+                    result = None
+                else:
+                    try:
+                        result = response.json()
+                    except ValueError:
+                        raise LNbitsUnavailable(
+                            f"LNbits returned status {response.status_code} with a body that is not json"
+                        )
+
+                self.breaker.success()
+                metrics.observe_dependency("lnbits", operation, monotonic() - start)
+                return response.status_code, result
+            except (httpx.TransportError, asyncio.TimeoutError, LNbitsUnavailable) as e:
+                backoff = random.uniform(0, RETRY_BACKOFF * 2**attempt)
+                if attempt + 1 == attempts or monotonic() + backoff >= deadline:
+                    logging.warning(f"LNbits {operation} failed after {attempt + 1} attempts: {e!r}")
+                    self.breaker.failure()
+                    metrics.observe_dependency("lnbits", operation, monotonic() - start, error=True)
+                    raise LNbitsUnavailable() from e
+
+                metrics.dependency_retries.inc("lnbits", operation)
+                await asyncio.sleep(backoff)
+
+    def _url(self, path):
+        return f"{self.protocol}://{self.host}{path}"
 
     # get balance
     async def getBalance(self, invoicekey):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.protocol}://{self.host}/api/v1/wallet",
-                headers={"X-Api-Key": invoicekey},
-            )
-            result = json.loads(response.text)
-            return int(result["balance"] / 1000)
+        _, result = await self._request(
+            "getBalance", "GET", self._url("/api/v1/wallet"), headers={"X-Api-Key": invoicekey}
+        )
+        return int(result["balance"] / 1000)
 
     # pay an invoice
     async def payInvoice(self, invoice, adminkey):
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.protocol}://{self.host}/api/v1/payments",
-                json={"out": True, "bolt11": invoice},
-                headers={"X-Api-Key": adminkey},
-            )
-            result = json.loads(response.text)
-            if "payment_hash" in result:
-                result["result"] = True
+        _, result = await self._request(
+            "payInvoice",
+            "POST",
+            self._url("/api/v1/payments"),
+            json={"out": True, "bolt11": invoice},
+            headers={"X-Api-Key": adminkey},
+        )
+        if "payment_hash" in result:
+            result["result"] = True
+        else:
+            result["result"] = False
+            detail = result.get("detail") or ""
+            if detail == "Insufficient balance.":
+                pass
+            elif detail.startswith("(sqlite3.IntegrityError) UNIQUE constraint failed"):
+                result["detail"] = "Duplicate invoice, payment failed."
             else:
-                result["result"] = False
-                if result["detail"] == "Insufficient balance.":
-                    pass
-                elif result["detail"].startswith("(sqlite3.IntegrityError) UNIQUE constraint failed"):
-                    result["detail"] = "Duplicate invoice, payment failed."
-                else:
-                    logging.info(result)
-                    result["detail"] = "Payment failed."
+                logging.warning(f"Payment failed: {detail}")
+                result["detail"] = "Payment failed."
 
-            return result
+        return result
 
     # creat an lnbits invoice
-    async def createInvoice(self, invoicekey, amount, memo, extra=None):
+    async def createInvoice(self, invoicekey, amount, memo, extra=None, expiry=None):
         payload = {
             "out": False,
             "amount": amount,
@@ -55,180 +214,191 @@ class LNbits:
         }
         if extra is not None:
             payload["extra"] = extra
+        if expiry is not None:
+            payload["expiry"] = expiry
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.protocol}://{self.host}/api/v1/payments",
-                headers={"X-Api-Key": invoicekey},
-                json=payload,
-            )
-
-            return json.loads(response.text)
+        _, result = await self._request(
+            "createInvoice", "POST", self._url("/api/v1/payments"), headers={"X-Api-Key": invoicekey}, json=payload
+        )
+        return result
 
     # create a user and initial wallet
     async def createUser(self, name):
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.protocol}://{self.host}/usermanager/api/v1/users",
-                headers={"X-Api-Key": self._admin_invoicekey},
-                json={
-                    "admin_id": self._admin_usrkey,
-                    "wallet_name": name,
-                    "user_name": name,
-                },
-            )
-        user = json.loads(response.text)
+        _, user = await self._request(
+            "createUser",
+            "POST",
+            self._url("/usermanager/api/v1/users"),
+            headers={"X-Api-Key": self._admin_invoicekey},
+            json={
+                "admin_id": self._admin_usrkey,
+                "wallet_name": name,
+                "user_name": name,
+            },
+        )
         return user["id"]
 
+    # rename a user and their wallet
+    async def renameUser(self, lnbitsuserid, name):
+        status_code, _ = await self._request(
+            "renameUser",
+            "PUT",
+            self._url(f"/usermanager/api/v1/users/{lnbitsuserid}"),
+            headers={"X-Api-Key": self._admin_adminkey},
+            json={
+                "admin_id": self._admin_usrkey,
+                "wallet_name": name,
+                "user_name": name,
+            },
+        )
+        return status_code == 200
+
     # delete user and their wallets
     async def deleteUser(self, lnbitsuserid):
-        async with httpx.AsyncClient() as client:
-            # TODO: unused
-            await client.delete(
-                f"{self.protocol}://{self.host}/usermanager/api/v1/users/{lnbitsuserid}",
-                headers={"X-Api-Key": self._admin_adminkey},
-            )
+        # TODO: unused
+        await self._request(
+            "deleteUser",
+            "DELETE",
+            self._url(f"/usermanager/api/v1/users/{lnbitsuserid}"),
+            headers={"X-Api-Key": self._admin_adminkey},
+        )
 
     # create a wallet for a user
     async def createWallet(self, lnbitsuserid, name):
-        print("We should not come in the function createWallet")
+        logging.error("We should not come in the function createWallet")
         return None
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.protocol}://{self.host}/usermanager/api/v1/wallets",
-                headers={"X-Api-Key": self._admin_invoicekey},
-                json={
-                    "user_id": lnbitsuserid,
-                    "wallet_name": name,
-                    "admin_id": self._admin_usrkey,
-                },
-            )
-        wallet = json.loads(response.text)
+        _, wallet = await self._request(
+            "createWallet",
+            "POST",
+            self._url("/usermanager/api/v1/wallets"),
+            headers={"X-Api-Key": self._admin_invoicekey},
+            json={
+                "user_id": lnbitsuserid,
+                "wallet_name": name,
+                "admin_id": self._admin_usrkey,
+            },
+        )
         return wallet
 
     # enable extension
     async def enableExtension(self, name, lnbitsuserid):
         # enable extension for user wallet
-        url = (
-            f"{self.protocol}://{self.host}/usermanager/api/v1/extensions"
-            f"?extension={name}"
-            f"&userid={lnbitsuserid}"
-            f"&active=true"
+        status_code, _ = await self._request(
+            "enableExtension",
+            "POST",
+            self._url("/usermanager/api/v1/extensions"),
+            params={"extension": name, "userid": lnbitsuserid, "active": "true"},
+            headers={"X-Api-Key": self._admin_invoicekey},
         )
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url,
-                headers={"X-Api-Key": self._admin_invoicekey},
-            )
-            if response.status_code == 200:
-                return True
-            else:
-                return False
+        return status_code == 200
 
     # creates LNURLP link
     async def createLnurlp(self, adminkey, payload):
-        # delete all previous paylinks, there could be conflicts
-        paylinks = []
-
         # get all paylinks
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.protocol}://{self.host}/lnurlp/api/v1/links",
-                headers={"X-Api-Key": adminkey},
-            )
-            paylinks.extend(response.json())
+        _, paylinks = await self._request(
+            "getLnurlps", "GET", self._url("/lnurlp/api/v1/links"), headers={"X-Api-Key": adminkey}
+        )
 
-        # delete all paylinks
+        # delete all previous paylinks, there could be conflicts
         for paylink in paylinks:
             logging.info(f"Deleting old paylink with id {paylink['id']}")
-            async with httpx.AsyncClient() as client:
-                response = await client.delete(
-                    f"{self.protocol}://{self.host}/lnurlp/api/v1/links/{paylink['id']}",
+        await asyncio.gather(
+            *[
+                self._request(
+                    "deleteLnurlp",
+                    "DELETE",
+                    self._url(f"/lnurlp/api/v1/links/{paylink['id']}"),
                     headers={"X-Api-Key": adminkey},
                 )
+                for paylink in paylinks
+            ]
+        )
 
         # create lnurlp link
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.protocol}://{self.host}/lnurlp/api/v1/links",
+        while True:
+            _, result = await self._request(
+                "createLnurlp",
+                "POST",
+                self._url("/lnurlp/api/v1/links"),
                 json=payload,
                 headers={"X-Api-Key": adminkey},
             )
-            result = response.json()
 
-            if "id" not in result:
-                if result["detail"].startswith("Username already exists."):
-                    logging.warning(f"Username already exists {payload['username']}, retrying without username")
-                    del payload["username"]
-                    return await self.createLnurlp(adminkey, payload)
-                else:
-                    logging.error(
-                        f"Could not create Lnurlpay link for payload '{json.dumps(payload)}' "
-                        f"the response was: '{json.dumps(result)}'"
-                    )
-                    return None
-            else:
+            if "id" in result:
                 return result
 
+            if (result.get("detail") or "").startswith("Username already exists.") and "username" in payload:
+                logging.warning(f"Username already exists {payload['username']}, retrying without username")
+                del payload["username"]
+                continue
+
+            logging.error(
+                f"Could not create Lnurlpay link for payload '{json.dumps(payload)}' "
+                f"the response was: '{json.dumps(result)}'"
+            )
+            return None
+
     # retrieves LNURLP link
     async def getLnurlp(self, baseurl, adminkey, payid):
         """
         Retrieve a Lnurlp link details
         """
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{baseurl}lnurlp/api/v1/links/{payid}", headers={"X-Api-Key": adminkey})
+        status_code, result = await self._request(
+            "getLnurlp", "GET", f"{baseurl}lnurlp/api/v1/links/{payid}", headers={"X-Api-Key": adminkey}
+        )
 
-            if response.status_code == 200:
-                return response.json()
-            else:
-                logging.error(f"LNbits returned and error {response.status_code}")
-                return None
+        if status_code == 200:
+            return result
+        else:
+            logging.error(f"LNbits returned and error {status_code}")
+            return None
 
     # check wether an invoice has been paid. Returns True if paid. Otherwise False
     async def checkInvoice(self, invoicekey, payment_hash):
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    f"{self.protocol}://{self.host}/api/v1/payments/{payment_hash}",
-                    headers={"X-Api-Key": invoicekey},
-                )
+        try:
+            _, jsobj = await self._request(
+                "checkInvoice",
+                "GET",
+                self._url(f"/api/v1/payments/{payment_hash}"),
+                headers={"X-Api-Key": invoicekey},
+            )
+        except LNbitsUnavailable:
+            logging.warning("LNbits is not available, invoice not checked")
+            return False
 
-                jsobj = json.loads(response.text)
-                if jsobj["paid"]:
-                    return True
-            except httpx.ReadTimeout:
-                logging.warning("LNbits read timeout")
-                return False
+        if jsobj["paid"]:
+            return True
         return False
 
     # get all wallets in lnbits
     async def getWallets(self):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.protocol}://{self.host}/usermanager/api/v1/wallets",
-                headers={"X-Api-Key": self._admin_adminkey},
-            )
-            return json.loads(response.text)
+        _, result = await self._request(
+            "getWallets",
+            "GET",
+            self._url("/usermanager/api/v1/wallets"),
+            headers={"X-Api-Key": self._admin_adminkey},
+        )
+        return result
 
     # get all wallets in lnbits
     async def getUsers(self):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.protocol}://{self.host}/usermanager/api/v1/users",
-                headers={"X-Api-Key": self._admin_adminkey},
-            )
-            return json.loads(response.text)
+        _, result = await self._request(
+            "getUsers",
+            "GET",
+            self._url("/usermanager/api/v1/users"),
+            headers={"X-Api-Key": self._admin_adminkey},
+        )
+        return result
 
     # return the wallet for a specific user
     async def getWallet(self, lnbitsuserid):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.protocol}://{self.host}/usermanager/api/v1/wallets/{lnbitsuserid}",
-                headers={"X-Api-Key": self._admin_adminkey},
-            )
-            result = json.loads(response.text)
-            if len(result) > 0:
-                return result[0]
+        _, result = await self._request(
+            "getWallet",
+            "GET",
+            self._url(f"/usermanager/api/v1/wallets/{lnbitsuserid}"),
+            headers={"X-Api-Key": self._admin_adminkey},
+        )
+        if len(result) > 0:
+            return result[0]
 
         return None
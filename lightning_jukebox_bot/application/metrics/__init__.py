@@ -0,0 +1,268 @@
+"""
+Metrics of the bot, exposed in the Prometheus text format on /metrics. Recording a value is a dict lookup and an
+addition, so the instrumentation stays on in production.
+"""
+
+import asyncio
+import functools
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import monotonic, perf_counter
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# seconds between two measurements of the event loop lag
+LOOP_LAG_INTERVAL = 0.5
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A metric family with one value per combination of label values
+    """
+
+    kind = None
+
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = {}
+        registry.append(self)
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, *labels, value: float) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    Values are kept per bucket and made cumulative when rendered
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+
+    def observe(self, *labels, value: float) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            # the counts per bucket, the last one is +Inf, and the sum
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, labels, le), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), total
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), cumulative
+
+
+registry = []
+
+dependency_latency = Histogram(
+    "jukebox_dependency_request_duration_seconds",
+    "Latency of calls to external dependencies",
+    ("dependency", "operation"),
+)
+dependency_errors = Counter(
+    "jukebox_dependency_errors_total",
+    "Failed calls to external dependencies",
+    ("dependency", "operation"),
+)
+dependency_retries = Counter(
+    "jukebox_dependency_retries_total",
+    "Calls to external dependencies that were tried again",
+    ("dependency", "operation"),
+)
+dependency_rejected = Counter(
+    "jukebox_dependency_rejected_total",
+    "Calls to external dependencies that failed fast because the circuit breaker was open",
+    ("dependency", "operation"),
+)
+command_latency = Histogram(
+    "jukebox_command_duration_seconds",
+    "Time to handle a bot command or button",
+    ("command",),
+)
+command_errors = Counter(
+    "jukebox_command_errors_total",
+    "Bot commands and buttons that raised an exception",
+    ("command",),
+)
+http_latency = Histogram(
+    "jukebox_http_request_duration_seconds",
+    "Time to handle a web request",
+    ("method", "route"),
+)
+http_requests = Counter(
+    "jukebox_http_requests_total",
+    "Handled web requests",
+    ("method", "route", "status"),
+)
+pending_invoices = Gauge("jukebox_pending_invoices", "Invoices that are waiting to be paid")
+queue_depth = Gauge("jukebox_queue_depth", "Items waiting in the queues of the bot", ("queue",))
+command_store_size = Gauge("jukebox_command_store_size", "Commands of inline buttons that are kept in memory")
+loop_lag = Gauge("jukebox_event_loop_lag_seconds", "The latest delay of the event loop in running a ready task")
+loop_lag_latency = Histogram(
+    "jukebox_event_loop_lag_duration_seconds",
+    "Delays of the event loop in running a ready task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+loop_lag_task = None
+
+# called with the dependency, the operation, the seconds it took and whether it failed after every call
+dependency_observers = []
+
+
+def observe_dependency(dependency: str, operation: str, seconds: float, error: bool = False) -> None:
+    dependency_latency.observe(dependency, operation, value=seconds)
+    if error:
+        dependency_errors.inc(dependency, operation)
+    for observer in dependency_observers:
+        observer(dependency, operation, seconds, error)
+
+
+def get_dependency_stats(dependency: str) -> dict:
+    """
+    The calls, errors, retries and rejected calls per operation of the dependency with the average latency and the
+    upper bound of the bucket of the 99th percentile, in seconds
+    """
+    operations = {}
+    for (name, operation), (counts, total) in dependency_latency.values.items():
+        if name != dependency:
+            continue
+        calls = sum(counts)
+        cumulative = 0
+        for p99, count in zip(dependency_latency.buckets + (float("inf"),), counts):
+            cumulative += count
+            if cumulative >= calls * 0.99:
+                break
+        operations[operation] = {"calls": calls, "average": total / calls if calls > 0 else 0.0, "p99": p99}
+    for counter, key in (
+        (dependency_errors, "errors"),
+        (dependency_retries, "retries"),
+        (dependency_rejected, "rejected"),
+    ):
+        for (name, operation), value in counter.values.items():
+            if name == dependency:
+                operations.setdefault(operation, {"calls": 0, "average": 0.0, "p99": 0.0})[key] = value
+    for stats in operations.values():
+        for key in ("errors", "retries", "rejected"):
+            stats.setdefault(key, 0)
+    return operations
+
+
+@contextmanager
+def track_dependency(dependency: str, operation: str):
+    """
+    Time the calls in the block, an exception counts as an error
+    """
+    start = perf_counter()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        observe_dependency(dependency, operation, perf_counter() - start, error)
+
+
+def track_command(name: str, callback):
+    """
+    Wrap the callback of a handler to record its latency and errors
+    """
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            command_errors.inc(name)
+            raise
+        finally:
+            command_latency.observe(name, value=perf_counter() - start)
+
+    return wrapper
+
+
+async def _monitor_loop_lag() -> None:
+    while True:
+        start = monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, monotonic() - start - LOOP_LAG_INTERVAL)
+        loop_lag.set(value=lag)
+        loop_lag_latency.observe(value=lag)
+
+
+def start() -> None:
+    global loop_lag_task
+
+    if loop_lag_task is None:
+        loop_lag_task = asyncio.get_running_loop().create_task(_monitor_loop_lag())
+
+
+async def stop() -> None:
+    global loop_lag_task
+
+    if loop_lag_task is not None:
+        loop_lag_task.cancel()
+        try:
+            await loop_lag_task
+        except asyncio.CancelledError:
+            pass
+        loop_lag_task = None
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
@@ -0,0 +1,357 @@
+"""
+The music players of the groups. A player searches tracks, tells what it plays and takes the next track to play, see
+docs/design/player.md. Spotify is the player of a group that coupled a spotify account. The fake player plays a
+generated catalog in memory, so the bot runs, is tested and benchmarked without a spotify account. The local player
+plays the music files of a directory, see local.py. Players that connect over the /player WebSocket play for their
+group instead of the configured player, see remote.py.
+"""
+
+import asyncio
+import json
+import logging
+import zlib
+from time import monotonic
+from typing import Optional, Protocol
+
+import requests
+from spotipy import SpotifyException, SpotifyOauthError
+
+from lightning_jukebox_bot.application import redis, spotify
+from lightning_jukebox_bot.settings import config
+
+from . import local, remote
+
+logger = logging.getLogger(__name__)
+
+SPOTIFY = "spotify"
+FAKE = "fake"
+LOCAL = "local"
+BACKENDS = [SPOTIFY, FAKE, LOCAL]
+
+# tracks per call of the spotify Web API
+SPOTIFY_TRACKS_BATCH = 50
+SPOTIFY_PLAYLIST_PAGE = 100
+
+
+class PlayerUnavailable(Exception):
+    """
+    Raised when the player does not answer or refuses a call. The message can be shown to users
+    """
+
+    def __init__(self, message: str = "Music player unavailable, please try again later."):
+        super().__init__(message)
+
+
+class Track:
+    def __init__(self, uri: str, title: str, duration: float):
+        self.uri = uri
+        self.title = title
+        self.duration = duration
+
+
+class NowPlaying:
+    """
+    The track that plays and the seconds it has left. The track is None when the player is active but plays nothing
+    """
+
+    def __init__(self, track: Optional[Track], remaining: float):
+        self.track = track
+        self.remaining = remaining
+
+
+class Player(Protocol):
+    # the part of the uris of the tracks before the id, the web jukebox only passes the id
+    uri_prefix: str
+
+    async def search(self, query: str, limit: int = 10) -> list[Track]:
+        """
+        The tracks that match the query, the best match first
+        """
+
+    async def track(self, uri: str) -> Optional[Track]:
+        """
+        The track of a uri, or None when the player does not know it
+        """
+
+    async def tracks(self, uris: list) -> list[Track]:
+        """
+        The tracks of a list of uris in one go, None for the uris the player does not know
+        """
+
+    async def now_playing(self) -> Optional[NowPlaying]:
+        """
+        What the player plays, or None when the player is not active
+        """
+
+    async def queue(self) -> list[Track]:
+        """
+        The tracks the player plays next
+        """
+
+    async def enqueue(self, uri: str) -> None:
+        """
+        Play a track after the current track
+        """
+
+    async def playlist(self, reference: str) -> tuple:
+        """
+        The name and the tracks of a playlist, up to playlist_cache_size tracks
+        """
+
+
+class SpotifyPlayer:
+    """
+    The spotify player of a group. Spotipy blocks, its calls run in a thread and its errors are raised as
+    PlayerUnavailable
+    """
+
+    uri_prefix = "spotify:track:"
+
+    def __init__(self, sp):
+        self.sp = sp
+
+    async def _call(self, func, *args, **kwargs):
+        try:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        except (SpotifyException, SpotifyOauthError, requests.RequestException) as e:
+            logger.warning(f"Spotify call {func.__name__} failed: {e}")
+            raise PlayerUnavailable() from e
+
+    @staticmethod
+    def _track(item: dict) -> Optional[Track]:
+        if item is None:
+            return None
+        return Track(item["uri"], spotify.helper.get_track_title(item), item["duration_ms"] / 1000)
+
+    async def search(self, query: str, limit: int = 10) -> list[Track]:
+        result = await self._call(self.sp.search, query, limit=limit)
+        return [self._track(item) for item in result["tracks"]["items"]]
+
+    async def track(self, uri: str) -> Optional[Track]:
+        return self._track(await self._call(self.sp.track, uri))
+
+    async def tracks(self, uris: list) -> list[Track]:
+        def read() -> list:
+            items = []
+            for i in range(0, len(uris), SPOTIFY_TRACKS_BATCH):
+                items += self.sp.tracks(uris[i : i + SPOTIFY_TRACKS_BATCH])["tracks"]
+            return items
+
+        return [self._track(item) for item in await self._call(read)]
+
+    async def now_playing(self) -> Optional[NowPlaying]:
+        result = await self._call(self.sp.current_user_playing_track)
+        if result is None:
+            return None
+        track = self._track(result.get("item"))
+        if track is None:
+            return NowPlaying(None, 0)
+        return NowPlaying(track, track.duration - (result.get("progress_ms") or 0) / 1000)
+
+    async def queue(self) -> list[Track]:
+        result = await self._call(self.sp.queue)
+        return [self._track(item) for item in result["queue"]]
+
+    async def enqueue(self, uri: str) -> None:
+        await self._call(self.sp.add_to_queue, uri)
+
+    async def playlist(self, reference: str) -> tuple:
+        def read() -> tuple:
+            name = self.sp.playlist(reference, fields="name")["name"]
+            fields = "items(track(uri,name,duration_ms,artists(name))),total"
+            items = []
+            offset = 0
+            total = 1
+            while offset < min(total, config.playlist_cache_size):
+                result = self.sp.playlist_items(reference, fields=fields, limit=SPOTIFY_PLAYLIST_PAGE, offset=offset)
+                total = result["total"]
+                offset += SPOTIFY_PLAYLIST_PAGE
+                items += [item["track"] for item in result["items"]]
+            return name, items
+
+        [name, items] = await self._call(read)
+        # local files and episodes can not be queued
+        tracks = [
+            self._track(item)
+            for item in items
+            if item is not None and item["uri"] is not None and item["uri"].startswith("spotify:track:")
+        ]
+        return name, tracks
+
+
+class FakePlayer:
+    """
+    A player that plays a generated catalog in memory, every call takes `latency` seconds. The uris look like spotify
+    uris, so the web jukebox works with the fake. When the queue is empty the catalog plays in order. What plays
+    follows from the clock, so a fake with a fake clock is deterministic
+    """
+
+    uri_prefix = "spotify:track:"
+
+    def __init__(self, catalog_size: int = 1000, latency: float = 0, clock=monotonic):
+        self.latency = latency
+        self.clock = clock
+        self.catalog = [
+            Track(f"spotify:track:FakeTrack{number:012d}", f"Artist {number % 97} - Track {number}", 180 + number % 60)
+            for number in range(catalog_size)
+        ]
+        self.tracks_by_uri = {track.uri: track for track in self.catalog}
+        self.upcoming = []
+        self.position = 0
+        self.current = self.catalog[0]
+        self.started = clock()
+
+    async def _call(self) -> None:
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def _advance(self) -> Track:
+        """
+        The track that plays now, after the tracks that ended since the last call
+        """
+        now = self.clock()
+        while now - self.started >= self.current.duration:
+            self.started += self.current.duration
+            if len(self.upcoming) > 0:
+                self.current = self.upcoming.pop(0)
+            else:
+                self.position = (self.position + 1) % len(self.catalog)
+                self.current = self.catalog[self.position]
+        return self.current
+
+    async def search(self, query: str, limit: int = 10) -> list[Track]:
+        await self._call()
+        words = query.lower().split()
+        result = [track for track in self.catalog if all(word in track.title.lower() for word in words)]
+        return result[:limit]
+
+    async def track(self, uri: str) -> Optional[Track]:
+        await self._call()
+        return self.tracks_by_uri.get(uri)
+
+    async def tracks(self, uris: list) -> list[Track]:
+        await self._call()
+        return [self.tracks_by_uri.get(uri) for uri in uris]
+
+    async def now_playing(self) -> Optional[NowPlaying]:
+        await self._call()
+        current = self._advance()
+        return NowPlaying(current, current.duration - (self.clock() - self.started))
+
+    async def queue(self) -> list[Track]:
+        await self._call()
+        self._advance()
+        return list(self.upcoming)
+
+    async def enqueue(self, uri: str) -> None:
+        await self._call()
+        if uri not in self.tracks_by_uri:
+            raise PlayerUnavailable(f"Unknown track {uri}")
+        self._advance()
+        self.upcoming.append(self.tracks_by_uri[uri])
+
+    async def playlist(self, reference: str) -> tuple:
+        await self._call()
+        start = zlib.crc32(reference.encode("utf-8")) % len(self.catalog)
+        count = min(50, len(self.catalog), config.playlist_cache_size)
+        tracks = [self.catalog[(start + i) % len(self.catalog)] for i in range(count)]
+        return f"Playlist {reference}", tracks
+
+
+# the fake players by group, they keep their queue between calls
+fakes = {}
+
+# the local player plays for all groups
+library_player = None
+
+
+def start() -> None:
+    """
+    Start the heartbeat of the remote players, and indexing the music directory when the groups play on the local
+    player
+    """
+    global library_player
+
+    remote.controller.start()
+    if config.player != LOCAL or library_player is not None:
+        return
+    if config.local_library_path is None:
+        logger.error("The local player needs a local_library_path")
+        return
+    library = local.Library(config.local_library_path, config.local_library_db)
+    library.start(config.local_library_rescan)
+    library_player = local.LocalPlayer(library, config.local_player_command)
+    logger.info(f"Playing the music library in {config.local_library_path}")
+
+
+def stop() -> None:
+    global library_player
+
+    remote.controller.stop()
+    if library_player is not None:
+        library_player.library.stop()
+        library_player = None
+
+
+async def get_player(chat_id) -> Optional[Player]:
+    """
+    Get the player of a group, or None when the group has no player
+    """
+    jukebox = remote.controller.get(chat_id)
+    if jukebox is not None and len(jukebox.connections) > 0:
+        return remote.RemotePlayer(jukebox)
+
+    if config.player == LOCAL:
+        return library_player
+
+    if config.player == FAKE:
+        chat_id = int(chat_id)
+        if chat_id not in fakes:
+            fakes[chat_id] = FakePlayer(config.fake_player_catalog, config.fake_player_latency)
+        return fakes[chat_id]
+
+    auth_manager = await spotify.helper.get_auth_manager(chat_id)
+    if auth_manager is None:
+        return None
+    return SpotifyPlayer(spotify.helper.create_client(auth_manager))
+
+
+def _playlistkey(reference: str) -> str:
+    return f"playlist:{reference}"
+
+
+async def get_playlist(player: Player, reference: str) -> tuple:
+    """
+    Get the name of a playlist and its number of tracks. The tracks are cached for playlist_cache_ttl seconds, the
+    player is only asked when the playlist is not cached
+    """
+    key = _playlistkey(reference)
+    pipe = redis.cache.pipeline()
+    pipe.get(f"{key}:name")
+    pipe.scard(key)
+    [name, count] = pipe.execute()
+    if name is not None and count > 0:
+        return name.decode("utf-8"), count
+
+    [name, tracks] = await player.playlist(reference)
+    if len(tracks) == 0:
+        return name, 0
+
+    pipe = redis.cache.pipeline()
+    pipe.delete(key)
+    pipe.sadd(key, *[json.dumps([track.uri, track.title, track.duration], separators=(",", ":")) for track in tracks])
+    pipe.expire(key, config.playlist_cache_ttl)
+    pipe.set(f"{key}:name", name, ex=config.playlist_cache_ttl)
+    pipe.execute()
+    return name, len(tracks)
+
+
+async def sample_playlist(player: Player, reference: str, count: int) -> list[Track]:
+    """
+    Get up to count distinct random tracks of a playlist. Sampling a cached playlist takes no calls to the player
+    """
+    sample = redis.cache.srandmember(_playlistkey(reference), count)
+    if len(sample) == 0:
+        await get_playlist(player, reference)
+        sample = redis.cache.srandmember(_playlistkey(reference), count)
+    return [Track(*json.loads(track)) for track in sample]
@@ -0,0 +1,337 @@
+"""
+The local library player plays the music files in a directory. The tags of the files are indexed into a SQLite full
+text index by a background thread, so searches take no calls to an external service. Rescans only read the tags of
+files whose modification time changed.
+
+Playing is left to a local command, like `mpc add {path}` for MPD, that is run for every track handed to the player.
+Without a command the player only keeps the time, a stand-in for a real player. Like the players of the design the
+local player is dumb: it plays the tracks it was handed in order and stops when they ran out.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import shlex
+import sqlite3
+import threading
+from time import monotonic
+from typing import Optional
+
+from lightning_jukebox_bot.application import players
+from lightning_jukebox_bot.settings import config
+
+try:
+    import mutagen
+except ImportError:
+    # the artist and title are taken from the file name, as in "Artist - Title.mp3"
+    mutagen = None
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {".aac", ".flac", ".m4a", ".mp3", ".ogg", ".opus", ".wav", ".wma"}
+
+URI_PREFIX = "local:track:"
+
+# seconds a track plays when the length is not known
+DEFAULT_DURATION = 180
+
+# files that are written to the index per transaction
+BATCH_SIZE = 1000
+
+# matches of a search that are ranked
+RANKED_MATCHES = 500
+
+# the search table is kept in sync with the files table by the triggers
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE,
+        mtime REAL NOT NULL,
+        artist TEXT NOT NULL,
+        title TEXT NOT NULL,
+        album TEXT NOT NULL,
+        duration REAL NOT NULL
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+        artist, title, album, content='files', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS files_insert AFTER INSERT ON files BEGIN
+        INSERT INTO search(rowid, artist, title, album) VALUES (new.id, new.artist, new.title, new.album);
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_delete AFTER DELETE ON files BEGIN
+        INSERT INTO search(search, rowid, artist, title, album)
+        VALUES ('delete', old.id, old.artist, old.title, old.album);
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_update AFTER UPDATE ON files BEGIN
+        INSERT INTO search(search, rowid, artist, title, album)
+        VALUES ('delete', old.id, old.artist, old.title, old.album);
+        INSERT INTO search(rowid, artist, title, album) VALUES (new.id, new.artist, new.title, new.album);
+    END;
+"""
+
+UPSERT = """
+    INSERT INTO files(path, mtime, artist, title, album, duration) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(path) DO UPDATE SET
+        mtime = excluded.mtime,
+        artist = excluded.artist,
+        title = excluded.title,
+        album = excluded.album,
+        duration = excluded.duration
+"""
+
+COLUMNS = "files.id, files.path, files.artist, files.title, files.album, files.duration"
+
+
+def read_tags(path: str) -> tuple:
+    """
+    The artist, title, album and length of a music file. Without tags the name of the file and its directory are used
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    [artist, _, title] = name.rpartition(" - ")
+    album = os.path.basename(os.path.dirname(path))
+    duration = DEFAULT_DURATION
+
+    if mutagen is not None:
+        try:
+            audio = mutagen.File(path, easy=True)
+        except (mutagen.MutagenError, OSError):
+            audio = None
+        if audio is not None:
+            tags = audio.tags or {}
+            artist = tags.get("artist", [artist])[0]
+            title = tags.get("title", [title])[0]
+            album = tags.get("album", [album])[0]
+            if audio.info is not None and audio.info.length:
+                duration = audio.info.length
+
+    return artist or "Unknown artist", title or name, album, duration
+
+
+def match_expression(query: str) -> Optional[str]:
+    """
+    A full text query that matches every word of the query, the last word as a prefix since it may not be complete.
+    None when the query has no words
+    """
+    words = re.findall(r"\w+", query)
+    if len(words) == 0:
+        return None
+    return " ".join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+
+
+class Library:
+    """
+    The index of the music files in a directory. Every thread gets its own connection, the database is in WAL mode
+    so searches are not blocked by a rescan
+    """
+
+    def __init__(self, root: str, database: str):
+        self.root = root
+        self.database = database
+        self._local = threading.local()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _walk(self):
+        """
+        The paths and modification times of the music files under the root
+        """
+        directories = [self.root]
+        while len(directories) > 0:
+            try:
+                entries = list(os.scandir(directories.pop()))
+            except OSError as e:
+                logger.warning(f"Could not read {e.filename}: {e.strerror}")
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in EXTENSIONS:
+                    yield entry.path, entry.stat().st_mtime
+
+    def scan(self) -> dict:
+        """
+        Bring the index up to date with the directory. Returns the number of files that were added or changed, that
+        were removed and that were unchanged
+        """
+        connection = self._connection()
+        known = dict(connection.execute("SELECT path, mtime FROM files"))
+        seen = set()
+        changed = []
+        counts = {"changed": 0, "removed": 0, "unchanged": 0}
+
+        def write() -> None:
+            connection.executemany(UPSERT, [(path, mtime, *read_tags(path)) for path, mtime in changed])
+            connection.commit()
+            counts["changed"] += len(changed)
+            changed.clear()
+
+        for path, mtime in self._walk():
+            if self._stopped.is_set():
+                return counts
+            seen.add(path)
+            if known.get(path) == mtime:
+                counts["unchanged"] += 1
+                continue
+            changed.append((path, mtime))
+            if len(changed) == BATCH_SIZE:
+                write()
+        write()
+
+        removed = [(path,) for path in known if path not in seen]
+        for i in range(0, len(removed), BATCH_SIZE):
+            connection.executemany("DELETE FROM files WHERE path = ?", removed[i : i + BATCH_SIZE])
+            connection.commit()
+        counts["removed"] = len(removed)
+        return counts
+
+    def search(self, query: str, limit: int = 10) -> list:
+        expression = match_expression(query)
+        if expression is None:
+            return []
+        # ranking every match of a short word takes long, only the first matches are ranked
+        return (
+            self._connection()
+            .execute(
+                f"SELECT {COLUMNS} FROM (SELECT rowid, bm25(search) AS score FROM search WHERE search MATCH ? LIMIT ?) "
+                "AS matches JOIN files ON files.id = matches.rowid ORDER BY matches.score LIMIT ?",
+                (expression, RANKED_MATCHES, limit),
+            )
+            .fetchall()
+        )
+
+    def get(self, ids: list) -> dict:
+        """
+        The files of a list of ids by id
+        """
+        if len(ids) == 0:
+            return {}
+        rows = (
+            self._connection()
+            .execute(f"SELECT {COLUMNS} FROM files WHERE id IN ({','.join('?' * len(ids))})", ids)
+            .fetchall()
+        )
+        return {row[0]: row for row in rows}
+
+    def album(self, name: str, limit: int) -> list:
+        return (
+            self._connection()
+            .execute(f"SELECT {COLUMNS} FROM files WHERE album = ? ORDER BY path LIMIT ?", (name, limit))
+            .fetchall()
+        )
+
+    def _rescan(self, interval: float) -> None:
+        while not self._stopped.is_set():
+            try:
+                counts = self.scan()
+                logger.info(f"Scanned the music library {self.root}: {counts}")
+            except Exception:
+                logger.exception(f"Scanning the music library {self.root} failed")
+            self._stopped.wait(interval)
+        if getattr(self._local, "connection", None) is not None:
+            self._local.connection.close()
+
+    def start(self, interval: float) -> None:
+        """
+        Scan the directory now and every interval seconds in a background thread
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._rescan, args=(interval,), name="library-index", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class LocalPlayer:
+    """
+    Plays the tracks of the library that it was handed, in order. Searches run on the event loop, they take a
+    fraction of a millisecond
+    """
+
+    uri_prefix = URI_PREFIX
+
+    def __init__(self, library: Library, command: Optional[str] = None, clock=monotonic):
+        self.library = library
+        self.command = shlex.split(command) if command else None
+        self.clock = clock
+        self.upcoming = []
+        self.current = None
+        self.started = 0
+
+    @staticmethod
+    def _track(row: tuple) -> "players.Track":
+        [track_id, _, artist, title, _, duration] = row
+        return players.Track(f"{URI_PREFIX}{track_id}", f"{artist} - {title}", duration)
+
+    @staticmethod
+    def _id(uri: str) -> Optional[int]:
+        if not uri.startswith(URI_PREFIX) or not uri[len(URI_PREFIX) :].isdigit():
+            return None
+        return int(uri[len(URI_PREFIX) :])
+
+    def _advance(self) -> None:
+        now = self.clock()
+        while self.current is not None and now - self.started >= self.current.duration:
+            self.started += self.current.duration
+            self.current = self.upcoming.pop(0) if len(self.upcoming) > 0 else None
+
+    async def search(self, query: str, limit: int = 10) -> list:
+        return [self._track(row) for row in self.library.search(query, limit)]
+
+    async def track(self, uri: str) -> Optional["players.Track"]:
+        return (await self.tracks([uri]))[0]
+
+    async def tracks(self, uris: list) -> list:
+        ids = [self._id(uri) for uri in uris]
+        rows = self.library.get([track_id for track_id in ids if track_id is not None])
+        return [self._track(rows[track_id]) if track_id in rows else None for track_id in ids]
+
+    async def now_playing(self) -> "players.NowPlaying":
+        self._advance()
+        if self.current is None:
+            return players.NowPlaying(None, 0)
+        return players.NowPlaying(self.current, self.current.duration - (self.clock() - self.started))
+
+    async def queue(self) -> list:
+        self._advance()
+        return list(self.upcoming)
+
+    async def enqueue(self, uri: str) -> None:
+        track_id = self._id(uri)
+        rows = self.library.get([track_id] if track_id is not None else [])
+        if track_id not in rows:
+            raise players.PlayerUnavailable(f"Unknown track {uri}")
+
+        if self.command is not None:
+            path = rows[track_id][1]
+            process = await asyncio.create_subprocess_exec(*[arg.replace("{path}", path) for arg in self.command])
+            if await process.wait() != 0:
+                raise players.PlayerUnavailable(f"The player could not queue {uri}")
+
+        self._advance()
+        track = self._track(rows[track_id])
+        if self.current is None:
+            self.current = track
+            self.started = self.clock()
+        else:
+            self.upcoming.append(track)
+
+    async def playlist(self, reference: str) -> tuple:
+        """
+        The albums of the library are its playlists
+        """
+        return reference, [self._track(row) for row in self.library.album(reference, config.playlist_cache_size)]
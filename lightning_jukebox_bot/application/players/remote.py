@@ -0,0 +1,420 @@
+"""
+Remote players connect to the bot over the /player/{jukebox id} WebSocket, see docs/design/player.md. The jukebox id
+is a token per group, so a player only learns the group it plays for. A group with a connected remote player plays
+on it instead of on the configured player.
+
+Remote players push what they play in nowplaying messages, the bot keeps the last state of every connection and acts
+on a change right away instead of polling. Searches go to every player of the group and wait for all answers or
+player_search_timeout seconds.
+
+Every connection has a bounded queue of outgoing messages that one task writes, so a slow player never blocks the
+bot, a player that falls player_send_queue messages behind is dropped. One task pings all connections every
+player_heartbeat seconds and drops the players that were silent for two pings.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import secrets
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from lightning_jukebox_bot.application import players, redis
+from lightning_jukebox_bot.settings import config
+
+logger = logging.getLogger(__name__)
+
+URI_PREFIX = "remote:track:"
+
+# titles of the tracks found by searches that are remembered per group, to add them later
+KNOWN_TRACKS = 10000
+
+# close codes, players reconnect after a going away but not after a policy violation
+GOING_AWAY = 1001
+POLICY_VIOLATION = 1008
+TRY_AGAIN_LATER = 1013
+
+
+def _text(value) -> Optional[str]:
+    """
+    A text field of a message of a player, raises TypeError when the field is not a string
+    """
+    if value is not None and not isinstance(value, str):
+        raise TypeError(f"Expected a string, got {type(value).__name__}")
+    return value
+
+
+def _tokenkey(token: str) -> str:
+    return f"playertoken:{token}"
+
+
+def create_token(chat_id: int) -> str:
+    """
+    Create the jukebox id that players of the group connect with, the previous id of the group stops working
+    """
+    token = secrets.token_urlsafe(24)
+    previous = redis.cache.hget(f"group:{chat_id}", "player_token")
+    pipe = redis.cache.pipeline()
+    if previous is not None:
+        pipe.delete(_tokenkey(previous.decode("utf-8")))
+    pipe.set(_tokenkey(token), chat_id)
+    pipe.hset(f"group:{chat_id}", "player_token", token)
+    pipe.execute()
+    return token
+
+
+def get_chat_id(token: str) -> Optional[int]:
+    chat_id = redis.cache.get(_tokenkey(token))
+    if chat_id is None:
+        return None
+    return int(chat_id)
+
+
+def uri(reference: str) -> str:
+    """
+    The uri of a track of a remote player, the reference of the player in hex so it is a valid id of the web jukebox
+    """
+    return URI_PREFIX + reference.encode("utf-8").hex()
+
+
+def reference(uri: str) -> Optional[str]:
+    try:
+        return bytes.fromhex(uri[len(URI_PREFIX) :]).decode("utf-8") if uri.startswith(URI_PREFIX) else None
+    except ValueError:
+        return None
+
+
+class Connection:
+    """
+    A connected player, with the queue of messages that are written to it and the last state it pushed
+    """
+
+    ids = itertools.count(1)
+
+    def __init__(self, websocket: WebSocket, chat_id: int):
+        self.id = next(Connection.ids)
+        self.websocket = websocket
+        self.chat_id = chat_id
+        self.outbox = asyncio.Queue(maxsize=config.player_send_queue)
+        self.seen = monotonic()
+        self.closed = False
+
+        # the last nowplaying message and when it arrived
+        self.title = None
+        self.reference = None
+        self.remaining = 0
+        self.updated = 0
+        self.next = None
+
+    def remaining_now(self) -> float:
+        return self.remaining - (monotonic() - self.updated)
+
+    def playing(self) -> bool:
+        return self.title is not None and self.remaining_now() > 0
+
+    def send(self, message: dict) -> bool:
+        """
+        Queue a message for the player. A player that fell too far behind is closed, returns whether it was queued
+        """
+        if self.closed:
+            return False
+        try:
+            self.outbox.put_nowait(json.dumps(message, separators=(",", ":")))
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"Dropping player {self.id} of chat {self.chat_id}, it is {self.outbox.qsize()} behind")
+            self.close(TRY_AGAIN_LATER)
+            return False
+
+    def close(self, code: int) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        # a sentinel stops the writer, the queue may be full
+        while not self.outbox.empty():
+            self.outbox.get_nowait()
+        self.outbox.put_nowait(code)
+
+    async def write(self) -> None:
+        while True:
+            message = await self.outbox.get()
+            if isinstance(message, int):
+                try:
+                    await self.websocket.close(code=message)
+                except Exception:
+                    pass
+                return
+            try:
+                await self.websocket.send_text(message)
+            except Exception:
+                self.closed = True
+                return
+
+
+class Search:
+    """
+    A search that waits for the answers of the players it was sent to
+    """
+
+    def __init__(self, connections: list):
+        self.waiting = {connection.id for connection in connections}
+        self.results = []
+        self.done = asyncio.Event()
+
+    def answer(self, connection: Connection, results: list) -> None:
+        if connection.id not in self.waiting:
+            return
+        self.waiting.discard(connection.id)
+        self.results += [(connection.id, result) for result in results]
+        if len(self.waiting) == 0:
+            self.done.set()
+
+
+class Jukebox:
+    """
+    The players of a group, the searches waiting for them and the tracks they found
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.connections = {}
+        self.searches = {}
+        self.tracks = OrderedDict()
+        # a change that arrives while the listeners run is handled once they are done
+        self.notifying = False
+        self.changed = False
+
+    def remember(self, track_uri: str, title: str, connection_id: int) -> None:
+        self.tracks[track_uri] = (title, connection_id)
+        self.tracks.move_to_end(track_uri)
+        if len(self.tracks) > KNOWN_TRACKS:
+            self.tracks.popitem(last=False)
+
+
+class Controller:
+    """
+    The jukeboxes of the groups with connected players, by chat id
+    """
+
+    def __init__(self):
+        self.jukeboxes = {}
+        # called with the chat id and the player of a group when a player of the group pushed a new state
+        self.listeners = []
+        self._heartbeat = None
+        self._notifiers = set()
+
+    def connections(self) -> int:
+        return sum(len(jukebox.connections) for jukebox in self.jukeboxes.values())
+
+    def get(self, chat_id) -> Optional[Jukebox]:
+        return self.jukeboxes.get(int(chat_id))
+
+    async def serve(self, websocket: WebSocket, chat_id: int) -> None:
+        """
+        Serve an accepted WebSocket of a player of the group until it disconnects
+        """
+        connection = Connection(websocket, chat_id)
+        jukebox = self.jukeboxes.setdefault(chat_id, Jukebox(chat_id))
+        jukebox.connections[connection.id] = connection
+        writer = asyncio.create_task(connection.write())
+        logger.info(f"Player {connection.id} connected to chat {chat_id}")
+        try:
+            while not connection.closed:
+                text = await websocket.receive_text()
+                connection.seen = monotonic()
+                self._handle(jukebox, connection, text)
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            connection.close(GOING_AWAY)
+            await writer
+            del jukebox.connections[connection.id]
+            for search in jukebox.searches.values():
+                search.answer(connection, [])
+            if len(jukebox.connections) == 0 and self.jukeboxes.get(chat_id) is jukebox:
+                del self.jukeboxes[chat_id]
+            logger.info(f"Player {connection.id} disconnected from chat {chat_id}")
+            self._changed(jukebox)
+
+    def _handle(self, jukebox: Jukebox, connection: Connection, text: str) -> None:
+        try:
+            message = json.loads(text)
+            topic = message["topic"]
+            if topic == "nowplaying":
+                remaining = float(message.get("remaining") or 0)
+                title = _text(message.get("title"))
+                reference = _text(message.get("reference"))
+                upcoming = message.get("next")
+                if upcoming is not None:
+                    _text(upcoming["title"])
+                    _text(upcoming.get("reference"))
+        except (ValueError, TypeError, KeyError):
+            connection.send({"topic": "status", "statuscode": 400, "message": f"Not a valid message: {text[:100]}"})
+            return
+
+        if topic == "nowplaying":
+            connection.title = title or None
+            connection.reference = reference
+            connection.remaining = remaining
+            connection.updated = monotonic()
+            connection.next = upcoming
+            if connection.reference is not None and connection.title is not None:
+                jukebox.remember(uri(connection.reference), connection.title, connection.id)
+            self._changed(jukebox)
+        elif topic == "searchresponse":
+            search = jukebox.searches.get(message.get("reference"))
+            results = message.get("results")
+            if search is not None:
+                search.answer(connection, results if isinstance(results, list) else [])
+        elif topic not in ["pong", "status"]:
+            connection.send({"topic": "status", "statuscode": 404, "message": f"Unknown topic {topic}"})
+
+    def _changed(self, jukebox: Jukebox) -> None:
+        if len(self.listeners) == 0:
+            return
+        if jukebox.notifying:
+            jukebox.changed = True
+            return
+        jukebox.notifying = True
+        task = asyncio.create_task(self._notify(jukebox))
+        self._notifiers.add(task)
+        task.add_done_callback(self._notifiers.discard)
+
+    async def _notify(self, jukebox: Jukebox) -> None:
+        try:
+            jukebox.changed = True
+            while jukebox.changed:
+                jukebox.changed = False
+                player = RemotePlayer(jukebox)
+                for listener in self.listeners:
+                    try:
+                        await listener(str(jukebox.chat_id), player)
+                    except Exception:
+                        logger.exception(f"Handling the state of the players of chat {jukebox.chat_id} failed")
+        finally:
+            jukebox.notifying = False
+
+    async def search(self, jukebox: Jukebox, query: str) -> list:
+        """
+        Send the query to every player of the group, returns (connection id, result) tuples of the players that
+        answered within player_search_timeout seconds
+        """
+        connections = list(jukebox.connections.values())
+        search_reference = secrets.token_hex(8)
+        search = Search(connections)
+        jukebox.searches[search_reference] = search
+        try:
+            for connection in connections:
+                if not connection.send({"topic": "search", "query": query, "reference": search_reference}):
+                    search.answer(connection, [])
+            if len(search.waiting) > 0:
+                await asyncio.wait_for(search.done.wait(), timeout=config.player_search_timeout)
+        except asyncio.TimeoutError:
+            logger.info(f"{len(search.waiting)} players of chat {jukebox.chat_id} did not answer a search")
+        finally:
+            del jukebox.searches[search_reference]
+        return search.results
+
+    async def _beat(self) -> None:
+        while True:
+            await asyncio.sleep(config.player_heartbeat)
+            silent = monotonic() - 2 * config.player_heartbeat
+            for jukebox in list(self.jukeboxes.values()):
+                for connection in list(jukebox.connections.values()):
+                    if connection.seen < silent:
+                        logger.info(f"Dropping player {connection.id} of chat {jukebox.chat_id}, it went silent")
+                        connection.close(GOING_AWAY)
+                    else:
+                        connection.send({"topic": "ping"})
+
+    def start(self) -> None:
+        if self._heartbeat is None:
+            self._heartbeat = asyncio.create_task(self._beat())
+
+    def stop(self) -> None:
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        for task in list(self._notifiers):
+            task.cancel()
+        for jukebox in list(self.jukeboxes.values()):
+            for connection in list(jukebox.connections.values()):
+                connection.close(GOING_AWAY)
+
+
+class RemotePlayer:
+    """
+    The connected players of a group as one player. It plays what the player that plays longest plays, and hands the
+    next track to the player that found it
+    """
+
+    uri_prefix = URI_PREFIX
+
+    def __init__(self, jukebox: Jukebox):
+        self.jukebox = jukebox
+
+    def _connections(self) -> list:
+        connections = [connection for connection in self.jukebox.connections.values() if not connection.closed]
+        if len(connections) == 0:
+            raise players.PlayerUnavailable()
+        return connections
+
+    async def search(self, query: str, limit: int = 10) -> list:
+        self._connections()
+        tracks = []
+        for connection_id, result in await controller.search(self.jukebox, query):
+            if not isinstance(result, dict) or "title" not in result or "reference" not in result:
+                continue
+            track = players.Track(uri(str(result["reference"])), str(result["title"]), result.get("duration", 0))
+            self.jukebox.remember(track.uri, track.title, connection_id)
+            tracks.append(track)
+        return tracks[:limit]
+
+    async def track(self, uri: str) -> Optional["players.Track"]:
+        return (await self.tracks([uri]))[0]
+
+    async def tracks(self, uris: list) -> list:
+        known = [self.jukebox.tracks.get(track_uri) for track_uri in uris]
+        return [players.Track(uris[i], known[i][0], 0) if known[i] else None for i in range(len(uris))]
+
+    async def now_playing(self) -> "players.NowPlaying":
+        playing = [connection for connection in self._connections() if connection.playing()]
+        if len(playing) == 0:
+            return players.NowPlaying(None, 0)
+        connection = max(playing, key=Connection.remaining_now)
+        track_uri = uri(connection.reference) if connection.reference is not None else URI_PREFIX
+        return players.NowPlaying(players.Track(track_uri, connection.title, 0), connection.remaining_now())
+
+    async def queue(self) -> list:
+        tracks = []
+        for connection in self._connections():
+            if isinstance(connection.next, dict) and "title" in connection.next:
+                tracks.append(
+                    players.Track(uri(str(connection.next.get("reference", ""))), connection.next["title"], 0)
+                )
+        return tracks
+
+    async def enqueue(self, uri: str) -> None:
+        track_reference = reference(uri)
+        if track_reference is None:
+            raise players.PlayerUnavailable(f"Unknown track {uri}")
+
+        connections = self._connections()
+        known = self.jukebox.tracks.get(uri)
+        owner = self.jukebox.connections.get(known[1]) if known is not None else None
+        playing = [connection for connection in connections if connection.playing()]
+        target = owner or (playing[0] if len(playing) > 0 else connections[0])
+
+        message = {"topic": "play", "reference": track_reference}
+        if not target.playing() and len(playing) > 0:
+            # an idle player waits for the track of the other player to end, the delay is in milliseconds
+            message["delay"] = int(max(connection.remaining_now() for connection in playing) * 1000)
+        if not target.send(message):
+            raise players.PlayerUnavailable()
+
+
+controller = Controller()
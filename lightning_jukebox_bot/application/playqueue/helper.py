@@ -0,0 +1,264 @@
+"""
+The queue of requested tracks of a group is kept by the bot. Tracks are ordered by their bid and then by the order in
+which they were requested, the score of a track in the sorted set is its sequence number minus its bid times
+BID_WEIGHT. Raising a bid is a single ZADD with INCR.
+
+The player gets one track at a time: the now playing poller hands the head of the queue to the player queue_handoff
+seconds before the current track ends, once per play. The plays are counted by the poller, a track that starts again
+is a new play even when it is the same track. Every change of the queue is published to the live feed of the
+group.
+
+Tracks that were requested or played within duplicate_window seconds are duplicates, a group rejects them, warns
+about them or charges a premium for them. The sorted set of requested tracks holds the time a track was queued, a
+track on an open invoice holds it for invoice_expiry seconds.
+"""
+
+import json
+import logging
+from time import time
+
+from lightning_jukebox_bot.application import leaderboard, live, redis
+from lightning_jukebox_bot.settings import config
+
+logger = logging.getLogger(__name__)
+
+# one sat of bid weighs more than any difference in sequence numbers
+BID_WEIGHT = 2**32
+
+# what a group does with a duplicate request
+REJECT = "reject"
+WARN = "warn"
+PREMIUM = "premium"
+POLICIES = [REJECT, WARN, PREMIUM]
+
+# seconds the remaining time of a track may grow between two polls before it counts as a new play of the track
+PLAY_TOLERANCE = 5
+
+
+def _queuekey(chat_id: int) -> str:
+    return f"playqueue:{chat_id}"
+
+
+def _keys(chat_id: int) -> list:
+    """
+    The sorted set of the queue, the hash of the entries by id and the sequence number of the group
+    """
+    key = _queuekey(chat_id)
+    return [key, f"{key}:entries", f"{key}:seq"]
+
+
+def _playerkey(chat_id: int) -> str:
+    return f"{_queuekey(chat_id)}:player"
+
+
+def _requestedkey(chat_id: int) -> str:
+    return f"{_queuekey(chat_id)}:requested"
+
+
+# add the entries and mark the uris as requested now, the uris and entries alternate after the time and the cutoff
+_enqueue = redis.cache.register_script("""
+    for i = 3, #ARGV, 2 do
+        local id = redis.call('incr', KEYS[3])
+        redis.call('zadd', KEYS[1], id, id)
+        redis.call('hset', KEYS[2], id, ARGV[i + 1])
+        redis.call('zadd', KEYS[4], 'GT', ARGV[1], ARGV[i])
+    end
+    redis.call('zremrangebyscore', KEYS[4], '-inf', '(' .. ARGV[2])
+    return redis.call('zcard', KEYS[1])
+    """)
+
+# the uris that were requested or played after the cutoff, the others are held for an open invoice
+_claim = redis.cache.register_script("""
+    local duplicates = {}
+    for i = 3, #ARGV do
+        local requested = redis.call('zscore', KEYS[1], ARGV[i])
+        local played = redis.call('zscore', KEYS[2], ARGV[i])
+        if (requested and tonumber(requested) >= tonumber(ARGV[1]))
+            or (played and tonumber(played) >= tonumber(ARGV[1])) then
+            table.insert(duplicates, ARGV[i])
+        end
+        redis.call('zadd', KEYS[1], 'GT', ARGV[2], ARGV[i])
+    end
+    redis.call('zremrangebyscore', KEYS[1], '-inf', '(' .. ARGV[1])
+    return duplicates
+    """)
+
+# release the uris that are held for an invoice but were not queued since
+_release = redis.cache.register_script("""
+    for i = 2, #ARGV do
+        local score = redis.call('zscore', KEYS[1], ARGV[i])
+        if score and tonumber(score) <= tonumber(ARGV[1]) then
+            redis.call('zrem', KEYS[1], ARGV[i])
+        end
+    end
+    """)
+
+_pop = redis.cache.register_script("""
+    local head = redis.call('zpopmin', KEYS[1])
+    if #head == 0 then
+        return false
+    end
+    local entry = redis.call('hget', KEYS[2], head[1])
+    redis.call('hdel', KEYS[2], head[1])
+    return {head[1], head[2], entry}
+    """)
+
+_read = redis.cache.register_script("""
+    local result = {redis.call('zcard', KEYS[1])}
+    local entries = redis.call('zrange', KEYS[1], ARGV[1], ARGV[2], 'WITHSCORES')
+    for i = 1, #entries, 2 do
+        table.insert(result, entries[i])
+        table.insert(result, entries[i + 1])
+        table.insert(result, redis.call('hget', KEYS[2], entries[i]))
+    end
+    return result
+    """)
+
+
+def _entry(entry_id: bytes, score: bytes, data: bytes) -> dict:
+    entry_id = int(entry_id)
+    [uri, title, userid] = json.loads(data)
+    return {
+        "id": entry_id,
+        "uri": uri,
+        "title": title,
+        "userid": userid,
+        "bid": round((entry_id - float(score)) / BID_WEIGHT),
+    }
+
+
+async def enqueue(chat_id: int, userid: int, tracks: list, player=None) -> int:
+    """
+    Add (uri, title) tuples that a user requested to the queue of the group and returns the length of the queue. The
+    head of the queue is handed to the player right away when the current track ends soon
+    """
+    now = time()
+    args = [now, now - config.duplicate_window]
+    for uri, title in tracks:
+        args += [uri, json.dumps([uri, title, userid], separators=(",", ":"))]
+    size = _enqueue(keys=_keys(chat_id) + [_requestedkey(chat_id)], args=args)
+    live.publish_queue(chat_id)
+
+    if player is not None:
+        [play, ends, fed] = redis.cache.hmget(_playerkey(chat_id), "play", "ends", "fed")
+        if play is not None and fed != play and float(ends or 0) - time() <= config.queue_handoff:
+            await feed(chat_id, player, int(play))
+    return size
+
+
+def claim(chat_id: int, uris: list) -> list:
+    """
+    Returns the uris that were requested or played in the group within duplicate_window seconds, and holds the uris
+    for an invoice so that a second request is a duplicate while the invoice is open
+    """
+    now = time()
+    cutoff = now - config.duplicate_window
+    return [
+        uri.decode("utf-8")
+        for uri in _claim(
+            keys=[_requestedkey(chat_id), leaderboard.helper.playedkey(chat_id)],
+            args=[cutoff, cutoff + config.invoice_expiry] + uris,
+        )
+    ]
+
+
+def release(chat_id: int, uris: list) -> None:
+    """
+    Release the uris of an invoice that was canceled, uris that were queued in the meantime stay
+    """
+    limit = time() - config.duplicate_window + config.invoice_expiry
+    _release(keys=[_requestedkey(chat_id)], args=[limit] + uris)
+
+
+def get_duplicate_policy(chat_id: int) -> str:
+    """
+    Gets what the group does with duplicate requests, defaults to the duplicate_policy setting
+    """
+    policy = redis.cache.hget(f"group:{chat_id}", "duplicate_policy")
+    if policy is None:
+        return config.duplicate_policy
+    return policy.decode("utf-8")
+
+
+def set_duplicate_policy(chat_id: int, policy: str) -> None:
+    redis.cache.hset(f"group:{chat_id}", "duplicate_policy", policy)
+
+
+def get_queue(chat_id: int, count: int = 10, offset: int = 0) -> dict:
+    """
+    Returns the length of the queue and its entries from the offset, in the order they are played
+    """
+    data = _read(keys=_keys(chat_id), args=[offset, offset + count - 1])
+    return {"size": data[0], "entries": [_entry(*data[i : i + 3]) for i in range(1, len(data), 3)]}
+
+
+def bid(chat_id: int, entry_id: int, sats: int) -> dict:
+    """
+    Raise the bid of a track in the queue. Returns the entry, or None when the track left the queue
+    """
+    [key, entrieskey, _] = _keys(chat_id)
+    pipe = redis.cache.pipeline()
+    pipe.zadd(key, {entry_id: -sats * BID_WEIGHT}, xx=True, incr=True)
+    pipe.hget(entrieskey, entry_id)
+    [score, data] = pipe.execute()
+    if score is None or data is None:
+        return None
+    live.publish_queue(chat_id)
+    return _entry(entry_id, score, data)
+
+
+async def feed(chat_id: int, player, play: int) -> dict:
+    """
+    Hand the head of the queue to the player during the play with the given number, returns the entry or None when
+    the queue is empty
+    """
+    [key, entrieskey, _] = _keys(chat_id)
+    head = _pop(keys=[key, entrieskey])
+    if head is None:
+        return None
+
+    entry = _entry(*head)
+    try:
+        await player.enqueue(entry["uri"])
+    except Exception:
+        # back at its place in the queue, the next poll tries again
+        pipe = redis.cache.pipeline()
+        pipe.zadd(key, {head[0]: float(head[1])})
+        pipe.hset(entrieskey, head[0], head[2])
+        pipe.execute()
+        raise
+
+    live.publish_queue(chat_id)
+    redis.cache.hset(_playerkey(chat_id), "fed", play)
+    logger.debug(f"Handed {entry['uri']} to the player of {chat_id}")
+    return entry
+
+
+async def poll(chat_id: int, player, current: str, remaining: float) -> float:
+    """
+    Record the track that plays and the seconds it has left, and hand over the head of the queue when the track ends
+    within queue_handoff seconds. An empty current track means the player is idle. Returns the seconds until the next
+    handoff is due, or None when the queue is empty or the play was fed already
+    """
+    [previous, left, play, fed] = redis.cache.hmget(_playerkey(chat_id), "current", "remaining", "play", "fed")
+    play = int(play or 0)
+    previous = previous.decode("utf-8") if previous is not None else None
+    # a pause keeps the remaining time, a track that starts again gets its full length back
+    if previous != current or (current != "" and remaining > float(left or 0) + PLAY_TOLERANCE):
+        play += 1
+
+    pipe = redis.cache.pipeline()
+    pipe.hset(
+        _playerkey(chat_id),
+        mapping={"current": current, "remaining": remaining, "ends": time() + remaining, "play": play},
+    )
+    pipe.zcard(_queuekey(chat_id))
+    [_, queued] = pipe.execute()
+
+    if queued == 0 or (fed is not None and fed.decode("utf-8") == str(play)):
+        return None
+    if remaining > config.queue_handoff:
+        return remaining - config.queue_handoff
+
+    await feed(chat_id, player, play)
+    return None
@@ -0,0 +1,123 @@
+"""
+A sampling profiler for live traffic. A thread samples the stack of the event loop thread at a fixed interval. A sample
+costs a few microseconds and nothing runs in between, so the overhead is bounded by the interval. One profile runs at a
+time and no longer than profile_max_seconds.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from lightning_jukebox_bot.application import watchdog
+from lightning_jukebox_bot.settings import config
+
+logger = logging.getLogger(__name__)
+
+session = None
+
+
+class Profile:
+    def __init__(self, seconds: float, interval: float):
+        self.seconds = seconds
+        self.interval = interval
+        self.samples = Counter()
+        self.elapsed = 0
+        self._names = {}
+
+    def sample(self, thread_id: int) -> None:
+        """
+        Sample the stack of the thread until the profile is done, runs in a thread of its own
+        """
+        start = time.monotonic()
+        deadline = start + self.seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stack = watchdog.capture_stack(frame)
+                self.samples[tuple((filename, function) for filename, _, function in stack)] += 1
+            # do not keep the frames of the loop alive
+            del frame
+            time.sleep(self.interval)
+        self.elapsed = time.monotonic() - start
+
+    def _name(self, frame: tuple) -> str:
+        name = self._names.get(frame)
+        if name is None:
+            name = self._names[frame] = f"{watchdog.module_name(frame[0])}.{frame[1]}"
+        return name
+
+    @staticmethod
+    def _idle(stack: tuple) -> bool:
+        # the loop waits for events in the selector
+        return len(stack) > 0 and stack[-1][0].endswith(f"{os.sep}selectors.py")
+
+    def summary(self, limit: int = 15) -> str:
+        """
+        The share of the busy samples of the bot functions on the stack, and of the innermost functions
+        """
+        total = sum(self.samples.values())
+        cumulative = Counter()
+        own = Counter()
+        for stack, count in self.samples.items():
+            if self._idle(stack):
+                continue
+            # recursive functions count once per sample
+            for frame in set(stack):
+                if frame[0].startswith(watchdog.PACKAGE_PATH):
+                    cumulative[self._name(frame)] += count
+            if len(stack) > 0:
+                own[self._name(stack[-1])] += count
+        busy = sum(own.values())
+
+        text = f"Profiled {self.elapsed:.1f} s, {total} samples, the event loop was busy in {busy} samples\n"
+        if busy == 0:
+            return text
+        text += "Bot functions on the stack:\n"
+        for name, count in cumulative.most_common(limit):
+            text += f" - {count / busy:6.1%} {name}\n"
+        text += "Running functions:\n"
+        for name, count in own.most_common(limit):
+            text += f" - {count / busy:6.1%} {name}\n"
+        return text
+
+    def collapsed(self) -> str:
+        """
+        The samples as collapsed stacks, the input of flamegraph.pl and speedscope
+        """
+        lines = []
+        for stack, count in self.samples.most_common():
+            lines.append(";".join(self._name(frame) for frame in stack) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+
+async def _run(profile: Profile) -> Profile:
+    global session
+
+    logger.info(f"Profiling the event loop for {profile.seconds} seconds")
+    try:
+        await asyncio.to_thread(profile.sample, threading.get_ident())
+    finally:
+        session = None
+    return profile
+
+
+def running() -> bool:
+    return session is not None
+
+
+def start(seconds: float) -> asyncio.Task:
+    """
+    Start a profile of at most profile_max_seconds, the task returns the profile. Returns None when a profile is
+    running already
+    """
+    global session
+
+    if session is not None:
+        return None
+    profile = Profile(max(1, min(seconds, config.profile_max_seconds)), config.profile_interval)
+    session = asyncio.get_running_loop().create_task(_run(profile))
+    return session
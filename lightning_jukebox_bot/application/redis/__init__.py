@@ -1,3 +1,26 @@
 import redis
+from redis.client import Pipeline
 
-cache = redis.Redis(db=2)
+from lightning_jukebox_bot.application import metrics
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        with metrics.track_dependency("redis", "PIPELINE"):
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    Records the latency and errors of every redis command
+    """
+
+    def execute_command(self, *args, **options):
+        with metrics.track_dependency("redis", str(args[0]).upper()):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> Pipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+cache = InstrumentedRedis(db=2)
@@ -1,15 +1,18 @@
 import json
 import logging
-from time import time
+import re
 
 from redis import RedisError
-from spotipy import CacheHandler, SpotifyOAuth
+from spotipy import CacheHandler, Spotify, SpotifyOAuth
 
-from lightning_jukebox_bot.application import redis
+from lightning_jukebox_bot.application import leaderboard, metrics, redis, stats
 from lightning_jukebox_bot.settings import config
 
 logger = logging.getLogger(__name__)
 
+# path segments of the Web API that are not a fixed name, such as the ids of tracks and playlists
+ID_PATTERN = re.compile(".*[^a-z-]")
+
 
 class SpotifySettings:
     def __init__(self, tguserid):
@@ -71,12 +74,25 @@ class CacheJukeboxHandler(CacheHandler):
             logging.warning("Error saving token to cache: " + str(e))
 
 
-def add_to_queue(sp, spotify_uri_list):
+class InstrumentedSpotify(Spotify):
     """
-    Add a list of tracks to the queue
+    Records the latency and errors of every call to the Web API. The ids in the path are left out of the operation
     """
-    for uri in spotify_uri_list:
-        sp.add_to_queue(uri)
+
+    def _internal_call(self, method, url, payload, params):
+        path = url[len(self.prefix) :] if url.startswith(self.prefix) else url.split("?")[0]
+        parts = [part if ID_PATTERN.match(part) is None else "{id}" for part in path.split("/")]
+        with metrics.track_dependency("spotify", f"{method} {'/'.join(parts)}"):
+            return super()._internal_call(method, url, payload, params)
+
+
+def create_client(auth_manager: SpotifyOAuth) -> Spotify:
+    """
+    Create a spotify client for the player of a group
+    """
+    sp = InstrumentedSpotify(auth_manager=auth_manager)
+    sp.prefix = config.spotify_api_prefix
+    return sp
 
 
 # construct the track title from a Spotify track item
@@ -141,6 +157,7 @@ async def init_auth_manager(chat_id, client_id, client_secret):
     logger.info("init auth manager")
     data = {"chat_id": chat_id, "client_id": client_id, "client_secret": client_secret}
     redis.cache.hset(f"group:{chat_id}", "authmanager", json.dumps(data))
+    stats.helper.add_group(chat_id)
 
     return await create_auth_manager(chat_id, client_id, client_secret)
 
@@ -203,22 +220,21 @@ async def get_history(chat_id, maxlen):
     return titles
 
 
-async def update_history(chat_id: int, title: str) -> None:
+async def update_history(chat_id: int, title: str, uri: str) -> None:
+    """
+    Add the track that is playing to the history, a track that started playing counts in the leaderboards
+    """
     rediskey = f"history:{chat_id}"
     currenttitle = redis.cache.lindex(rediskey, 0)
+    if currenttitle is not None and currenttitle.decode("utf-8") == title:
+        return
 
-    if currenttitle is None:
-        redis.cache.lpush(rediskey, title)
-    else:
-        currenttitle = currenttitle.decode("utf-8")
-        if currenttitle != title:
-            redis.cache.lpush(rediskey, title)
-
-        if redis.cache.llen(rediskey) > 100:
-            redis.cache.rpop(rediskey)
+    pipe = redis.cache.pipeline()
+    pipe.lpush(rediskey, title)
+    pipe.ltrim(rediskey, 0, 99)
+    pipe.execute()
 
-    # update last played entry
-    redis.cache.hset(f"lastplayed:{chat_id}", title, int(time()))
+    leaderboard.helper.record_play(chat_id, uri, title)
 
 
 async def get_donation_fee(chat_id: int) -> int:
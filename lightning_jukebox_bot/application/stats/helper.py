@@ -1,35 +1,134 @@
 import logging
+from time import time
+from typing import Optional
 
-from lightning_jukebox_bot.application import redis, users
+from lightning_jukebox_bot.application import analytics, leaderboard, redis, users
 from lightning_jukebox_bot.settings import config
 
+logger = logging.getLogger(__name__)
 
-async def get_bot_stack() -> int:
+# the groups by the time they were first seen
+GROUPS_KEY = "stats:groups"
+# the totals over all groups
+TOTALS_KEY = "stats:totals"
+# set once the index is built from the group keys
+BUILT_KEY = "stats:built"
+
+# groups on a page of /stats
+PAGE_SIZE = 25
+
+
+def _groupkey(chat_id: int) -> str:
+    return f"stats:group:{chat_id}"
+
+
+def add_group(chat_id: int) -> None:
+    """
+    Add a group to the index, when a group connects a player
+    """
+    redis.cache.zadd(GROUPS_KEY, {chat_id: int(time())}, nx=True)
+
+
+def set_owner(chat_id: int, userid: int) -> None:
+    pipe = redis.cache.pipeline()
+    pipe.zadd(GROUPS_KEY, {chat_id: int(time())}, nx=True)
+    pipe.hset(_groupkey(chat_id), "owner", userid)
+    pipe.execute()
+
+
+def remove_owner(chat_id: int) -> None:
+    redis.cache.hdel(_groupkey(chat_id), "owner")
+
+
+def add_tracks(chat_id: int, userid: int, uris: list, sats: int) -> None:
     """
-    Returns the amount of sats of the Jukebox Bot itself.
+    Count tracks that a user added to the queue of a group and the sats that were paid for them, in the totals, the
+    analytics of the group and the leaderboards
     """
-    jukeboxbot: users.helper.User = await users.helper.get_or_create_user(config.bot_id)
-    balance: int = await users.helper.get_balance(jukeboxbot)
-    return balance
+    tracks = len(uris)
+    pipe = redis.cache.pipeline()
+    pipe.zadd(GROUPS_KEY, {chat_id: int(time())}, nx=True)
+    pipe.hincrby(_groupkey(chat_id), "tracks", tracks)
+    pipe.hincrby(_groupkey(chat_id), "sats", sats)
+    pipe.hincrby(TOTALS_KEY, "tracks", tracks)
+    pipe.hincrby(TOTALS_KEY, "sats", sats)
+    analytics.helper.record_tracks(pipe, chat_id, userid, tracks, sats)
+    leaderboard.helper.record_sats(pipe, chat_id, uris, sats)
+    pipe.execute()
+
+
+def add_donation(chat_id: int, sats: int) -> None:
+    pipe = redis.cache.pipeline()
+    pipe.hincrby(_groupkey(chat_id), "donations", sats)
+    pipe.hincrby(TOTALS_KEY, "donations", sats)
+    pipe.execute()
 
 
-async def get_jukebox_groups() -> dict:
+def build_index() -> None:
     """
-    Returns a list of Jukebox groups and some stats about them
+    Add the groups that existed before the index was kept, once. The counters of the tracks, sats and donations
+    start at zero
     """
-    result = {"numgroups": 0, "group": []}
+    if not redis.cache.set(BUILT_KEY, int(time()), nx=True):
+        return
+
+    count = 0
     for key in redis.cache.scan_iter("group:*"):
-        chatid: int = int(key.decode("utf-8").split(":")[1])
+        chat_id: int = int(key.decode("utf-8").split(":")[1])
+        [owner, authmanager] = redis.cache.hmget(key, "owner", "authmanager")
+        if owner is not None:
+            set_owner(chat_id, int(owner))
+        elif authmanager is not None:
+            add_group(chat_id)
+        else:
+            continue
+        count += 1
+    logger.info(f"Added {count} groups to the stats index")
+
+
+def _hash(values: dict) -> dict:
+    return {key.decode("utf-8"): int(value) for key, value in values.items()}
 
-        result["numgroups"] += 1
 
-        owner = None
-        try:
-            owner = await users.helper.get_group_owner(chatid)
-        # TODO: replace bare except
-        except:  # noqa: E722
-            logging.error("problem getting group stats")
+def get_page(page: int) -> dict:
+    """
+    Returns the totals and a page of groups with their owners and counters, pages are numbered from 1. Owners
+    without a wallet in the bot have no username
+    """
+    start = (max(1, page) - 1) * PAGE_SIZE
+    pipe = redis.cache.pipeline(transaction=False)
+    pipe.zcard(GROUPS_KEY)
+    pipe.hgetall(TOTALS_KEY)
+    pipe.zrange(GROUPS_KEY, start, start + PAGE_SIZE - 1)
+    [numgroups, totals, chat_ids] = pipe.execute()
 
-        result["group"].append({"groupid": chatid, "owner": owner})
+    # the counters of the groups, then the userdata of their owners
+    for chat_id in chat_ids:
+        pipe.hgetall(_groupkey(int(chat_id)))
+    groups = [_hash(group) for group in pipe.execute()]
+    owners = [users.helper.User(group.pop("owner")) if "owner" in group else None for group in groups]
+    for owner in owners:
+        if owner is not None:
+            pipe.hget(owner.rediskey, "userdata")
+    userdata = iter(pipe.execute())
 
+    result = {
+        "numgroups": numgroups,
+        "totals": _hash(totals),
+        "pages": max(1, -(-numgroups // PAGE_SIZE)),
+        "group": [],
+    }
+    for chat_id, group, owner in zip(chat_ids, groups, owners):
+        if owner is not None:
+            data = next(userdata)
+            if data is not None:
+                owner.decode(data)
+        result["group"].append({"groupid": int(chat_id), "owner": owner, **group})
     return result
+
+
+def get_bot_stack() -> Optional[int]:
+    """
+    Returns the cached amount of sats of the Jukebox Bot itself, or None when the balance is not cached
+    """
+    return users.helper.get_cached_balance(users.helper.User(config.bot_id))
@@ -1,29 +1,62 @@
 from telegram.ext import CallbackQueryHandler, CommandHandler
 
-from . import bot_cmds, helper, util  # noqa: F401
+from lightning_jukebox_bot.application import (
+    donations,
+    leaderboard,
+    metrics,
+    players,
+    tracing,
+    users,
+)
+from lightning_jukebox_bot.settings import config
+
+from . import bot_cmds, broadcast, helper, ingest, media, sender, util  # noqa: F401
 from .application import app
 
+
+def command(commands, callback) -> CommandHandler:
+    """
+    A command handler that records the latency, errors and spans of the command under its first name
+    """
+    name = commands if isinstance(commands, str) else commands[0]
+    return CommandHandler(commands, metrics.track_command(name, tracing.traced(f"command {name}", callback)))
+
+
 # register handlers
-app.add_handler(CommandHandler("add", bot_cmds.search))  # search for a track
-app.add_handler(CommandHandler(["stack", "balance"], bot_cmds.balance))  # view wallet balance
-app.add_handler(CommandHandler("couple", bot_cmds.connect))  # connect to spotify account
-app.add_handler(CommandHandler("decouple", bot_cmds.disconnect))  # disconnect from spotify account
-app.add_handler(CommandHandler("fund", bot_cmds.fund))  # add funds to wallet
-app.add_handler(CommandHandler("history", bot_cmds.history))  # view history of tracks
-app.add_handler(CommandHandler("link", bot_cmds.link))  # view LNDHUB QR
-app.add_handler(CommandHandler("refund", bot_cmds.pay))  # pay a lightning invoice
-app.add_handler(CommandHandler("price", bot_cmds.price))  # set the track price
-app.add_handler(CommandHandler("queue", bot_cmds.queue))  # view the queue
-app.add_handler(CommandHandler("service", bot_cmds.service))  # service notifications to bot users
-# TODO: does not exist?
-app.add_handler(CommandHandler("setclientsecret", bot_cmds.spotify_settings))  # set the secret for a spotify app
-app.add_handler(CommandHandler("setclientid", bot_cmds.spotify_settings))  # set the clientid or a spotify app
-
-app.add_handler(CommandHandler("stats", bot_cmds.stats))  # dump various stats
-app.add_handler(CommandHandler(["start", "faq"], bot_cmds.start))  # help message
-app.add_handler(CommandHandler("dj", bot_cmds.dj))  # pay another user
-app.add_handler(CommandHandler("web", bot_cmds.web))  # display the web URL
-
-app.add_handler(CallbackQueryHandler(util.callback_button))
+app.add_handler(command("add", bot_cmds.search))  # search for a track
+app.add_handler(command(["stack", "balance"], bot_cmds.balance))  # view wallet balance
+app.add_handler(command("couple", bot_cmds.connect))  # connect to spotify account
+app.add_handler(command("decouple", bot_cmds.disconnect))  # disconnect from spotify account
+app.add_handler(command("fund", bot_cmds.fund))  # add funds to wallet
+app.add_handler(command("history", bot_cmds.history))  # view history of tracks
+app.add_handler(command("top", bot_cmds.top))  # view the most played and best paid tracks
+app.add_handler(command("link", bot_cmds.link))  # view LNDHUB QR
+app.add_handler(command("refund", bot_cmds.pay))  # pay a lightning invoice
+app.add_handler(command("price", bot_cmds.price))  # set the track price
+app.add_handler(command("duplicates", bot_cmds.duplicates))  # what happens with tracks requested again
+app.add_handler(command("analytics", bot_cmds.show_analytics))  # tracks, sats and requesters of the group
+app.add_handler(command("queue", bot_cmds.queue))  # view the queue
+app.add_handler(command("bump", bot_cmds.bump))  # bid on a track to move it up the queue
+app.add_handler(command("service", bot_cmds.service))  # service notifications to bot users
+app.add_handler(command("setclientsecret", bot_cmds.spotify_config))  # set the secret for a spotify app
+app.add_handler(command("setclientid", bot_cmds.spotify_config))  # set the clientid or a spotify app
+
+app.add_handler(command("stats", bot_cmds.show_stats))  # dump various stats
+app.add_handler(command("donations", bot_cmds.donation_report))  # reconciliation of the donations to the bot
+app.add_handler(command("stalls", bot_cmds.stalls))  # calls that blocked the event loop
+app.add_handler(command("profile", bot_cmds.profile))  # profile the bot on live traffic
+app.add_handler(command(["start", "faq"], bot_cmds.start))  # help message
+app.add_handler(command("dj", bot_cmds.dj))  # pay another user
+app.add_handler(command("web", bot_cmds.web))  # display the web URL
+app.add_handler(command("player", bot_cmds.player))  # the URL that music players connect to
+
+app.add_handler(CallbackQueryHandler(metrics.track_command("button", tracing.traced("button", util.callback_button))))
+app.add_error_handler(util.error_handler)
 app.job_queue.run_repeating(util.regular_cleanup, 12 * 3600)
 app.job_queue.run_once(util.callback_spotify, 2)
+players.remote.controller.listeners.append(util.update_now_playing)  # remote players push what they play
+app.job_queue.run_once(broadcast.resume_broadcasts, 5)
+app.job_queue.run_repeating(users.pool.refill, config.wallet_pool_refill_interval, first=10)
+app.job_queue.run_repeating(users.helper.reconcile_balances, config.balance_reconcile_interval)
+app.job_queue.run_repeating(donations.helper.settle_donations, config.donation_settle_interval, first=60)
+app.job_queue.run_repeating(leaderboard.helper.decay, 24 * 3600, first=3600)
@@ -1,5 +1,36 @@
+from time import perf_counter
+
 from telegram.ext import Application
+from telegram.request import HTTPXRequest
 
+from lightning_jukebox_bot.application import metrics
 from lightning_jukebox_bot.settings import config
 
-app = Application.builder().token(config.bot_token).updater(None).build()
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    Records the latency and errors of every call to the Bot API, the operation is the name of the method
+    """
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        operation = url.rsplit("/", 1)[-1]
+        start = perf_counter()
+        try:
+            status_code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            metrics.observe_dependency("telegram", operation, perf_counter() - start, error=True)
+            raise
+        metrics.observe_dependency("telegram", operation, perf_counter() - start, error=status_code >= 400)
+        return status_code, payload
+
+
+app = (
+    Application.builder()
+    .token(config.bot_token)
+    .base_url(config.telegram_base_url)
+    # the pool size of the default request of the bot
+    .request(InstrumentedRequest(connection_pool_size=256))
+    .updater(None)
+    .concurrent_updates(config.telegram_update_workers)
+    .build()
+)
@@ -1,19 +1,27 @@
 import base64
 import logging
-import os
 import re
+from datetime import datetime, timezone
 
-import qrcode
-import spotipy
-from PIL import Image
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.error import TelegramError
 from telegram.ext import ContextTypes
 
-from lightning_jukebox_bot.application import invoicing, spotify, telegram, users
-from lightning_jukebox_bot.config import config
+from lightning_jukebox_bot.application import (
+    analytics,
+    donations,
+    invoicing,
+    leaderboard,
+    players,
+    playqueue,
+    profiler,
+    spotify,
+    stats,
+    telegram,
+    users,
+    watchdog,
+)
+from lightning_jukebox_bot.settings import config
 
-from ...settings import const
 from . import helper, messages
 from .helper import TelegramCommand
 from .util import adminonly, debounce, delete_message
@@ -30,31 +38,28 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
 
     if update.message.chat.type == "private":
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text="Execute the /add command in the group instead of the private chat.",
         )
         return
 
-    # get an auth manager, if no auth manager is available, dump a message
-    auth_manager = await spotify.helper.get_auth_manager(update.effective_chat.id)
-    if auth_manager is None:
-        await context.bot.send_message(
+    # get the player, if no player is available, dump a message
+    player = await players.get_player(update.effective_chat.id)
+    if player is None:
+        await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             parse_mode="HTML",
             text="Bot not connected to player. The admin should perform the /couple command to authorize the bot.",
         )
         return
 
-    # create spotify instance
-    sp = spotipy.Spotify(auth_manager=auth_manager)
-
     # validate the search string
     searchstr = update.message.text.split(" ", 1)
     if len(searchstr) > 1:
         searchstr = searchstr[1]
     else:
-        message = await context.bot.send_message(chat_id=update.effective_chat.id, text=messages.ADD_COMMAND_HELP)
+        message = await telegram.sender.send_message(chat_id=update.effective_chat.id, text=messages.ADD_COMMAND_HELP)
         context.job_queue.run_once(
             delete_message,
             config.delete_message_timeout_medium,
@@ -66,20 +71,29 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     match = re.search("https://open.spotify.com/playlist/([A-Za-z0-9]+).*$", searchstr)
     if match:
         playlistid = match.groups()[0]
-        result = sp.playlist(playlistid, fields=["name"])
-        message = await context.bot.send_message(
+        [name, _] = await players.get_playlist(player, playlistid)
+        price = await spotify.helper.get_price(update.effective_chat.id)
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
-            text=f"@{update.effective_user.username} suggests to play tracks from the '{result['name']}' playlist.",
+            text=f"@{update.effective_user.username} suggests to play tracks from the '{name}' playlist.",
             reply_markup=InlineKeyboardMarkup(
                 [
                     [
                         InlineKeyboardButton(
-                            f"Pay {await spotify.helper.get_price(update.effective_chat.id)} sats for a random track",
+                            f"Pay {price} sats for a random track",
                             callback_data=telegram.helper.add_command(
-                                TelegramCommand(0, telegram.helper.playrandom, playlistid)
+                                TelegramCommand(0, telegram.helper.playrandom, (playlistid, 1))
                             ),
                         )
-                    ]
+                    ],
+                    [
+                        InlineKeyboardButton(
+                            f"Pay {config.playlist_batch * price} sats for {config.playlist_batch} random tracks",
+                            callback_data=telegram.helper.add_command(
+                                TelegramCommand(0, telegram.helper.playrandom, (playlistid, config.playlist_batch))
+                            ),
+                        )
+                    ],
                 ]
             ),
         )
@@ -96,38 +110,28 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     numtries: int = 3
     while numtries > 0:
         try:
-            result = sp.search(searchstr)
-        except spotipy.oauth2.SpotifyOauthError:
-            # spotify not properly authenticated
-            logger.info("Spotify Oauth error")
-            message = await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Music player not available, search aborted.",
-            )
-            return
-
-        except spotipy.exceptions.SpotifyException:
+            result = await player.search(searchstr)
+        except players.PlayerUnavailable:
             numtries -= 1
             if numtries == 0:
-                # spotify still triggers an exception
-                logger.error("Spotify returned and exception, not returning search result")
-                message = await context.bot.send_message(
+                # the player still triggers an exception
+                logger.error("Player returned an exception, not returning search result")
+                message = await telegram.sender.send_message(
                     chat_id=update.effective_chat.id,
                     text="Music player unavailable, search aborted.",
                 )
                 return
-            logger.warning("Spotify returned and exception, retrying")
+            logger.warning("Player returned an exception, retrying")
             continue
 
         break
 
     # create a list of max five buttons, each with a unique song title
-    # TODO: May be referenced before assignment
-    if len(result["tracks"]["items"]) > 0:
+    if len(result) > 0:
         tracktitles = {}
         button_list = []
-        for item in result["tracks"]["items"]:
-            title = spotify.helper.get_track_title(item)
+        for track in result:
+            title = track.title
             if title not in tracktitles:
                 tracktitles[title] = 1
                 button_list.append(
@@ -138,7 +142,7 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                                 TelegramCommand(
                                     update.effective_user.id,
                                     telegram.helper.add,
-                                    item["uri"],
+                                    track.uri,
                                 )
                             ),
                         )
@@ -161,7 +165,7 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             ]
         )
 
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text=f"Results for '{searchstr}'",
             reply_markup=InlineKeyboardMarkup(button_list),
@@ -174,7 +178,9 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             data={"message": message},
         )
     else:
-        message = await context.bot.send_message(chat_id=update.effective_chat.id, text=f"No results for '{searchstr}'")
+        message = await telegram.sender.send_message(
+            chat_id=update.effective_chat.id, text=f"No results for '{searchstr}'"
+        )
         context.job_queue.run_once(
             delete_message,
             config.delete_message_timeout_short,
@@ -186,7 +192,7 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 @debounce
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # send the message
-    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=messages.HELP)
+    message = await telegram.sender.send_message(chat_id=update.effective_chat.id, text=messages.HELP)
 
     # only create a callback to delete the message when not in a private chat
     if update.message.chat.type != "private":
@@ -199,7 +205,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 # display stats
 @debounce
-async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Shows the totals and a page of the groups, /stats <page>
+    """
     userid: int = update.effective_user.id
 
     if update.message.chat.type != "private":
@@ -209,18 +218,154 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logging.info(f"User {userid} is not a superadmin. Access to stats denied")
         return
 
-    results = await stats.helper.get_jukebox_groups()
-    balance = await stats.helper.get_bot_stack()
+    page = 1
+    if len(context.args) > 0 and context.args[0].isdigit():
+        page = int(context.args[0])
 
-    statsText = f"Bot balance: {balance} sats \n"
+    results = stats.helper.get_page(page)
+    balance = stats.helper.get_bot_stack()
+    totals = results["totals"]
 
-    statsText += f"Number of groups: {results['numgroups']}. List of owners: \n"
+    statsText = f"Bot balance: {balance} sats \n" if balance is not None else "Bot balance: not cached \n"
+    statsText += (
+        f"Tracks added: {totals.get('tracks', 0)}, paid: {totals.get('sats', 0)} sats, "
+        f"donations: {totals.get('donations', 0)} sats\n"
+    )
+
+    statsText += f"Number of groups: {results['numgroups']}. Owners, page {page} of {results['pages']}: \n"
     for group in results["group"]:
-        if group["owner"] is not None:
-            statsText += f" - {group['groupid']} : @{group['owner'].username}\n"
+        if group["owner"] is None:
+            owner = "Unknown owner"
+        elif group["owner"].username is not None:
+            owner = f"@{group['owner'].username}"
         else:
-            statsText += f" - {group['groupid']} : Unknown owner\n"
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=statsText)
+            owner = str(group["owner"].userid)
+        statsText += (
+            f" - {group['groupid']} : {owner}, {group.get('tracks', 0)} tracks, {group.get('sats', 0)} sats, "
+            f"{group.get('donations', 0)} sats donated\n"
+        )
+
+    lnbits = config.lnbits.get_stats()
+    statsText += f"LNbits: {lnbits['state']}\n"
+    for operation, opstats in sorted(lnbits["operations"].items()):
+        statsText += (
+            f" - {operation} : {opstats['calls']} calls, avg {opstats['average'] * 1000:.0f} ms, "
+            f"p99 under {opstats['p99'] * 1000:.0f} ms, {opstats['errors']} errors, {opstats['retries']} retries, "
+            f"{opstats['rejected']} rejected\n"
+        )
+    await telegram.sender.send_message(chat_id=update.effective_chat.id, text=statsText)
+
+
+# display the calls that blocked the event loop
+@debounce
+async def stalls(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    userid: int = update.effective_user.id
+
+    if update.message.chat.type != "private":
+        return
+
+    if userid not in config.superadmins:
+        logging.info(f"User {userid} is not a superadmin. Access to stalls denied")
+        return
+
+    if not watchdog.enabled():
+        await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="The watchdog is off. Set loop_watchdog_threshold in the settings to turn it on.",
+        )
+        return
+
+    recorded = watchdog.get_stalls()
+    text = f"Event loop stalls over {config.loop_watchdog_threshold * 1000:.0f} ms: {len(recorded)}\n"
+
+    # the calls that blocked the loop the longest in total
+    totals = {}
+    for stall in recorded:
+        calls = " > ".join(watchdog.describe(stall.stack))
+        count, duration = totals.get(calls, (0, 0))
+        totals[calls] = (count + 1, duration + stall.duration)
+    if len(totals) > 0:
+        text += "Worst offenders:\n"
+        for calls, (count, duration) in sorted(totals.items(), key=lambda item: item[1][1], reverse=True)[:5]:
+            text += f" - {duration * 1000:.0f} ms in {count} stalls: {calls}\n"
+
+    if len(recorded) > 0:
+        text += "Latest:\n"
+        for stall in reversed(recorded[-10:]):
+            started = datetime.fromtimestamp(stall.started).strftime("%H:%M:%S")
+            text += f" - {started} {stall.duration * 1000:.0f} ms: {' > '.join(watchdog.describe(stall.stack))}\n"
+
+    await telegram.sender.send_message(chat_id=update.effective_chat.id, text=text)
+
+
+async def send_profile(chat_id: int, session, stacks: bool) -> None:
+    profile = await session
+    await telegram.sender.send_message(chat_id=chat_id, text=profile.summary()[:4096])
+    if stacks:
+        await telegram.sender.send_document(
+            chat_id=chat_id, document=profile.collapsed().encode("utf-8"), filename="profile.folded"
+        )
+
+
+# profile the bot on live traffic
+@debounce
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    userid: int = update.effective_user.id
+
+    if update.message.chat.type != "private":
+        return
+
+    if userid not in config.superadmins:
+        logging.info(f"User {userid} is not a superadmin. Access to profile denied")
+        return
+
+    result = re.search("^/profile\s+([0-9]+)(\s+stacks)?\s*$", update.message.text)  # noqa: W605
+    if result is None:
+        await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="Use the /profile command as follows: /profile <seconds> [stacks]\n"
+            "With stacks the collapsed stacks for a flamegraph are sent as well.",
+        )
+        return
+
+    session = profiler.start(int(result.groups()[0]))
+    if session is None:
+        await telegram.sender.send_message(chat_id=update.effective_chat.id, text="A profile is running already.")
+        return
+
+    await telegram.sender.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"Profiling the bot for {min(int(result.groups()[0]), config.profile_max_seconds)} seconds.",
+    )
+    # the results are sent when the profile is done, the update is handled now
+    context.application.create_task(send_profile(update.effective_chat.id, session, result.groups()[1] is not None))
+
+
+# display the reconciliation of the donations to the bot
+@debounce
+async def donation_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    userid: int = update.effective_user.id
+
+    if update.message.chat.type != "private":
+        return
+
+    if userid not in config.superadmins:
+        logging.info(f"User {userid} is not a superadmin. Access to donations denied")
+        return
+
+    report = donations.helper.get_report()
+
+    text = (
+        f"Donations recorded: {report['recorded']} sats\n"
+        f"Settled: {report['settled']} sats\n"
+        f"Pending: {report['pending']} sats\n"
+        f"In flight: {report['in_flight']} sats\n"
+    )
+    if len(report["mismatches"]) > 0:
+        text += "Owners that do not add up:\n"
+        for mismatch in report["mismatches"]:
+            text += f" - {mismatch['owner']} : recorded {mismatch['recorded']}, accounted {mismatch['accounted']}\n"
+    await telegram.sender.send_message(chat_id=update.effective_chat.id, text=text)
 
 
 # get the current balance
@@ -231,7 +376,7 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         bot_me = await context.bot.get_me()
 
         # direct the user to their private chat
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text=messages.BALANCE_IN_GROUP,
             reply_markup=InlineKeyboardMarkup(
@@ -253,8 +398,10 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     balance = await users.helper.get_balance(user)
 
     # create a message with the balance
-    logging.info(f"User {user.userid} balance is {balance} sats")
-    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Your balance is {balance} sats.")
+    logging.debug(f"User {user.userid} balance is {balance} sats")
+    message = await telegram.sender.send_message(
+        chat_id=update.effective_chat.id, text=f"Your balance is {balance} sats."
+    )
 
 
 # Disconnect a spotify player from the bot, the connect command
@@ -263,7 +410,7 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def disconnect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # this command can only be used in group chats, send instructions if used in a private chat
     if update.message.chat.type == "private":
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             parse_mode="HTML",
             text=messages.DISCONNECT_IN_PRIVATE_CHAT,
@@ -283,7 +430,7 @@ async def disconnect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
     # get an auth manager, if no auth manager is available, dump a message
     if result:
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             parse_mode="HTML",
             text=messages.SPOTIFY_AUTHORISATION_REMOVED,
@@ -294,7 +441,7 @@ async def disconnect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             data={"message": message},
         )
     else:
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             parse_mode="HTML",
             text=messages.SPOTIFY_AUTHORISATION_REMOVED_ERROR,
@@ -311,12 +458,11 @@ async def disconnect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 # @adminonly
 async def connect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # get spotify config for the user
-    # TODO: This doesnt exist?
-    sps = await spotify.helper.get_spotify_config(update.effective_user.id)
+    sps = await spotify.helper.get_spotify_settings(update.effective_user.id)
 
     # this command has to be execute from within a group
     if update.message.chat.type == "private":
-        await context.bot.send_message(
+        await telegram.sender.send_message(
             chat_id=update.effective_user.id,
             parse_mode="HTML",
             text=f"""
@@ -337,22 +483,22 @@ To connect this bot to your spotify account, you have to create an app in the de
 
         # check that client_id is not None
         if sps.client_id is None:
-            await context.bot.send_message(chat_id=update.effective_user.id, text=messages.NO_CLIENT_ID_SET)
+            await telegram.sender.send_message(chat_id=update.effective_user.id, text=messages.NO_CLIENT_ID_SET)
         else:
-            await context.bot.send_message(
+            await telegram.sender.send_message(
                 chat_id=update.effective_user.id,
                 text=messages.CLIENT_ID_SET.format(sps.client_id),
             )
 
         # check that client secret is not None
         if sps.client_secret is None:
-            await context.bot.send_message(chat_id=update.effective_user.id, text=messages.NO_CLIENT_SECRET_SET)
+            await telegram.sender.send_message(chat_id=update.effective_user.id, text=messages.NO_CLIENT_SECRET_SET)
         else:
-            await context.bot.send_message(chat_id=update.effective_user.id, text=messages.CLIENT_SECRET_SET)
+            await telegram.sender.send_message(chat_id=update.effective_user.id, text=messages.CLIENT_SECRET_SET)
 
         # hint the user for the connect command
         if sps.client_id is not None and sps.client_secret is not None:
-            await context.bot.send_message(
+            await telegram.sender.send_message(
                 chat_id=update.effective_user.id,
                 text=messages.EVERYTHING_SET_NOW_DO_CONNECT,
             )
@@ -367,7 +513,7 @@ To connect this bot to your spotify account, you have to create an app in the de
         # get an auth manaer
         auth_manager = await spotify.helper.get_auth_manager(update.effective_chat.id)
         if auth_manager is not None:
-            message = await context.bot.send_message(
+            message = await telegram.sender.send_message(
                 chat_id=update.effective_chat.id,
                 text="A player is already connected to this group chat. "
                 "Disconnect it first using the /decouple command before connecting a new one",
@@ -384,7 +530,7 @@ To connect this bot to your spotify account, you have to create an app in the de
         )
 
         # send instructions in the group
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text=messages.INSTRUCTIONS_IN_PRIVATE_CHAT,
             reply_markup=InlineKeyboardMarkup(
@@ -409,7 +555,7 @@ To connect this bot to your spotify account, you have to create an app in the de
         )
 
         # send a message to the private chat of the bot
-        await context.bot.send_message(
+        await telegram.sender.send_message(
             chat_id=update.effective_user.id,
             text=messages.CLICK_THE_BUTTON_TO_AUTHORIZE,
             reply_markup=InlineKeyboardMarkup(
@@ -425,7 +571,7 @@ To connect this bot to your spotify account, you have to create an app in the de
         )
     else:
         # send a message that configuration is required
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text="Additional configuration is required, execute this command in a private chat with me.",
             reply_markup=InlineKeyboardMarkup(
@@ -445,7 +591,7 @@ To connect this bot to your spotify account, you have to create an app in the de
 @adminonly
 async def price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.chat.type == "private":
-        await context.bot.send_message(
+        await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text="The /price command only works in a group chat.",
         )
@@ -455,7 +601,7 @@ async def price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     donation = await spotify.helper.get_donation_fee(update.effective_chat.id)
 
     if update.message.text == "/price":
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             parse_mode="HTML",
             text=f"Current track price is {price}. Per requested track, {donation} sats is donated to the Jukebox Bot.",
@@ -470,7 +616,7 @@ async def price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # parse and validate the price command
     result = re.search("/price\s+([0-9]+)\s+([0-9]+)$", update.message.text)  # noqa: W605
     if result is None:
-        await context.bot.send_message(
+        await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text="Use command as follows: /price <price> <donation>\n"
             "<price> is the track price in sats\n"
@@ -489,7 +635,7 @@ async def price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await spotify.helper.set_price(update.effective_chat.id, newprice)
     await spotify.helper.set_donation_fee(update.effective_chat.id, newdonation)
 
-    message = await context.bot.send_message(
+    message = await telegram.sender.send_message(
         chat_id=update.effective_chat.id,
         text=f"Updating price to {newprice} sats. Donation amount is {newdonation} sats.",
     )
@@ -501,23 +647,25 @@ async def price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
-# display the play queue
+# view or set what the group does with tracks that were requested or played recently
 @debounce
-async def queue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@adminonly
+async def duplicates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.chat.type == "private":
-        await context.bot.send_message(
+        await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
-            text="Execute the /queue command in the group instead of the private chat.",
+            text="The /duplicates command only works in a group chat.",
         )
         return
 
-    # get an auth managher, if no auth manager is available, dump a message
-    auth_manager = await spotify.helper.get_auth_manager(update.effective_chat.id)
-    if auth_manager is None:
-        message = await context.bot.send_message(
+    result = re.search("^/duplicates(@\w+)?(\s+(\w+))?\s*$", update.message.text)  # noqa: W605
+    if result is None or (result.groups()[2] is not None and result.groups()[2] not in playqueue.helper.POLICIES):
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
-            parse_mode="HTML",
-            text="Bot not connected to player. The admin should perform the /couple command to authorize the bot.",
+            text="Use command as follows: /duplicates <policy>\n"
+            f"<policy> is what happens with a track that was requested or played in the last "
+            f"{config.duplicate_window // 60} minutes: reject it, warn about it or charge {config.duplicate_premium} "
+            "times the price. Use reject, warn or premium.",
         )
         context.job_queue.run_once(
             delete_message,
@@ -526,56 +674,105 @@ async def queue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
-    # create spotify instance
-    try:
-        sp = spotipy.Spotify(auth_manager=auth_manager)
-    # TODO: bare except
-    except:  # noqa: E722
-        message = await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="Failed to connect to music player"
+    policy = result.groups()[2]
+    if policy is None:
+        policy = playqueue.helper.get_duplicate_policy(update.effective_chat.id)
+        text = f"The policy for duplicate requests is {policy}."
+    else:
+        playqueue.helper.set_duplicate_policy(update.effective_chat.id, policy)
+        text = f"Updating the policy for duplicate requests to {policy}."
+
+    message = await telegram.sender.send_message(chat_id=update.effective_chat.id, text=text)
+    context.job_queue.run_once(
+        delete_message,
+        config.delete_message_timeout_short,
+        data={"message": message},
+    )
+
+
+# display the tracks, sats and requesters of the group over a period
+@debounce
+@adminonly
+async def show_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.chat.type == "private":
+        await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="The /analytics command only works in a group chat.",
         )
-        context.job_queue.run_once(
-            delete_message,
-            config.delete_message_timeout_medium,
-            data={"message": message},
+        return
+
+    period = context.args[0] if len(context.args) > 0 else "week"
+    if period not in analytics.helper.PERIODS:
+        await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="Use command as follows: /analytics [day|week|month]",
         )
         return
 
-    # get the current track
-    try:
-        track = sp.current_user_playing_track()
-    # TODO: bare except
-    except:  # noqa: E722
-        track = None
+    report = analytics.helper.get_report(update.effective_chat.id, period)
 
-    title = "Nothing is playing at the moment"
-    if track:
-        title = "🎵 {title} 🎵".format(title=spotify.helper.get_track_title(track["item"]))
-
-    # query the queue
-    try:
-        result = sp.queue()
-    # TODO: bare except
-    except:  # noqa: E722
-        message = await context.bot.send_message(chat_id=update.effective_chat.id, text="Failed to retrieve queue")
+    text = f"Last {period}: {report['tracks']} tracks, {report['sats']} sats, {report['users']} unique requesters\n"
+    timeformat = "%H:%M" if report["resolution"] == "hour" else "%a %d %b"
+    for bucket in report["buckets"]:
+        if bucket["tracks"] == 0:
+            continue
+        start = datetime.fromtimestamp(bucket["start"], timezone.utc).strftime(timeformat)
+        text += f" - {start} : {bucket['tracks']} tracks, {bucket['sats']} sats\n"
+
+    message = await telegram.sender.send_message(chat_id=update.effective_chat.id, text=text)
+    context.job_queue.run_once(
+        delete_message,
+        config.delete_message_timeout_long,
+        data={"message": message},
+    )
+
+
+# display the play queue
+@debounce
+async def queue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.chat.type == "private":
+        await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="Execute the /queue command in the group instead of the private chat.",
+        )
+        return
+
+    # get the player, if no player is available, dump a message
+    player = await players.get_player(update.effective_chat.id)
+    if player is None:
+        message = await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            parse_mode="HTML",
+            text="Bot not connected to player. The admin should perform the /couple command to authorize the bot.",
+        )
         context.job_queue.run_once(
             delete_message,
-            config.delete_message_timeout_medium,
+            config.delete_message_timeout_short,
             data={"message": message},
         )
         return
 
+    # the queue is kept by the bot, the player only knows the next track
+    history = await spotify.helper.get_history(update.effective_chat.id, 1)
+    title = "Nothing is playing at the moment"
+    if len(history) > 0:
+        title = f"🎵 {history[0]} 🎵"
+
+    result = playqueue.helper.get_queue(update.effective_chat.id, 10)
+
     text = ""
-    for i in range(min(10, len(result["queue"]))):
-        item = result["queue"][i]
-        text += " {count}. {title}\n".format(count=(i + 1), title=spotify.helper.get_track_title(item))
+    for i, entry in enumerate(result["entries"]):
+        text += f" {i + 1}. {entry['title']}"
+        text += f" ({entry['bid']} sats bid)\n" if entry["bid"] > 0 else "\n"
+    if result["size"] > len(result["entries"]):
+        text += f" and {result['size'] - len(result['entries'])} more\n"
 
     if len(text) == 0:
         text = title + "\nNo items in queue."
     else:
         text = title + "\nUpcoming tracks:\n" + text
 
-    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    message = await telegram.sender.send_message(chat_id=update.effective_chat.id, text=text)
     context.job_queue.run_once(
         delete_message,
         config.delete_message_timeout_medium,
@@ -583,6 +780,93 @@ async def queue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+# raise the bid of a track in the queue to move it up
+@debounce
+async def bump(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.chat.type == "private":
+        await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="Execute the /bump command in the group instead of the private chat.",
+        )
+        return
+
+    result = re.search("^/bump(@\w+)?\s+([0-9]+)\s+([0-9]+)\s*$", update.message.text)  # noqa: W605
+    if result is None or int(result.groups()[1]) == 0 or int(result.groups()[2]) == 0:
+        message = await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="Use command as follows: /bump <position> <sats>\n"
+            "<position> is the position of the track in the /queue\n"
+            "<sats> is the amount that is added to the bid of the track. Tracks with a higher bid are played first.",
+        )
+        context.job_queue.run_once(
+            delete_message,
+            config.delete_message_timeout_short,
+            data={"message": message},
+        )
+        return
+
+    position = int(result.groups()[1])
+    amount = int(result.groups()[2])
+
+    queued = playqueue.helper.get_queue(update.effective_chat.id, 1, position - 1)
+    if len(queued["entries"]) == 0:
+        message = await telegram.sender.send_message(
+            chat_id=update.effective_chat.id, text=f"There is no track at position {position} of the queue."
+        )
+        context.job_queue.run_once(
+            delete_message,
+            config.delete_message_timeout_short,
+            data={"message": message},
+        )
+        return
+
+    # the bid is paid to the owner of the player
+    sender = await users.helper.get_or_create_user(update.effective_user.id, update.effective_user.username)
+    balance = users.helper.get_cached_balance(sender)
+    if balance is not None and balance < amount:
+        message = await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="Insufficient balance, /fund your balance first to /bump a track.",
+        )
+        context.job_queue.run_once(
+            delete_message,
+            config.delete_message_timeout_short,
+            data={"message": message},
+        )
+        return
+
+    recipient = await users.helper.get_group_owner(update.effective_chat.id)
+    invoice = await invoicing.helper.create_invoice(
+        recipient, amount, f"Bid of @{sender.username} on '{queued['entries'][0]['title']}'"
+    )
+    invoice.recipient = recipient
+    invoice.user = sender
+    invoice.amount_to_pay = amount
+
+    payment = await invoicing.helper.pay_invoice(sender, invoice)
+    if not payment["result"]:
+        message = await telegram.sender.send_message(chat_id=update.effective_chat.id, text="Payment failed. Sorry.")
+        context.job_queue.run_once(
+            delete_message,
+            config.delete_message_timeout_short,
+            data={"message": message},
+        )
+        return
+
+    entry = playqueue.helper.bid(update.effective_chat.id, queued["entries"][0]["id"], amount)
+    if entry is None:
+        await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="The track was handed to the player while paying, the bid was paid to the owner.",
+        )
+        return
+
+    await telegram.sender.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"@{sender.username} raised the bid on '{entry['title']}' to {entry['bid']} sats.",
+    )
+
+
 @debounce
 @adminonly
 async def service(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -600,7 +884,7 @@ async def service(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     result = re.search("^/service \S.*", update.message.text)  # noqa: W605
     if result is None:
-        await context.bot.send_message(
+        await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text="Use the /service command as follows: /service <message>\nThe message is sent to all owners of bot",
         )
@@ -609,31 +893,8 @@ async def service(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # set message, strip the command
     msgstr = update.message.text[9:]
 
-    results = await stats.helper.get_jukebox_groups()
-    num = 0
-    for group in results["group"]:
-        # skip if no owner is set
-        if group["owner"] is None:
-            continue
-
-        # send a message each owner
-        try:
-            await context.bot.send_message(
-                chat_id=group["owner"].userid,
-                text=f"Service message from the Jukebox Bot:\n\n{msgstr}\n\nThank you!",
-            )
-            num += 1
-        except TelegramError:
-            pass
-
-    # send a message each owner
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=f"The following message was sent to {num} users:\n\n"
-        f"Service message from the Jukebox Bot:\n\n"
-        f"{msgstr}\n\n"
-        f"Thank you!",
-    )
+    # the broadcast runs as a job and reports its progress in this chat
+    await telegram.broadcast.start_broadcast(update.effective_chat.id, msgstr)
 
 
 # connect a spotify player to the bot, the setclient secret and set client id commands
@@ -643,7 +904,7 @@ async def spotify_config(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         bot_me = await context.bot.get_me()
 
         # direct the user to their private chat
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text="Like keeping your mnenomic seedphrase offline, "
             "it is better to perform these actions in a private chat with me.",
@@ -660,12 +921,11 @@ async def spotify_config(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     # get spotify config for the user
-    # TODO: This doesnt exist?
-    sps = await spotify.helper.get_spotify_config(update.effective_user.id)
+    sps = await spotify.helper.get_spotify_settings(update.effective_user.id)
 
     result = re.search("/(setclientid|setclientsecret)\s+([a-z0-9]+)\s*$", update.message.text)  # noqa: W605
     if result is None:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="Incorrect usage. ")
+        await telegram.sender.send_message(chat_id=update.effective_chat.id, text="Incorrect usage. ")
         return
 
     # after validation
@@ -682,9 +942,8 @@ async def spotify_config(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         bSave = True
 
     if bSave:
-        # TODO: doesnt exist
-        await spotify.helper.save_spotify_config(sps)
-        message = await context.bot.send_message(
+        await spotify.helper.save_spotify_settings(sps)
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text="Settings updated. Type /couple for current config and instructions.",
         )
@@ -699,7 +958,7 @@ async def fund(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if user.lnaddress is not None:
         text += f"\nYou can also fund the wallet by sending sats to the following address: {user.lnaddress}"
 
-    message = await context.bot.send_message(
+    message = await telegram.sender.send_message(
         chat_id=update.effective_chat.id,
         text=text,
         reply_markup=InlineKeyboardMarkup(
@@ -721,16 +980,16 @@ async def fund(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 @debounce
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.chat.type == "private":
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text="Execute the /history command in the group instead of the private chat.",
         )
         return
 
-    # get an auth managher, if no auth manager is available, dump a message
-    auth_manager = await spotify.helper.get_auth_manager(update.effective_chat.id)
-    if auth_manager is None:
-        message = await context.bot.send_message(
+    # get the player, if no player is available, dump a message
+    player = await players.get_player(update.effective_chat.id)
+    if player is None:
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             parse_mode="HTML",
             text="Bot not connected to player. The admin should perform the /couple command to authorize the bot.",
@@ -742,16 +1001,12 @@ async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
-    # create spotify instance
-    # TODO: unused
-    # sp = spotipy.Spotify(auth_manager=auth_manager)
-
     text = "Track history:\n"
     history = await spotify.helper.get_history(update.effective_chat.id, 20)
     for title in history:
         text += f"{title}\n"
 
-    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    message = await telegram.sender.send_message(chat_id=update.effective_chat.id, text=text)
     context.job_queue.run_once(
         delete_message,
         config.delete_message_timeout_medium,
@@ -759,6 +1014,34 @@ async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+# view the most played and best paid tracks of the group, or of all groups
+@debounce
+async def top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    overall = len(context.args) > 0 and context.args[0] == "global"
+    if update.message.chat.type == "private" and not overall:
+        await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="Execute the /top command in the group, or use /top global.",
+        )
+        return
+
+    chat_id = None if overall else update.effective_chat.id
+    text = "Most played tracks:\n"
+    for entry in leaderboard.helper.get_top(chat_id, leaderboard.helper.PLAYS):
+        text += f"{entry['score']}x {entry['title'] or entry['uri']}\n"
+    text += "\nBest paid tracks:\n"
+    for entry in leaderboard.helper.get_top(chat_id, leaderboard.helper.SATS):
+        text += f"{entry['score']} sats {entry['title'] or entry['uri']}\n"
+
+    message = await telegram.sender.send_message(chat_id=update.effective_chat.id, text=text)
+    if update.message.chat.type != "private":
+        context.job_queue.run_once(
+            delete_message,
+            config.delete_message_timeout_medium,
+            data={"message": message},
+        )
+
+
 # get lndhub link for user
 @debounce
 async def link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -766,7 +1049,7 @@ async def link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.chat.type != "private":
         bot_me = await context.bot.get_me()
 
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text="Like keeping your mnenomic seedphrase offline, "
             "it is better to request your lndhub link in a private chat with me.",
@@ -786,20 +1069,18 @@ async def link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = await users.helper.get_or_create_user(update.effective_user.id, update.effective_user.username)
 
     # create QR code for the link
-    filename = users.helper.get_qrcode_filename(user.lndhub)
-    with open(filename, "rb") as file:
-        await context.bot.send_photo(
-            update.effective_chat.id,
-            file,
-            caption="Scan this QR code with an lndhub compatible wallet like BlueWallet or Zeus.",
-            parse_mode="HTML",
-        )
+    await telegram.media.send_qrcode(
+        update.effective_chat.id,
+        user.lndhub,
+        caption="Scan this QR code with an lndhub compatible wallet like BlueWallet or Zeus.",
+        parse_mode="HTML",
+    )
 
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"<pre>{user.lndhub}</pre>",
-            parse_mode="HTML",
-        )
+    await telegram.sender.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"<pre>{user.lndhub}</pre>",
+        parse_mode="HTML",
+    )
 
 
 # pay a lightning invoice
@@ -807,7 +1088,7 @@ async def link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     result = re.search("/refund\s+(lnbc[a-z0-9]+)\s*$", update.message.text)  # noqa: W605
     if result is None:
-        await context.bot.send_message(
+        await telegram.sender.send_message(
             chat_id=update.effective_user.id,
             text="Unknown lightning invoice format. Should start with 'lnbc'.",
         )
@@ -821,11 +1102,12 @@ async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # pay the invoice
     payment_result = await config.lnbits.payInvoice(payment_request, user.adminkey)
     if payment_result["result"]:
-        await context.bot.send_message(chat_id=update.effective_user.id, text="Payment succes.")
+        users.helper.invalidate_balance(user.userid)
+        await telegram.sender.send_message(chat_id=update.effective_user.id, text="Payment succes.")
         logging.info(f"User {user.userid} paid and invoice")
     else:
         logging.warning(payment_result)
-        await context.bot.send_message(
+        await telegram.sender.send_message(
             chat_id=update.effective_user.id,
             parse_mode="HTML",
             text=payment_result["detail"],
@@ -841,7 +1123,7 @@ async def dj(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # verify that this is not a private chat
     # verify that the message is a reply
     if update.message.reply_to_message is None:
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text=f"The /dj command only works as a reply to another user. "
             f"If no amount is specified, the price for a track, "
@@ -867,9 +1149,12 @@ async def dj(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # get the user that is sending the sats and check his balance
     sender = await users.helper.get_or_create_user(update.effective_user.id, update.effective_user.username)
     balance = await users.helper.get_balance(sender)
+    if balance < amount:
+        # the cached balance might not include a recent deposit
+        balance = await users.helper.get_balance(sender, cached=False)
 
     if balance < amount:
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text="Insufficient balance, /fund your balance first to /dj another user.",
         )
@@ -890,12 +1175,13 @@ async def dj(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     invoice = await invoicing.helper.create_invoice(recipient, amount, f"@{sender.username} thinks you're a DJ!")
     invoice.recipient = recipient
     invoice.user = sender
+    invoice.amount_to_pay = amount
 
     # pay the invoice
     result = await invoicing.helper.pay_invoice(sender, invoice)
     if result["result"]:
         # send message in the group chat
-        message = await context.bot.send_message(
+        message = await telegram.sender.send_message(
             chat_id=update.effective_chat.id,
             text=f"@{sender.username} sent {amount} sats to @{recipient.username}.",
         )
@@ -903,28 +1189,24 @@ async def dj(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
         # send a message in the private chat
         if not update.message.reply_to_message.from_user.is_bot:
-            try:
-                await context.bot.send_message(
-                    chat_id=recipient.userid,
-                    text=f"Received {amount} sats from @{sender.username}.",
-                )
-            except TelegramError:
-                logging.info("Could not send message to user, probably not allowed")
+            telegram.sender.send_message(
+                chat_id=recipient.userid,
+                text=f"Received {amount} sats from @{sender.username}.",
+                priority=telegram.sender.PRIORITY_PAYMENT,
+            )
         else:
             logging.info(f"@{sender.username} is sending {amount} sats to the bot")
 
         # send a message in the private chat
-        try:
-            await context.bot.send_message(
-                chat_id=sender.userid,
-                text=f"Sent {amount} sats to  @{recipient.username}.",
-            )
-        except TelegramError:
-            logging.info("Could not send message to sender user, probably not allowed")
+        telegram.sender.send_message(
+            chat_id=sender.userid,
+            text=f"Sent {amount} sats to  @{recipient.username}.",
+            priority=telegram.sender.PRIORITY_PAYMENT,
+        )
 
         logging.info(f"User {sender.userid} sent {amount} sats to {recipient.userid}")
     else:
-        message = await context.bot.send_message(chat_id=update.effective_chat.id, text="Payment failed. Sorry.")
+        message = await telegram.sender.send_message(chat_id=update.effective_chat.id, text="Payment failed. Sorry.")
         context.job_queue.run_once(
             delete_message,
             config.delete_message_timeout_short,
@@ -932,6 +1214,30 @@ async def dj(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
 
 
+# send the URL that music players of the group connect to, a new URL replaces the previous one
+@debounce
+@adminonly
+async def player(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.chat.type == "private":
+        await telegram.sender.send_message(
+            chat_id=update.effective_chat.id,
+            text="The /player command only works in a group chat.",
+        )
+        return
+
+    token = players.remote.create_token(update.effective_chat.id)
+    await telegram.sender.send_message(
+        chat_id=update.effective_user.id,
+        text=f"Music players of {update.effective_chat.title} connect to wss://{config.domain}/player/{token}. "
+        "Players that use a previous URL are not accepted anymore when they reconnect.",
+    )
+    message = await telegram.sender.send_message(
+        chat_id=update.effective_chat.id,
+        text="The URL for music players was sent to you in a private chat.",
+    )
+    context.job_queue.run_once(delete_message, config.delete_message_timeout_short, data={"message": message})
+
+
 @debounce
 async def web(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -941,28 +1247,12 @@ async def web(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     jukebox_url = f"https://{config.domain}/jukebox/web/{update.effective_chat.id}"
-    filename = os.path.join(const.QR_CODE_DIR, f"web_url_{update.effective_chat.id}.png")
-
-    if not os.path.isfile(filename):
-        img_bg = Image.open("../assets/web_jukebox_template.png")
-        qr = qrcode.QRCode(box_size=7, border=0)
-        qr.add_data(jukebox_url)
-        qr.make()
-        img_qr = qr.make_image()
-        pos = (
-            int((img_bg.size[0] - img_qr.size[0]) / 2),
-            385 - int(img_qr.size[1] / 2),
-        )
-        img_bg.paste(img_qr, pos)
-        img_bg.save(filename)
-
-    with open(filename, "rb") as file:
-        message = await context.bot.send_photo(
-            update.effective_chat.id,
-            file,
-            caption=f"Access this Jukebox directly at the following URL: {jukebox_url}. "
-            f"Pro tip: print out this image and scan it with your phone.",
-            parse_mode="HTML",
-        )
+    message = await telegram.media.send_web_poster(
+        update.effective_chat.id,
+        jukebox_url,
+        caption=f"Access this Jukebox directly at the following URL: {jukebox_url}. "
+        f"Pro tip: print out this image and scan it with your phone.",
+        parse_mode="HTML",
+    )
 
     context.job_queue.run_once(delete_message, config.delete_message_timeout_long, data={"message": message})
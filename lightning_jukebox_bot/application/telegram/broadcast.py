@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import random
+import string
+
+from telegram.error import BadRequest, Forbidden, TelegramError
+from telegram.ext import ContextTypes
+
+from lightning_jukebox_bot.application import redis
+from lightning_jukebox_bot.settings import config
+
+from . import sender
+from .application import app
+
+logger = logging.getLogger(__name__)
+
+# users that blocked the bot or no longer exist
+BOUNCED_KEY = "broadcast:bounced"
+
+# broadcasts that have not finished yet
+RUNNING_KEY = "broadcast:running"
+
+
+def _rediskey(job_id: str) -> str:
+    return f"broadcast:{job_id}"
+
+
+def _progress_text(text: str, state: dict) -> str:
+    return (
+        f"Service message: sent {state['sent']}, skipped {state['skipped']}, failed {state['failed']}. "
+        f"{'Done.' if state['status'] == 'done' else 'Sending...'}\n\n{text}"
+    )
+
+
+async def start_broadcast(chat_id: int, text: str) -> str:
+    """
+    Start sending a service message to all owners of a group. Progress is reported in chat_id
+    """
+    job_id = "".join(random.sample(string.ascii_letters, 12))
+    message = await sender.send_message(chat_id=chat_id, text="Service message: starting...")
+
+    redis.cache.hset(
+        _rediskey(job_id),
+        mapping={
+            "text": text,
+            "chat_id": chat_id,
+            "message_id": message.id if message is not None else 0,
+            "cursor": 0,
+            "status": "running",
+            "sent": 0,
+            "skipped": 0,
+            "failed": 0,
+        },
+    )
+    redis.cache.sadd(RUNNING_KEY, job_id)
+
+    app.job_queue.run_once(run_broadcast, 0, data=job_id)
+    return job_id
+
+
+async def _deliver(userid: int, text: str) -> str:
+    try:
+        await sender.send_message(
+            chat_id=userid,
+            text=f"Service message from the Jukebox Bot:\n\n{text}\n\nThank you!",
+            raise_errors=True,
+        )
+        return "sent"
+    except Forbidden:
+        # the user blocked the bot
+        redis.cache.sadd(BOUNCED_KEY, userid)
+        return "skipped"
+    except BadRequest as e:
+        if "chat not found" in str(e).lower():
+            redis.cache.sadd(BOUNCED_KEY, userid)
+            return "skipped"
+        logger.warning(f"Could not send service message to {userid}: {e}")
+        return "failed"
+    except TelegramError as e:
+        logger.warning(f"Could not send service message to {userid}: {e}")
+        return "failed"
+
+
+async def run_broadcast(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    This function sends the service message page by page. After each page the scan cursor is stored, so that an
+    interrupted broadcast continues where it stopped
+    """
+    job_id = context.job.data
+    rediskey = _rediskey(job_id)
+    seenkey = f"{rediskey}:seen"
+
+    data = redis.cache.hgetall(rediskey)
+    if not data:
+        logger.error(f"Broadcast {job_id} does not exist")
+        redis.cache.srem(RUNNING_KEY, job_id)
+        return
+
+    state = {key.decode("utf-8"): value.decode("utf-8") for key, value in data.items()}
+    if state["status"] == "done":
+        redis.cache.srem(RUNNING_KEY, job_id)
+        return
+
+    text = state["text"]
+    chat_id = int(state["chat_id"])
+    message_id = int(state["message_id"])
+    cursor = int(state["cursor"])
+    logger.info(f"Running broadcast {job_id} from cursor {cursor}")
+
+    while True:
+        cursor, keys = redis.cache.scan(cursor, match="group:*", count=config.broadcast_batch_size)
+
+        # get all owners of this page in one round trip
+        pipe = redis.cache.pipeline()
+        for key in keys:
+            pipe.hget(key, "owner")
+        owners = {int(owner) for owner in pipe.execute() if owner is not None}
+
+        # skip owners that already got the message on an earlier page and owners that bounced before
+        recipients = []
+        skipped = 0
+        if len(owners) > 0:
+            owners = list(owners)
+            pipe = redis.cache.pipeline()
+            pipe.smismember(seenkey, owners)
+            pipe.smismember(BOUNCED_KEY, owners)
+            [seen, bounced] = pipe.execute()
+            for owner, is_seen, is_bounced in zip(owners, seen, bounced):
+                if is_seen:
+                    continue
+                if is_bounced:
+                    skipped += 1
+                    continue
+                recipients.append(owner)
+
+        # the sender enforces the rate limits
+        results = await asyncio.gather(*[_deliver(userid, text) for userid in recipients])
+
+        pipe = redis.cache.pipeline()
+        if len(owners) > 0:
+            pipe.sadd(seenkey, *owners)
+        pipe.hincrby(rediskey, "sent", results.count("sent"))
+        pipe.hincrby(rediskey, "skipped", skipped + results.count("skipped"))
+        pipe.hincrby(rediskey, "failed", results.count("failed"))
+        pipe.hset(rediskey, "cursor", cursor)
+        if cursor == 0:
+            pipe.hset(rediskey, "status", "done")
+        pipe.execute()
+
+        state = {key.decode("utf-8"): value.decode("utf-8") for key, value in redis.cache.hgetall(rediskey).items()}
+        if message_id != 0:
+            sender.edit_message_text(_progress_text(text, state), chat_id=chat_id, message_id=message_id)
+
+        if cursor == 0:
+            break
+
+    logger.info(f"Broadcast {job_id} done: {state['sent']} sent, {state['skipped']} skipped, {state['failed']} failed")
+    redis.cache.srem(RUNNING_KEY, job_id)
+    redis.cache.delete(seenkey)
+    redis.cache.expire(rediskey, 7 * 24 * 3600)
+
+
+async def resume_broadcasts(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Resume broadcasts that were interrupted by a restart
+    """
+    for job_id in redis.cache.smembers(RUNNING_KEY):
+        job_id = job_id.decode("utf-8")
+        logger.info(f"Resuming broadcast {job_id}")
+        context.job_queue.run_once(run_broadcast, 0, data=job_id)
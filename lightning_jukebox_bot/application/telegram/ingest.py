@@ -0,0 +1,130 @@
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+
+from telegram import Update
+
+from lightning_jukebox_bot.application import tracing
+from lightning_jukebox_bot.settings import config
+
+from .application import app
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDispatcher:
+    """
+    This class buffers incoming updates and processes them with a fixed number of workers. Updates of the same chat
+    are processed in order, one at a time, while different chats are processed in parallel. Chats take turns, so a
+    flooded chat does not starve the others.
+
+    The buffer is bounded in total and per chat, when it is full new updates are refused.
+    """
+
+    def __init__(self, process, workers: int, capacity: int, per_chat: int):
+        self._process = process
+        self._workers = workers
+        self._capacity = capacity
+        self._per_chat = per_chat
+        self._chats = {}
+        self._ready = None
+        self._tasks = []
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def saturated(self) -> bool:
+        return self._size >= self._capacity
+
+    @staticmethod
+    def _key(update: Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return update.update_id
+
+    def submit(self, update: Update) -> bool:
+        """
+        Add an update to the buffer, returns False when there is no room for it
+        """
+        if self.saturated():
+            return False
+
+        key = self._key(update)
+        pending = self._chats.get(key)
+        if pending is None:
+            pending = deque()
+            self._chats[key] = pending
+            self._ready.put_nowait(key)
+        elif len(pending) >= self._per_chat:
+            return False
+
+        pending.append((update, monotonic()))
+        self._size += 1
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            update, submitted = pending.popleft()
+            try:
+                queued_ms = round((monotonic() - submitted) * 1000, 3)
+                with tracing.trace("telegram update", update_id=update.update_id, chat_id=key, queued_ms=queued_ms):
+                    await self._process(update)
+            except Exception:
+                logger.exception(f"Unhandled exception while processing update {update.update_id}")
+            finally:
+                self._size -= 1
+                # go to the back of the line when the chat has more updates
+                if len(pending) > 0:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+
+    async def start(self) -> None:
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self._workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        if self._size > 0:
+            logger.warning(f"Dropping {self._size} unprocessed updates")
+        self._chats.clear()
+        self._size = 0
+
+
+dispatcher = UpdateDispatcher(
+    app.process_update,
+    config.telegram_update_workers,
+    config.telegram_update_queue_size,
+    config.telegram_update_queue_per_chat,
+)
+
+
+def saturated() -> bool:
+    return dispatcher.saturated()
+
+
+def size() -> int:
+    return dispatcher.size
+
+
+def submit(update: Update) -> bool:
+    return dispatcher.submit(update)
+
+
+async def start() -> None:
+    await dispatcher.start()
+
+
+async def stop() -> None:
+    await dispatcher.stop()
@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import qrcode
+from PIL import Image
+from telegram import Message
+from telegram.error import BadRequest
+
+from lightning_jukebox_bot.application import redis
+from lightning_jukebox_bot.settings import config, const
+
+from . import sender
+
+logger = logging.getLogger(__name__)
+
+# maps the digest of the content of a photo to the file_id telegram assigned to it
+FILE_ID_KEY = "telegram:file_ids"
+
+# PIL and qrcode are synchronous, images are rendered in a pool to keep the event loop responsive
+executor = ThreadPoolExecutor(max_workers=config.image_workers, thread_name_prefix="media")
+
+web_template = None
+web_template_digest = None
+
+
+def load_templates() -> None:
+    """
+    Decode the template images once, renders work on a copy
+    """
+    global web_template, web_template_digest
+
+    try:
+        with open(const.WEB_TEMPLATE_PATH, "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        logger.warning(f"Template {const.WEB_TEMPLATE_PATH} not found, the web url is sent as a plain QR code")
+        return
+
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    web_template = image
+    web_template_digest = hashlib.sha256(data).hexdigest()
+
+
+def get_digest(*parts) -> str:
+    """
+    Returns the digest of the data a photo is rendered from
+    """
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def _to_png(image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def render_qrcode(data: str) -> bytes:
+    return _to_png(qrcode.make(data))
+
+
+def render_web_poster(url: str) -> bytes:
+    img_bg = web_template.copy()
+    qr = qrcode.QRCode(box_size=7, border=0)
+    qr.add_data(url)
+    qr.make()
+    img_qr = qr.make_image()
+    pos = (
+        int((img_bg.size[0] - img_qr.size[0]) / 2),
+        385 - int(img_qr.size[1] / 2),
+    )
+    img_bg.paste(img_qr, pos)
+    return _to_png(img_bg)
+
+
+async def send_cached_photo(chat_id: int, digest: str, render, *args, **kwargs) -> Message:
+    """
+    Send a photo that is rendered by render(*args). When the same content was sent before, only the telegram
+    file_id is sent and nothing is rendered or uploaded
+    """
+    file_id = redis.cache.hget(FILE_ID_KEY, digest)
+    if file_id is not None:
+        try:
+            return await sender.send_photo(chat_id, file_id.decode("utf-8"), raise_errors=True, **kwargs)
+        except BadRequest as e:
+            logger.warning(f"Cached file_id was rejected, uploading the photo again: {e}")
+            redis.cache.hdel(FILE_ID_KEY, digest)
+
+    photo = await asyncio.get_running_loop().run_in_executor(executor, render, *args)
+    message = await sender.send_photo(chat_id, photo, **kwargs)
+    if message is not None and len(message.photo) > 0:
+        redis.cache.hset(FILE_ID_KEY, digest, message.photo[-1].file_id)
+    return message
+
+
+async def send_qrcode(chat_id: int, data: str, **kwargs) -> Message:
+    return await send_cached_photo(chat_id, get_digest("qrcode", data), render_qrcode, data, **kwargs)
+
+
+async def send_web_poster(chat_id: int, url: str, **kwargs) -> Message:
+    if web_template is None:
+        return await send_qrcode(chat_id, url, **kwargs)
+    digest = get_digest("web", web_template_digest, url)
+    return await send_cached_photo(chat_id, digest, render_web_poster, url, **kwargs)
@@ -0,0 +1,340 @@
+import asyncio
+import itertools
+import logging
+from datetime import timedelta
+from time import monotonic
+
+from telegram.error import RetryAfter, TelegramError
+
+from lightning_jukebox_bot.application import tracing
+from lightning_jukebox_bot.settings import config
+
+from .application import app
+
+logger = logging.getLogger(__name__)
+
+# priority classes, lower values are delivered first
+PRIORITY_PAYMENT = 0
+PRIORITY_NOW_PLAYING = 1
+PRIORITY_CHATTER = 2
+
+# seconds the calls in flight get to finish when the sender stops
+STOP_TIMEOUT = 5
+
+
+class TokenBucket:
+    """
+    A token bucket that refills at `rate` tokens per second up to `capacity` tokens
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """
+        Returns the number of seconds until a token is available
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """
+        Make the next token available no sooner than `seconds` seconds from now
+        """
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class OutboundMessage:
+    def __init__(self, priority: int, method: str, chat_id: int, kwargs: dict, raise_errors: bool = False):
+        self.priority = priority
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.raise_errors = raise_errors
+        self.future = asyncio.get_running_loop().create_future()
+        self.seq = None
+        # waiting for a token of its chat, _requeue puts it back in the queue
+        self.deferred = False
+        # the message is part of the trace it was sent from until it is delivered
+        self.span = tracing.start_span(f"telegram {method}", chat_id=chat_id)
+        if self.span is not None:
+            self.future.add_done_callback(lambda _: self.span.end())
+
+
+class OutboundSender:
+    """
+    This class schedules all outbound messages to Telegram so that the flood limits are respected. Messages are
+    delivered in order of priority, limited by a token bucket per chat and a global token bucket. Edits of the same
+    message that have not been delivered yet are collapsed into one edit.
+
+    A RetryAfter from telegram pauses the chat it was sent to. When a second chat gets one while the first is still
+    paused the bot as a whole is over the limit, and all messages are paused.
+
+    All methods return a future that resolves to the result of the Telegram call, or None when delivery failed.
+    With raise_errors the future raises the exception instead.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._queue = None
+        self._seq = itertools.count()
+        self._task = None
+        self._semaphore = None
+        self._global = TokenBucket(config.telegram_global_rate, config.telegram_global_rate)
+        self._chats = {}
+        self._pending_edits = {}
+        self._paused_until = 0
+        # the chats paused by a RetryAfter and until when
+        self._flooded = {}
+        self._deliveries = set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # group chats have negative ids and a stricter limit than private chats
+            if int(chat_id) < 0:
+                bucket = TokenBucket(config.telegram_group_rate / 60, config.telegram_group_burst)
+            else:
+                bucket = TokenBucket(config.telegram_private_rate, config.telegram_private_rate)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    @property
+    def size(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _put(self, item: OutboundMessage) -> None:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if item.seq is None:
+            item.seq = next(self._seq)
+        self._queue.put_nowait((item.priority, item.seq, item))
+
+    def _submit(
+        self, priority: int, method: str, chat_id: int, kwargs: dict, raise_errors: bool = False
+    ) -> asyncio.Future:
+        item = OutboundMessage(priority, method, chat_id, kwargs, raise_errors)
+        self._put(item)
+        return item.future
+
+    def send_message(
+        self, chat_id: int, text: str, priority: int = PRIORITY_CHATTER, raise_errors: bool = False, **kwargs
+    ) -> asyncio.Future:
+        kwargs = {"chat_id": chat_id, "text": text, **kwargs}
+        return self._submit(priority, "send_message", chat_id, kwargs, raise_errors)
+
+    def send_photo(
+        self, chat_id: int, photo, priority: int = PRIORITY_CHATTER, raise_errors: bool = False, **kwargs
+    ) -> asyncio.Future:
+        kwargs = {"chat_id": chat_id, "photo": photo, **kwargs}
+        return self._submit(priority, "send_photo", chat_id, kwargs, raise_errors)
+
+    def send_document(
+        self, chat_id: int, document, priority: int = PRIORITY_CHATTER, raise_errors: bool = False, **kwargs
+    ) -> asyncio.Future:
+        kwargs = {"chat_id": chat_id, "document": document, **kwargs}
+        return self._submit(priority, "send_document", chat_id, kwargs, raise_errors)
+
+    def edit_message_text(
+        self, text: str, chat_id: int, message_id: int, priority: int = PRIORITY_NOW_PLAYING, **kwargs
+    ) -> asyncio.Future:
+        """
+        Edit the text of a message. When an edit of the same message is still waiting to be delivered,
+        that edit is replaced by this one
+        """
+        kwargs = {"text": text, "chat_id": chat_id, "message_id": message_id, **kwargs}
+        key = (chat_id, message_id)
+        item = self._pending_edits.get(key)
+        if item is not None:
+            item.kwargs = kwargs
+            if priority < item.priority:
+                item.priority = priority
+                # the queued entry keeps its original priority, requeue it at the new one. A deferred edit is put
+                # back at the new priority when it is due
+                if not item.deferred:
+                    item.seq = next(self._seq)
+                    self._put(item)
+            return item.future
+
+        item = OutboundMessage(priority, "edit_message_text", chat_id, kwargs)
+        self._pending_edits[key] = item
+        self._put(item)
+        return item.future
+
+    def _requeue(self, item: OutboundMessage) -> None:
+        item.deferred = False
+        if self._task is None:
+            # the sender was stopped while the message was deferred
+            if not item.future.done():
+                item.future.set_result(None)
+            return
+        self._put(item)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            _, seq, item = await self._queue.get()
+
+            # skip stale entries of edits that were requeued at a higher priority
+            if item.future.done() or item.seq != seq:
+                continue
+
+            # honour a RetryAfter from telegram for all chats
+            pause = self._paused_until - loop.time()
+            if pause > 0:
+                await asyncio.sleep(pause)
+
+            # defer the message when the chat has no tokens left, other chats can continue
+            delay = self._chat_bucket(item.chat_id).delay()
+            if delay > 0:
+                item.seq = next(self._seq)
+                item.deferred = True
+                loop.call_later(delay, self._requeue, item)
+                continue
+
+            delay = self._global.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self._global.consume()
+            self._chat_bucket(item.chat_id).consume()
+            if item.method == "edit_message_text":
+                self._pending_edits.pop((item.chat_id, item.kwargs["message_id"]), None)
+
+            await self._semaphore.acquire()
+            task = asyncio.create_task(self._deliver(item))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    def _flood(self, chat_id: int, retry_after: float) -> None:
+        now = asyncio.get_running_loop().time()
+        self._flooded = {chat: until for chat, until in self._flooded.items() if until > now and chat != chat_id}
+        if len(self._flooded) > 0:
+            logger.warning(f"Flood control exceeded, pausing all outbound messages for {retry_after} seconds")
+            self._paused_until = max(self._paused_until, now + retry_after)
+        else:
+            logger.warning(f"Flood control exceeded, pausing outbound messages to {chat_id} for {retry_after} seconds")
+        self._flooded[chat_id] = now + retry_after
+        self._chat_bucket(chat_id).pause(retry_after)
+
+    async def _deliver(self, item: OutboundMessage) -> None:
+        result = None
+        try:
+            with tracing.activate(item.span):
+                result = await getattr(self.bot, item.method)(**item.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            self._flood(item.chat_id, retry_after)
+            if item.method == "edit_message_text":
+                # a newer edit might have been queued in the mean time, that one wins
+                key = (item.chat_id, item.kwargs["message_id"])
+                if key in self._pending_edits:
+                    item.future.set_result(None)
+                    return
+                self._pending_edits[key] = item
+            self._requeue(item)
+            return
+        except TelegramError as e:
+            if item.raise_errors:
+                item.future.set_exception(e)
+                return
+            logger.warning(f"Could not deliver {item.method} to chat {item.chat_id}: {e}")
+        except Exception as e:
+            if item.raise_errors:
+                item.future.set_exception(e)
+                return
+            logger.exception(f"Could not deliver {item.method} to chat {item.chat_id}")
+        except asyncio.CancelledError:
+            # the sender stopped before the call returned
+            item.future.set_result(None)
+            raise
+        finally:
+            self._semaphore.release()
+
+        if not item.future.done():
+            item.future.set_result(result)
+
+    async def start(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._semaphore = asyncio.Semaphore(config.max_connections)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # let the calls in flight finish, a message deferred by a RetryAfter is not requeued anymore
+        if len(self._deliveries) > 0:
+            _, pending = await asyncio.wait(self._deliveries, timeout=STOP_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        # resolve everything that was not delivered
+        while self._queue is not None and not self._queue.empty():
+            _, _, item = self._queue.get_nowait()
+            if not item.future.done():
+                item.future.set_result(None)
+        self._pending_edits.clear()
+
+
+outbound = OutboundSender(app.bot)
+
+
+def send_message(
+    chat_id: int, text: str, priority: int = PRIORITY_CHATTER, raise_errors: bool = False, **kwargs
+) -> asyncio.Future:
+    return outbound.send_message(chat_id, text, priority, raise_errors, **kwargs)
+
+
+def send_photo(
+    chat_id: int, photo, priority: int = PRIORITY_CHATTER, raise_errors: bool = False, **kwargs
+) -> asyncio.Future:
+    return outbound.send_photo(chat_id, photo, priority, raise_errors, **kwargs)
+
+
+def send_document(
+    chat_id: int, document, priority: int = PRIORITY_CHATTER, raise_errors: bool = False, **kwargs
+) -> asyncio.Future:
+    return outbound.send_document(chat_id, document, priority, raise_errors, **kwargs)
+
+
+def edit_message_text(
+    text: str, chat_id: int, message_id: int, priority: int = PRIORITY_NOW_PLAYING, **kwargs
+) -> asyncio.Future:
+    return outbound.edit_message_text(text, chat_id, message_id, priority, **kwargs)
+
+
+def size() -> int:
+    return outbound.size
+
+
+async def start() -> None:
+    await outbound.start()
+
+
+async def stop() -> None:
+    await outbound.stop()
@@ -1,17 +1,26 @@
-import json
 import logging
-import random
 
 import aiomqtt
-import spotipy
 from aiomqtt import MqttError
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.error import TelegramError
 from telegram.ext import ContextTypes
 
-from lightning_jukebox_bot.application import invoicing, spotify, users
-from lightning_jukebox_bot.application.invoicing.helper import Invoice
-from lightning_jukebox_bot.application.telegram import app, helper, messages
+from lightning_jukebox_bot.application import (
+    donations,
+    invoicing,
+    live,
+    metrics,
+    players,
+    playqueue,
+    redis,
+    spotify,
+    stats,
+    users,
+)
+from lightning_jukebox_bot.application.lnbits import LNbitsUnavailable
+from lightning_jukebox_bot.application.telegram import helper, messages, sender
+from lightning_jukebox_bot.application.telegram.application import app
 from lightning_jukebox_bot.application.telegram.helper import TelegramCommand
 from lightning_jukebox_bot.settings import config
 
@@ -69,7 +78,7 @@ def adminonly(func):
             return
 
         # say to user to go away
-        message = await context.bot.send_message(chat_id=update.effective_chat.id, text=messages.you_are_not_admin)
+        message = await sender.send_message(chat_id=update.effective_chat.id, text=messages.you_are_not_admin)
         context.job_queue.run_once(
             delete_message,
             config.delete_message_timeout_short,
@@ -90,6 +99,20 @@ async def delete_message(context: ContextTypes.DEFAULT_TYPE):
         logging.warning("Could not delete message")
 
 
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    This function tells the user when LNbits or the player is down, other errors are logged
+    """
+    if not isinstance(context.error, (LNbitsUnavailable, players.PlayerUnavailable)):
+        logger.error("Exception while handling an update", exc_info=context.error)
+        return
+
+    logger.warning(f"Service unavailable while handling an update: {context.error}")
+    if isinstance(update, Update) and update.effective_chat is not None:
+        message = await sender.send_message(chat_id=update.effective_chat.id, text=str(context.error))
+        context.job_queue.run_once(delete_message, config.delete_message_timeout_medium, data={"message": message})
+
+
 # callback for button presses
 async def callback_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -107,7 +130,7 @@ async def callback_button(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     command = helper.get_command(key)
 
     if command is None:
-        logging.info("Command is None")
+        logging.debug("Command is None")
         return
 
     # parse the callback data.
@@ -134,14 +157,14 @@ async def callback_button(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         invoice = command.data
         if invoice is not None:
             await invoicing.helper.delete_invoice(invoice.payment_hash)
+            playqueue.helper.release(invoice.chat_id, invoice.spotify_uri_list)
         return
 
     # the commands from here on modify a list of tracks to be queue
-    # and we have to check hat we have spotify available
-    # get an auth managher, if no auth manager is available, dump a message
-    auth_manager = await spotify.helper.get_auth_manager(update.effective_chat.id)
-    if auth_manager is None:
-        message = await context.bot.send_message(
+    # and we have to check that we have a player available, if not, dump a message
+    player = await players.get_player(update.effective_chat.id)
+    if player is None:
+        message = await sender.send_message(
             chat_id=update.effective_chat.id,
             parse_mode="HTML",
             text="Bot not connected to player. The admin should perform the /couple command to authorize the bot.",
@@ -153,13 +176,9 @@ async def callback_button(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
-    # create spotify instance
-    sp = spotipy.Spotify(auth_manager=auth_manager)
-
     # verify that player is available, otherwise it has no use to queue a track
-    track = sp.current_user_playing_track()
-    if track is None:
-        message = await context.bot.send_message(
+    if await player.now_playing() is None:
+        message = await sender.send_message(
             chat_id=update.effective_chat.id,
             parse_mode="HTML",
             text="Player is not active at the moment. Payment aborted.",
@@ -171,71 +190,100 @@ async def callback_button(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
-    # Play a random track from a playli st
+    # the tracks to add with their titles
     spotify_uri_list = []
+    titles = []
     if command.command == helper.add:
         # add a single track to the list
         spotify_uri_list = [command.data]
+        titles = [track.title for track in await player.tracks(spotify_uri_list) if track is not None]
         await update.callback_query.delete_message()
     elif command.command == helper.playrandom:
-        playlistid = command.data
-        result = sp.playlist_items(playlistid, offset=0, limit=1)
-        idxs = random.sample(range(0, result["total"]), 1)
-        for idx in idxs:
-            result = sp.playlist_items(playlistid, offset=idx, limit=1)
-            for item in result["items"]:
-                spotify_uri_list.append(item["track"]["uri"])
+        # distinct random tracks from the cached playlist, the titles come with them
+        [playlistid, count] = command.data
+        tracks = await players.sample_playlist(player, playlistid, count)
+        spotify_uri_list = [track.uri for track in tracks]
+        titles = [track.title for track in tracks]
     else:
         logging.error(f"Unknown command: {command.command}")
         return
 
+    if len(spotify_uri_list) == 0 or len(titles) < len(spotify_uri_list):
+        message = await sender.send_message(chat_id=update.effective_chat.id, text="No tracks found to add.")
+        context.job_queue.run_once(
+            delete_message,
+            config.delete_message_timeout_short,
+            data={"message": message},
+        )
+        return
+
+    # tracks that were requested or played recently are handled by the policy of the group
+    duplicates = playqueue.helper.claim(update.effective_chat.id, spotify_uri_list)
+    policy = playqueue.helper.get_duplicate_policy(update.effective_chat.id) if len(duplicates) > 0 else None
+    if policy is not None:
+        duplicate_titles = ",".join(f"'{title}'" for uri, title in zip(spotify_uri_list, titles) if uri in duplicates)
+        minutes = config.duplicate_window // 60
+        if policy == playqueue.helper.REJECT:
+            text = f"{duplicate_titles} was requested or played in the last {minutes} minutes and is not added again."
+        elif policy == playqueue.helper.PREMIUM:
+            text = (
+                f"{duplicate_titles} was requested or played in the last {minutes} minutes "
+                f"and costs {config.duplicate_premium} times the price."
+            )
+        else:
+            text = f"{duplicate_titles} was requested or played in the last {minutes} minutes."
+        message = await sender.send_message(chat_id=update.effective_chat.id, text=text)
+        context.job_queue.run_once(
+            delete_message,
+            config.delete_message_timeout_short,
+            data={"message": message},
+        )
+        if policy == playqueue.helper.REJECT:
+            return
+
     # validate payment conditions
     payment_required = True
-    amount_to_pay = int((await spotify.helper.get_price(update.effective_chat.id)) * len(spotify_uri_list))
-    logging.info(f"Amount to pay = {amount_to_pay}")
+    price = await spotify.helper.get_price(update.effective_chat.id)
+    amount_to_pay = int(price * len(spotify_uri_list))
+    if policy == playqueue.helper.PREMIUM:
+        amount_to_pay += int(price * (config.duplicate_premium - 1) * len(duplicates))
+    logging.debug(f"Amount to pay = {amount_to_pay}")
     if amount_to_pay == 0:
         payment_required = False
 
-    # if no payment required, add the tracks to the queue one by one
-    if not payment_required:
-        spotify.helper.add_to_queue(sp, spotify_uri_list)
-
-        for uri in spotify_uri_list:
-            tracktitle = spotify.helper.get_track_title(sp.track(uri))
+    # create an invoice title
+    invoice_title = ",".join(f"'{title}'" for title in titles)
 
-            try:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    parse_mode="HTML",
-                    text=f"@{update.effective_user.username} added '{tracktitle}' to the queue.",
-                )
-            except TelegramError:
-                pass
+    # if no payment required, add the tracks to the queue
+    if not payment_required:
+        await playqueue.helper.enqueue(
+            update.effective_chat.id, update.effective_user.id, list(zip(spotify_uri_list, titles)), player
+        )
+        live.publish_added(update.effective_chat.id, update.effective_user.username, titles)
+        stats.helper.add_tracks(update.effective_chat.id, update.effective_user.id, spotify_uri_list, 0)
 
-            try:
-                await context.bot.send_message(
-                    chat_id=update.effective_user.id,
-                    parse_mode="HTML",
-                    text=f"You added '{tracktitle}' to the queue for {amount_to_pay} sats.",
-                )
-            except TelegramError:
-                pass
+        sender.send_message(
+            chat_id=update.effective_chat.id,
+            parse_mode="HTML",
+            text=f"@{update.effective_user.username} added {invoice_title} to the queue.",
+        )
+        sender.send_message(
+            chat_id=update.effective_user.id,
+            parse_mode="HTML",
+            text=f"You added {invoice_title} to the queue for {amount_to_pay} sats.",
+        )
 
-            try:
+        try:
+            with metrics.track_dependency("mqtt", "publish"):
                 async with aiomqtt.Client("localhost") as client:
-                    await client.publish(f"{update.effective_chat.id}/added_to_queue", payload=tracktitle)
-            except MqttError:
-                logging.error("Exception when publishing queue add to mqtt")
-                pass
+                    await client.publish(f"{update.effective_chat.id}/added_to_queue", payload=invoice_title)
+        except MqttError:
+            logging.error("Exception when publishing queue add to mqtt")
+            pass
 
         # return
         return
 
-    # create an invoice title
-    invoice_title = f"'{spotify.helper.get_track_title(sp.track(spotify_uri_list[0]))}'"
-    for i in range(1, len(spotify_uri_list)):
-        invoice_title += f",'{spotify.helper.get_track_title(sp.track(spotify_uri_list[0]))}'"
-
     # create the invoice
     # the owner is the one that has his spotify player connected
     recipient = await users.helper.get_group_owner(update.effective_chat.id)
@@ -251,39 +299,59 @@ async def callback_button(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     invoice.chat_id = update.effective_chat.id
     invoice.amount_to_pay = amount_to_pay
 
-    # pay the invoice
-    payment_result = await invoicing.helper.pay_invoice(invoice.user, invoice)
+    # saved before the payment, when the answer of LNbits is lost the webhook and the poller still find the invoice
+    await invoicing.helper.save_invoice(invoice)
+
+    # pay the invoice, unless the balance is known to be insufficient
+    unconfirmed = False
+    balance = users.helper.get_cached_balance(invoice.user)
+    if balance is not None and balance < amount_to_pay:
+        payment_result = {"result": False, "detail": "Insufficient balance."}
+    else:
+        try:
+            payment_result = await invoicing.helper.pay_invoice(invoice.user, invoice)
+        except LNbitsUnavailable:
+            # the payment may have gone through, the poller of the invoice finds out
+            logging.warning(f"The payment of invoice {invoice.payment_hash} was not confirmed, checking it later")
+            unconfirmed = True
+            payment_result = {"result": False, "detail": "Payment not confirmed."}
 
     # if payment success
     if payment_result["result"]:
-        spotify.helper.add_to_queue(sp, spotify_uri_list)
-        await context.bot.send_message(
+        # the webhook of LNbits may have handled the paid invoice already
+        if not await invoicing.helper.delete_invoice(invoice.payment_hash):
+            return
+
+        await playqueue.helper.enqueue(
+            update.effective_chat.id, update.effective_user.id, list(zip(spotify_uri_list, titles)), player
+        )
+        live.publish_added(update.effective_chat.id, update.effective_user.username, titles)
+        stats.helper.add_tracks(update.effective_chat.id, update.effective_user.id, spotify_uri_list, amount_to_pay)
+        sender.send_message(
             chat_id=update.effective_chat.id,
             parse_mode="HTML",
             text=f"@{update.effective_user.username} added {invoice_title} to the queue.",
+            priority=sender.PRIORITY_PAYMENT,
+        )
+        sender.send_message(
+            chat_id=update.effective_user.id,
+            parse_mode="HTML",
+            text=f"You paid {amount_to_pay} sats for {invoice_title}.",
+            priority=sender.PRIORITY_PAYMENT,
         )
-        try:
-            await context.bot.send_message(
-                chat_id=update.effective_user.id,
-                parse_mode="HTML",
-                text=f"You paid {amount_to_pay} sats for {invoice_title}.",
-            )
-        except TelegramError:
-            logging.info("Could not send message to user")
 
         try:
-            async with aiomqtt.Client("localhost") as client:
-                await client.publish(f"{update.effective_chat.id}/added_to_queue", payload=invoice_title)
+            with metrics.track_dependency("mqtt", "publish"):
+                async with aiomqtt.Client("localhost") as client:
+                    await client.publish(f"{update.effective_chat.id}/added_to_queue", payload=invoice_title)
         except MqttError:
             logging.error("Exception when publishing queue add to mqtt")
             pass
 
-        # make donation to the bot
-        jukeboxbot = await users.helper.get_or_create_user(config.bot_id)
-        donation_amount: int = await spotify.helper.get_donation_fee(invoice.chat_id)
-        donation_amount = min(donation_amount, invoice.amount_to_pay)
-        donation_invoice = await invoicing.helper.create_invoice(jukeboxbot, donation_amount, "donation to the bot")
-        result = await invoicing.helper.pay_invoice(recipient, donation_invoice)
+        # record the donation to the bot, it is settled in the background
+        await donations.helper.record_donation(
+            recipient.userid, invoice.chat_id, invoice.amount_to_pay, invoice.payment_hash
+        )
 
         return
 
@@ -291,7 +359,7 @@ async def callback_button(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # add extra data
 
     # we failed paying the invoice, popup the lnurlp
-    message = await context.bot.send_message(
+    message = await sender.send_message(
         chat_id=update.effective_chat.id,
         text=f"@{update.effective_user.username} add '{invoice_title}' to the queue?"
         f"\n\nClick to pay below or fund the bot with /fund@Jukebox_Lightning_bot.",
@@ -318,15 +386,30 @@ async def callback_button(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         ),
     )
 
+    # without the message nobody can pay the invoice, the tracks can be requested again. A payment that was not
+    # confirmed is checked all the same
+    if message is None and not unconfirmed:
+        await invoicing.helper.delete_invoice(invoice.payment_hash)
+        playqueue.helper.release(invoice.chat_id, invoice.spotify_uri_list)
+        sender.send_message(
+            chat_id=update.effective_user.id,
+            parse_mode="HTML",
+            text=f"Could not show the invoice for {invoice_title} in the group, please try again later.",
+        )
+        return
+
     # add data to the invoice
-    invoice.message_id = message.id
+    invoice.message_id = message.id if message is not None else None
 
-    # and save the invoice
-    await invoicing.helper.save_invoice(invoice)
+    # and save the invoice, unless it was paid in the meantime
+    if not await invoicing.helper.update_invoice(invoice):
+        if message is not None:
+            context.job_queue.run_once(delete_message, 0, data={"message": message})
+        return
 
     # change this into an SSE
     # start a loop to check the invoice, for a period of 10 minutes
-    app.job_queue.run_once(check_invoice_callback, 15, data=invoice)
+    app.job_queue.run_once(check_invoice_callback, invoicing.helper.CHECK_INTERVAL, data=invoice)
 
 
 async def check_invoice_callback(context: ContextTypes.DEFAULT_TYPE):
@@ -350,15 +433,16 @@ async def check_invoice_callback(context: ContextTypes.DEFAULT_TYPE):
         return
 
     # invoice has not been paid
-    invoice.ttl -= 15
+    invoice.ttl -= invoicing.helper.CHECK_INTERVAL
     if invoice.ttl <= 0:
         await invoicing.helper.delete_invoice(invoice.payment_hash)
-        try:
-            await context.bot.delete_message(invoice.chat_id, invoice.message_id)
-        except TelegramError:
-            pass
+        if invoice.message_id is not None:
+            try:
+                await context.bot.delete_message(invoice.chat_id, invoice.message_id)
+            except TelegramError:
+                pass
     else:
-        app.job_queue.run_once(check_invoice_callback, 15, data=invoice)
+        app.job_queue.run_once(check_invoice_callback, invoicing.helper.CHECK_INTERVAL, data=invoice)
 
 
 async def regular_cleanup(context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -373,6 +457,74 @@ async def regular_cleanup(context: ContextTypes.DEFAULT_TYPE) -> None:
     helper.purge_commands()
 
 
+async def update_now_playing(chat_id: str, player) -> float:
+    """
+    Update the pinned message of the group with the current playing track, and hand the next track of the queue to
+    the player when it is due. Returns the seconds until the group needs the next update, or None when the player is
+    unavailable. Runs for every group on the poller and right away when a remote player pushes its state
+    """
+    try:
+        nowplaying = await player.now_playing()
+    except players.PlayerUnavailable:
+        return None
+
+    interval = 300
+    title = "Nothing playing at the moment"
+    current = ""
+    remaining = 0
+    if nowplaying is not None and nowplaying.track is not None:
+        title = nowplaying.track.title
+        current = nowplaying.track.uri
+
+        # update history
+        await spotify.helper.update_history(chat_id, title, current)
+
+        remaining = nowplaying.remaining
+        interval = remaining + 2
+    elif nowplaying is not None:
+        logging.debug(f"Nothing playing in chat {chat_id}")
+
+    # hand the next track of the queue to the player just before the current one ends
+    try:
+        due = await playqueue.helper.poll(chat_id, player, current, remaining)
+        if due is not None and due + 1 < interval:
+            interval = due + 1
+    except Exception as e:
+        logging.error(f"Could not hand the next track to the player of chat {chat_id}: {e}")
+
+    # update the title
+    if chat_id in now_playing_message:
+        [message_id, prev_title] = now_playing_message[chat_id]
+        if prev_title != title:
+            # edits that are not delivered yet are replaced by this one
+            sender.edit_message_text(title, chat_id=chat_id, message_id=message_id)
+            now_playing_message[chat_id] = [message_id, title]
+            logging.info(f"Now playing {title} in chat {chat_id}")
+            live.publish_now_playing(chat_id, title, remaining)
+
+            try:
+                with metrics.track_dependency("mqtt", "publish"):
+                    async with aiomqtt.Client("localhost") as client:
+                        await client.publish(f"{chat_id}/now_playing", payload=title)
+            except MqttError:
+                logging.error("Exception when publishing current track to mqtt")
+                pass
+
+    else:
+        live.publish_now_playing(chat_id, title, remaining)
+        logging.info("Creating new pinned message")
+        message = await sender.send_message(text=title, chat_id=chat_id, priority=sender.PRIORITY_NOW_PLAYING)
+        if message is None:
+            logging.error("Exception when sending message to group")
+            return interval
+        try:
+            await app.bot.pin_chat_message(chat_id=chat_id, message_id=message.id)
+        except TelegramError:
+            logging.error("Exception when pinning message in group")
+        now_playing_message[chat_id] = [message.id, title]
+    return interval
+
+
 async def callback_spotify(context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     This function creates a message of the current playing track. It reschedules itself depending on the remaining time
@@ -381,115 +533,74 @@ async def callback_spotify(context: ContextTypes.DEFAULT_TYPE) -> None:
 
     interval = 300
     try:
-        for key in config.rds.scan_iter("group:*"):
+        for key in redis.cache.scan_iter("group:*"):
             # logging.info(f"callback_spotify for group {key}")
             chat_id = key.decode("utf-8").split(":")[1]
-            auth_manager = await spotify.helper.get_auth_manager(chat_id)
-            if auth_manager is None:
-                # logging.warning("Auth manager is None in callback_spotify")
-                continue
-
-            currenttrack = None
-            try:
-                sp = spotipy.Spotify(auth_manager=auth_manager)
-                currenttrack = sp.current_user_playing_track()
-            # TODO: replace bare except
-            except:  # noqa: E722
-                # logging.info("Exception while querying the current playing track at spotify")
+            player = await players.get_player(chat_id)
+            if player is None:
                 continue
 
-            title = "Nothing playing at the moment"
-            if currenttrack is not None and "item" in currenttrack and currenttrack["item"] is not None:
-                title = spotify.helper.get_track_title(currenttrack["item"])
-
-                # update history
-                await spotify.helper.update_history(chat_id, title)
-
-                newinterval = (currenttrack["item"]["duration_ms"] - currenttrack["progress_ms"]) / 1000 + 2
-                if newinterval < interval:
-                    interval = newinterval
-            elif currenttrack is not None:
-                logging.info(json.dumps(currenttrack))
-
-            # update the title
-            if chat_id in now_playing_message:
-                [message_id, prev_title] = now_playing_message[chat_id]
-                if prev_title != title:
-                    try:
-                        await context.bot.editMessageText(title, chat_id=chat_id, message_id=message_id)
-                        now_playing_message[chat_id] = [message_id, title]
-                        logging.info(f"Now playing {title} in chat {chat_id}")
-                    except TelegramError:
-                        # logging.error("Exception when refreshing now playing")
-                        pass
-
-                    try:
-                        async with aiomqtt.Client("localhost") as client:
-                            await client.publish(f"{chat_id}/now_playing", payload=title)
-                    except MqttError:
-                        logging.error("Exception when publishing current track to mqtt")
-                        pass
-
-            else:
-                logging.info("Creating new pinned message")
-                try:
-                    message = await context.bot.send_message(text=title, chat_id=chat_id)
-                    await context.bot.pin_chat_message(chat_id=chat_id, message_id=message.id)
-                    now_playing_message[chat_id] = [message.id, title]
-                except TelegramError:
-                    logging.error("Exception when sending message to group")
+            due = await update_now_playing(chat_id, player)
+            if due is not None and due < interval:
+                interval = due
     # TODO: replace bare except
     except:  # noqa: E722
         logging.error("Unhandled exception in callback_spotify")
     finally:
-        if interval < 30 or interval > 300:
-            interval = 30
-        logging.info(f"Next run in {interval} seconds")
+        # the handoff of the queue needs a poll within queue_handoff seconds of the end of a track
+        interval = min(max(interval, 5), 300)
+        logging.debug(f"Next run in {interval} seconds")
         context.job_queue.run_once(callback_spotify, interval, job_kwargs={"misfire_grace_time": None})
 
 
-async def callback_paid_invoice(invoice: Invoice):
+async def callback_paid_invoice(invoice: "invoicing.helper.Invoice"):
+    """
+    Queue the tracks of an invoice, check_invoice_callback calls this only after LNbits confirmed the payment
+    """
     if invoice is None:
         logging.error("Invoice is None")
         return
-    logging.info("callback_paid_invoice")
-    logging.info(invoice.to_json())
+    logging.debug(f"Paid invoice {invoice.payment_hash}")
 
     if invoice.chat_id is None:
         logging.error("Invoice chat_id is None")
         return
 
     if not await invoicing.helper.delete_invoice(invoice.payment_hash):
-        logging.info("invoicing.helper.delete_invoice returned False")
+        logging.debug("invoicing.helper.delete_invoice returned False")
         return
 
-    auth_manager = await spotify.helper.get_auth_manager(invoice.chat_id)
-    if auth_manager is None:
-        logging.error("No auth manager after succesfull payment")
+    player = await players.get_player(invoice.chat_id)
+    if player is None:
+        logging.error("No player after succesfull payment")
         return
 
-    try:
-        logging.info(f"Trying to delete chat_id {invoice.chat_id}, messageid {invoice.message_id}")
-        await app.bot.delete_message(invoice.chat_id, invoice.message_id)
-    except TelegramError:
-        pass
+    if invoice.message_id is not None:
+        try:
+            logging.debug(f"Trying to delete chat_id {invoice.chat_id}, messageid {invoice.message_id}")
+            await app.bot.delete_message(invoice.chat_id, invoice.message_id)
+        except TelegramError:
+            pass
 
     # add to the queue and inform others
-    sp = spotipy.Spotify(auth_manager=auth_manager)
-
-    spotify.helper.add_to_queue(sp, invoice.spotify_uri_list)
-    try:
-        await app.bot.send_message(
-            chat_id=invoice.chat_id,
-            parse_mode="HTML",
-            text=f"'{invoice.title}' was added to the queue.",
-        )
-    except TelegramError:
-        logging.error("Could not  send message to the group that track was added to the queue")
+    tracks = await player.tracks(invoice.spotify_uri_list)
+    titles = [track.title if track is not None else uri for uri, track in zip(invoice.spotify_uri_list, tracks)]
+    await playqueue.helper.enqueue(
+        invoice.chat_id, invoice.user.userid, list(zip(invoice.spotify_uri_list, titles)), player
+    )
+    live.publish_added(invoice.chat_id, invoice.user.username, titles)
+    stats.helper.add_tracks(invoice.chat_id, invoice.user.userid, invoice.spotify_uri_list, invoice.amount_to_pay)
+    sender.send_message(
+        chat_id=invoice.chat_id,
+        parse_mode="HTML",
+        text=f"'{invoice.title}' was added to the queue.",
+        priority=sender.PRIORITY_PAYMENT,
+    )
 
     try:
-        async with aiomqtt.Client("localhost") as client:
-            await client.publish(f"{invoice.chat_id}/added_to_queue", payload=invoice.title)
+        with metrics.track_dependency("mqtt", "publish"):
+            async with aiomqtt.Client("localhost") as client:
+                await client.publish(f"{invoice.chat_id}/added_to_queue", payload=invoice.title)
     except MqttError:
         logging.error("Exception when publishing queue add to mqtt")
         pass
@@ -505,13 +616,13 @@ async def callback_paid_invoice(invoice: Invoice):
     #     except TelegramError:
     #         logging.info("Could not send individual message to user that")
 
-    # make donation to the bot
-    jukeboxbot = await users.helper.get_or_create_user(config.bot_id)
-    donator = await users.helper.get_or_create_user(invoice.recipient.userid)
-    donation_amount: int = await spotify.helper.get_donation_fee(invoice.chat_id)
-    donation_amount = min(donation_amount, invoice.amount_to_pay)
-    donation_invoice = await invoicing.helper.create_invoice(jukeboxbot, donation_amount, "donation to the bot")
-    # TODO: unused
-    result = await invoicing.helper.pay_invoice(donator, donation_invoice)  # noqa: F841
+    # the payment was made outside of the bot, or by the bot when its answer was lost
+    users.helper.invalidate_balance(invoice.recipient.userid)
+    users.helper.invalidate_balance(invoice.user.userid)
+
+    # record the donation to the bot, it is settled in the background
+    await donations.helper.record_donation(
+        invoice.recipient.userid, invoice.chat_id, invoice.amount_to_pay, invoice.payment_hash
+    )
 
     return
@@ -0,0 +1,283 @@
+"""
+Lightweight tracing of updates and web requests. A trace is started per Telegram update and per HTTP request, the
+current span is kept in a context variable so it follows the call through the helpers, tasks and threads. The calls to
+Redis, LNbits, Spotify, Telegram and MQTT are recorded as spans from the instrumentation of the metrics.
+
+A trace is done when all its spans ended. Traces that are slower than trace_slow_threshold are kept in memory for
+inspection. Those and a sample of the others are written to trace_file as json lines, one span per line with the
+fields of OTLP spans.
+"""
+
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import random
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter, time
+
+from lightning_jukebox_bot.application import metrics
+from lightning_jukebox_bot.settings import config
+
+logger = logging.getLogger(__name__)
+
+# seconds between two writes to the trace file
+FLUSH_INTERVAL = 5
+
+# spans of a trace, further spans are not recorded
+MAX_SPANS = 500
+
+current = contextvars.ContextVar("current_span", default=None)
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "open", "done")
+
+    def __init__(self):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.spans = []
+        self.open = 0
+        self.done = False
+
+    @property
+    def root(self) -> "Span":
+        return self.spans[0]
+
+    @property
+    def duration(self) -> float:
+        # spans can end after the root, such as messages that are delivered later
+        root = self.root
+        return max(span.start + span.duration for span in self.spans) - root.start
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "duration_ms": round(self.duration * 1000, 3),
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "duration", "attributes", "error", "_started")
+
+    def __init__(self, trace: Trace, parent_id: str, name: str, attributes: dict, start: float = None):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time() if start is None else start
+        self.duration = None
+        self.attributes = attributes
+        self.error = False
+        self._started = perf_counter()
+        trace.spans.append(self)
+        trace.open += 1
+
+    def end(self, error: bool = False, duration: float = None) -> None:
+        if self.duration is not None:
+            return
+        self.duration = perf_counter() - self._started if duration is None else duration
+        self.error = self.error or error
+        self.trace.open -= 1
+        if self.trace.open == 0:
+            _finish(self.trace)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "start_time_unix_nano": int(self.start * 1e9),
+            "end_time_unix_nano": int((self.start + (self.duration or 0)) * 1e9),
+            "attributes": self.attributes,
+            "status": {"code": "ERROR" if self.error else "OK"},
+        }
+
+
+class JsonLinesExporter:
+    """
+    Buffers the spans of kept traces and appends them to a file from a thread
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._buffer = []
+        self._task = None
+
+    def export(self, trace: Trace) -> None:
+        self._buffer.extend(json.dumps(span.to_dict(), separators=(",", ":")) for span in trace.spans)
+
+    def _write(self, lines: list) -> None:
+        with open(self.path, "a") as file:
+            file.write("\n".join(lines) + "\n")
+
+    async def flush(self) -> None:
+        if len(self._buffer) == 0:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except OSError as e:
+            logger.error(f"Could not write {len(lines)} spans to {self.path}: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+
+
+slow_traces = deque(maxlen=config.trace_history)
+exporter = JsonLinesExporter(config.trace_file) if config.trace_file is not None else None
+
+
+def _finish(trace: Trace) -> None:
+    trace.done = True
+    slow = trace.duration >= config.trace_slow_threshold
+    if slow:
+        slow_traces.append(trace)
+    if exporter is not None and (slow or random.random() < config.trace_sample_rate):
+        exporter.export(trace)
+
+
+def _parent() -> Span:
+    """
+    The current span, or None outside of a trace, when the trace is done or when it has too many spans
+    """
+    parent = current.get()
+    if parent is None or parent.trace.done or len(parent.trace.spans) >= MAX_SPANS:
+        return None
+    return parent
+
+
+def start_span(name: str, **attributes) -> Span:
+    """
+    Start a child of the current span without making it the current span, returns None outside of a trace
+    """
+    parent = _parent()
+    if parent is None:
+        return None
+    return Span(parent.trace, parent.span_id, name, attributes)
+
+
+@contextmanager
+def activate(span: Span):
+    """
+    Make the span the current span in the block
+    """
+    token = current.set(span)
+    try:
+        yield span
+    finally:
+        current.reset(token)
+
+
+@contextmanager
+def _run_span(span: Span):
+    token = current.set(span)
+    try:
+        yield span
+    except BaseException:
+        span.end(error=True)
+        raise
+    finally:
+        current.reset(token)
+        span.end()
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """
+    Start a new trace in the block, or a span when the block runs in a trace already
+    """
+    parent = current.get()
+    if not config.trace_enabled:
+        yield None
+    elif parent is not None and not parent.trace.done:
+        with span(name, **attributes) as child:
+            yield child
+    else:
+        with _run_span(Span(Trace(), None, name, attributes)) as root:
+            yield root
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Record the block as a child of the current span, does nothing outside of a trace
+    """
+    parent = _parent()
+    if parent is None:
+        yield None
+    else:
+        with _run_span(Span(parent.trace, parent.span_id, name, attributes)) as child:
+            yield child
+
+
+def record(name: str, seconds: float, error: bool = False, **attributes) -> None:
+    """
+    Add a span that just ended after the given number of seconds to the current span
+    """
+    parent = _parent()
+    if parent is not None:
+        Span(parent.trace, parent.span_id, name, attributes, start=time() - seconds).end(error, seconds)
+
+
+@contextmanager
+def detached():
+    """
+    Run the block outside of the current trace, for tasks that are started by an update but outlive it
+    """
+    token = current.set(None)
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+
+def _record_dependency(dependency: str, operation: str, seconds: float, error: bool) -> None:
+    record(f"{dependency} {operation}", seconds, error)
+
+
+metrics.dependency_observers.append(_record_dependency)
+
+
+def traced(name: str, callback):
+    """
+    Wrap the callback of a handler to record it as a span
+    """
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        with span(name):
+            return await callback(*args, **kwargs)
+
+    return wrapper
+
+
+def get_slow_traces() -> list:
+    return [trace.to_dict() for trace in slow_traces]
+
+
+def start() -> None:
+    if exporter is not None:
+        exporter.start()
+
+
+async def stop() -> None:
+    if exporter is not None:
+        await exporter.stop()
@@ -1 +1 @@
-from . import helper  # noqa: F401
+from . import helper, pool  # noqa: F401
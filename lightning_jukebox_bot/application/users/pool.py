@@ -0,0 +1,106 @@
+import asyncio
+import json
+import logging
+import random
+import string
+from typing import Optional
+
+from lightning_jukebox_bot.application import redis, tracing
+from lightning_jukebox_bot.settings import config
+
+logger = logging.getLogger(__name__)
+
+# wallets that are created in advance, with the extensions enabled, waiting for a new user
+POOL_KEY = "users:pool"
+# LNbits users of the pool whose wallet or extensions failed, the next refill finishes them first
+INCOMPLETE_KEY = "users:pool:incomplete"
+
+refill_lock = asyncio.Lock()
+refill_task = None
+
+
+async def provision_wallet(lnbitsuserid: str = None) -> Optional[dict]:
+    """
+    Create an LNbits user and wallet with the lnurlp and lndhub extensions enabled, or finish the user with the given
+    id. The user is recorded as incomplete until it is done, so a failure does not leave it unused at LNbits
+    """
+    if lnbitsuserid is None:
+        name = "pool:" + "".join(random.sample(string.ascii_letters, 12))
+        lnbitsuserid = await config.lnbits.createUser(name)
+    redis.cache.sadd(INCOMPLETE_KEY, lnbitsuserid)
+
+    wallet = await config.lnbits.getWallet(lnbitsuserid)
+    if wallet is None:
+        # there is nothing to finish without a wallet
+        logger.error(f"No wallet for pool user {lnbitsuserid}")
+        redis.cache.srem(INCOMPLETE_KEY, lnbitsuserid)
+        return None
+
+    enabled = await asyncio.gather(
+        config.lnbits.enableExtension("lnurlp", lnbitsuserid),
+        config.lnbits.enableExtension("lndhub", lnbitsuserid),
+    )
+    if not all(enabled):
+        logger.error(f"Could not enable the extensions for pool user {lnbitsuserid}")
+        return None
+
+    redis.cache.srem(INCOMPLETE_KEY, lnbitsuserid)
+    return {
+        "lnbitsuserid": lnbitsuserid,
+        "id": wallet["id"],
+        "inkey": wallet["inkey"],
+        "adminkey": wallet["adminkey"],
+    }
+
+
+async def refill(context=None) -> int:
+    """
+    Top up the pool to wallet_pool_size wallets, a few wallets at a time. Returns the number of wallets added
+    """
+    if refill_lock.locked():
+        return 0
+
+    async with refill_lock:
+        missing = config.wallet_pool_size - redis.cache.llen(POOL_KEY)
+        if missing <= 0:
+            return 0
+
+        semaphore = asyncio.Semaphore(config.wallet_pool_concurrency)
+        # taken from the set, so that the refill of another process does not finish them as well
+        incomplete = [lnbitsuserid.decode("utf-8") for lnbitsuserid in redis.cache.spop(INCOMPLETE_KEY, missing)]
+
+        async def add(lnbitsuserid: str = None) -> bool:
+            async with semaphore:
+                try:
+                    wallet = await provision_wallet(lnbitsuserid)
+                except Exception:
+                    logger.exception("Could not provision a wallet for the pool")
+                    return False
+            if wallet is None:
+                return False
+            redis.cache.rpush(POOL_KEY, json.dumps(wallet))
+            return True
+
+        results = await asyncio.gather(
+            *[add(lnbitsuserid) for lnbitsuserid in incomplete], *[add() for _ in range(missing - len(incomplete))]
+        )
+        logger.info(f"Added {results.count(True)} of {missing} wallets to the pool")
+        return results.count(True)
+
+
+def claim_wallet() -> Optional[dict]:
+    """
+    Take a wallet from the pool, or None when the pool is empty. A refill is started when the pool runs low
+    """
+    global refill_task
+
+    wallet = redis.cache.lpop(POOL_KEY)
+
+    if redis.cache.llen(POOL_KEY) < config.wallet_pool_low_water and (refill_task is None or refill_task.done()):
+        # the refill outlives the onboarding that claimed the wallet
+        with tracing.detached():
+            refill_task = asyncio.get_running_loop().create_task(refill())
+
+    if wallet is None:
+        return None
+    return json.loads(wallet)
@@ -0,0 +1,165 @@
+"""
+A watchdog that finds the calls that block the event loop. A task on the loop beats at a fixed interval and a thread
+checks the beats. When a beat is late by more than the threshold, the thread samples the stack of the loop thread
+until the loop runs again. The stall and the stack that was sampled most often are kept in a ring buffer.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+from collections import Counter, deque
+from time import monotonic, time
+
+from lightning_jukebox_bot.settings import config
+
+logger = logging.getLogger(__name__)
+
+PACKAGE = "lightning_jukebox_bot"
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Stall:
+    __slots__ = ("started", "duration", "stack", "samples")
+
+    def __init__(self, started: float, duration: float, stack: tuple, samples: int):
+        self.started = started
+        self.duration = duration
+        self.stack = stack
+        self.samples = samples
+
+
+def capture_stack(frame) -> tuple:
+    """
+    Returns the stack of the frame as (filename, line number, function) tuples, the outermost call first
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, frame.f_lineno, getattr(code, "co_qualname", code.co_name)))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def module_name(filename: str) -> str:
+    if filename.startswith(PACKAGE_PATH):
+        module = os.path.relpath(filename, os.path.dirname(PACKAGE_PATH))
+    else:
+        # the part of the path after the directory of the library
+        module = filename
+        for path in sorted(sys.path, key=len, reverse=True):
+            if path and filename.startswith(path + os.sep):
+                module = filename[len(path) + 1 :]
+                break
+    module = module.removesuffix(".py").removesuffix(f"{os.sep}__init__").replace(os.sep, ".")
+    return module.removeprefix(f"{PACKAGE}.application.").removeprefix(f"{PACKAGE}.")
+
+
+def describe(stack: tuple, depth: int = 4) -> list:
+    """
+    The calls of the bot in the stack, each followed by the library function it called, the innermost `depth` calls
+    """
+    calls = []
+    for i, (filename, lineno, function) in enumerate(stack):
+        if filename.startswith(PACKAGE_PATH):
+            calls.append(f"{module_name(filename)}.{function}:{lineno}")
+        elif i > 0 and stack[i - 1][0].startswith(PACKAGE_PATH):
+            calls.append(f"{module_name(filename)}.{function}")
+    if len(calls) == 0:
+        calls = [f"{module_name(filename)}.{function}" for filename, _, function in stack]
+    return calls[-depth:]
+
+
+class Watchdog:
+    def __init__(self, threshold: float, history: int):
+        self.threshold = threshold
+        self.interval = max(0.01, threshold / 2)
+        self.stalls = deque(maxlen=history)
+        self._beat = monotonic()
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            self._beat = monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _record(self, started: float, beat: float, lag: float, samples: Counter) -> None:
+        # once the loop beats again the length of the stall is known exactly
+        duration = self._beat - beat - self.interval if self._beat != beat else lag
+        stack, count = samples.most_common(1)[0] if len(samples) > 0 else ((), 0)
+        self.stalls.append(Stall(started, duration, stack, count))
+        logger.warning(f"Event loop blocked for {duration * 1000:.0f} ms in {' > '.join(describe(stack))}")
+
+    def _watch(self) -> None:
+        # the beat after which the loop stalled, when it started, the latest lag and the sampled stacks
+        beat = started = last_lag = None
+        samples = Counter()
+        while not self._stopped.wait(self.interval):
+            lag = monotonic() - self._beat - self.interval
+            if beat is not None and (lag < self.threshold or self._beat != beat):
+                self._record(started, beat, last_lag, samples)
+                beat = None
+            if lag < self.threshold:
+                continue
+
+            if beat is None:
+                beat = self._beat
+                started = time() - lag
+                samples = Counter()
+            last_lag = lag
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                samples[capture_stack(frame)] += 1
+            # do not keep the frames of the loop alive
+            del frame
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._beat = monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+watchdog = None
+
+
+def enabled() -> bool:
+    return watchdog is not None
+
+
+def start() -> None:
+    global watchdog
+
+    if config.loop_watchdog_threshold <= 0 or watchdog is not None:
+        return
+    watchdog = Watchdog(config.loop_watchdog_threshold, config.loop_watchdog_history)
+    watchdog.start()
+    logger.info(f"Watching for event loop stalls over {config.loop_watchdog_threshold * 1000:.0f} ms")
+
+
+async def stop() -> None:
+    global watchdog
+
+    if watchdog is not None:
+        await watchdog.stop()
+        watchdog = None
+
+
+def get_stalls() -> list:
+    return list(watchdog.stalls) if watchdog is not None else []
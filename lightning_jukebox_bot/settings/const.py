@@ -4,5 +4,6 @@ from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 QR_CODE_DIR = BASE_DIR.joinpath("tmp")
+WEB_TEMPLATE_PATH = BASE_DIR.parent.joinpath("assets", "web_jukebox_template.png")
 
 TG_SECRET = "".join(random.sample(string.ascii_letters, 12))
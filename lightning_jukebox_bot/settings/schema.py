@@ -1,3 +1,6 @@
+import os
+from functools import cached_property
+
 from pydantic import computed_field
 from pydantic_settings import (
     BaseSettings,
@@ -6,6 +9,8 @@ from pydantic_settings import (
     YamlConfigSettingsSource,
 )
 
+from lightning_jukebox_bot.application.lnbits import LNbits
+
 from .const import BASE_DIR
 
 
@@ -22,14 +27,108 @@ class JukeboxSettings(BaseSettings):
 
     max_connections: int = 5
 
+    # outbound flood control, see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+    telegram_global_rate: int = 30  # messages per second
+    telegram_group_rate: int = 20  # messages per minute in a group
+    telegram_group_burst: int = 3
+    telegram_private_rate: int = 1  # messages per second in a private chat
+
+    # incoming updates
+    telegram_update_workers: int = 8
+    telegram_update_queue_size: int = 1000
+    telegram_update_queue_per_chat: int = 50
+
+    broadcast_batch_size: int = 100
+
+    image_workers: int = 2
+
+    # seconds the event loop may block before the watchdog captures the stack, 0 turns the watchdog off
+    loop_watchdog_threshold: float = 0
+    loop_watchdog_history: int = 100  # stalls that are kept
+
+    # sampling profiler of the event loop, started by superadmins
+    profile_max_seconds: int = 60
+    profile_interval: float = 0.005  # seconds between two samples of the stack
+
+    # tracing of updates and web requests
+    trace_enabled: bool = True
+    trace_file: str | None = None  # json lines file for the kept traces, nothing is written without a file
+    trace_sample_rate: float = 0.01  # share of the other traces that is written to the file
+    trace_slow_threshold: float = 1.0  # seconds, slower traces are always kept
+    trace_history: int = 100  # slow traces kept in memory
+
+    # days the hourly and daily analytics of a group are kept
+    analytics_hourly_retention: int = 2
+    analytics_daily_retention: int = 90
+
+    # leaderboards of the tracks, trimmed to leaderboard_size once they grew to twice that size
+    leaderboard_size: int = 100
+    leaderboard_half_life: int = 30  # days until a play or payment counts half
+    leaderboard_recent: int = 500  # recently played tracks that are kept per group
+
+    # seconds before the end of a track that the next track of the queue is handed to the player
+    queue_handoff: int = 15
+
+    # the player of the groups: spotify, fake to run without a spotify account with a generated catalog, or local
+    player: str = "spotify"
+    fake_player_catalog: int = 1000  # tracks in the catalog of the fake player
+    fake_player_latency: float = 0  # seconds every call to the fake player takes
+
+    # the music directory of the local player, indexed into a sqlite database
+    local_library_path: str | None = None
+    local_library_db: str = "local_library.sqlite"
+    local_library_rescan: int = 600  # seconds between rescans of the directory
+    local_player_command: str | None = None  # run for every track handed to the player, like "mpc add {path}"
+
+    # players that connect over the /player WebSocket
+    player_heartbeat: int = 20  # seconds between pings, a player that is silent for two pings is dropped
+    player_search_timeout: float = 3  # seconds a search waits for the answers of the players
+    player_send_queue: int = 100  # messages waiting to be written to a player, a player further behind is dropped
+
+    # tracks of a playlist that are cached to pick random tracks from, and the tracks of the larger batch
+    playlist_cache_size: int = 1000
+    playlist_cache_ttl: int = 3600
+    playlist_batch: int = 5
+
+    # tracks requested or played within duplicate_window seconds are rejected, warned about or charged a premium
+    duplicate_policy: str = "warn"  # default of the groups, reject, warn or premium
+    duplicate_window: int = 3600
+    duplicate_premium: int = 2  # times the price of a duplicate track
+
+    # the live feed of the web jukebox
+    live_send_queue: int = 32  # messages waiting for a listener, the oldest is dropped when a listener falls behind
+    live_keepalive: int = 15  # seconds between keepalives of the server-sent events
+    live_queue_entries: int = 10  # upcoming tracks in a queue message
+
+    # bearer token of the admin endpoints, they are off without a token
+    admin_token: str | None = None
+
     bot_token: str
     bot_id: int
     bot_ipaddr: str
+    telegram_base_url: str = "https://api.telegram.org/bot"
+
+    spotify_api_prefix: str = "https://api.spotify.com/v1/"
 
     price: int = 21
     donation_fee: int = 21
+    donation_settle_interval: int = 3600  # seconds between settlements of donations to the bot
+    donation_settle_threshold: int = 2100  # settle the donations of an owner early from this amount
     fund_max: int = 42000
 
+    # wallets created in advance for new users
+    wallet_pool_size: int = 10
+    wallet_pool_low_water: int = 3  # refill the pool when it has fewer wallets
+    wallet_pool_concurrency: int = 3  # wallets created at the same time
+    wallet_pool_refill_interval: int = 300
+    onboarding_concurrency: int = 4  # LNbits calls at the same time for onboarding new users
+
+    balance_cache_ttl: int = 600
+    balance_reconcile_interval: int = 300
+
+    # seconds before an unpaid invoice expires
+    invoice_expiry: int = 300
+
     lnbits_protocol: str
     lnbits_host: str
     lnbits_adminkey: str
@@ -43,6 +142,27 @@ class JukeboxSettings(BaseSettings):
     def fund_min(self) -> int:
         return self.price
 
+    @computed_field
+    @property
+    def superadmins(self) -> list[int]:
+        return self.superadmin
+
+    @computed_field
+    @property
+    def ipaddress(self) -> str:
+        return self.bot_ipaddr
+
+    @cached_property
+    def lnbits(self) -> LNbits:
+        return LNbits(
+            self.lnbits_protocol,
+            self.lnbits_host,
+            self.lnbits_adminkey,
+            self.lnbits_hostkey,
+            self.lnbits_userkey,
+            max_connections=self.max_connections,
+        )
+
     @computed_field
     @property
     def spotify_redirect_uri(self) -> str:
@@ -59,7 +179,9 @@ class JukeboxSettings(BaseSettings):
     ) -> tuple[PydanticBaseSettingsSource, ...]:
         return (
             init_settings,
-            YamlConfigSettingsSource(settings_cls, BASE_DIR.parent.joinpath("settings.yaml")),
+            YamlConfigSettingsSource(
+                settings_cls, os.environ.get("JUKEBOX_SETTINGS_FILE", BASE_DIR.parent.joinpath("settings.yaml"))
+            ),
             env_settings,
             file_secret_settings,
         )
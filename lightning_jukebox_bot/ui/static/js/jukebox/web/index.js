@@ -29,3 +29,20 @@ function submitSearch() {
     req1.setRequestHeader("Content-Type", "application/json");
     req1.send(JSON.stringify({ query: document.getElementsByName("query")[0].value }));
 }
+
+// what plays and the tracks that are added, pushed by the bot
+let nowPlaying = "";
+const live = new EventSource(`${window.location.pathname}/live`);
+live.onmessage = (event) => {
+    const message = JSON.parse(event.data);
+    const node = document.querySelector(".now-playing-container");
+    if (message.topic === "nowplaying") {
+        nowPlaying = message.title;
+        node.innerText = nowPlaying;
+    } else if (message.topic === "added") {
+        node.innerText = `${message.user} added ${message.titles.join(", ")}`;
+        setTimeout(() => {
+            node.innerText = nowPlaying;
+        }, 5000);
+    }
+};
@@ -0,0 +1,74 @@
+"""
+Re-encode the invoices and users stored in the legacy json format with the compact encoding, and give invoices that
+were stored without an expiry the configured invoice expiry.
+
+Usage: python -m migrations.compact_encoding [--dry-run]
+"""
+
+import argparse
+import logging
+
+from lightning_jukebox_bot.application import redis
+from lightning_jukebox_bot.application.invoicing.helper import INVOICE_ENCODING, Invoice
+from lightning_jukebox_bot.application.users.helper import USER_ENCODING, User
+from lightning_jukebox_bot.settings import config
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_invoices(dry_run: bool) -> int:
+    num = 0
+    for key in redis.cache.scan_iter("invoice:*", count=500):
+        data = redis.cache.get(key)
+        if data is None:
+            continue
+
+        ttl = redis.cache.ttl(key)
+        if data.startswith(INVOICE_ENCODING) and ttl >= 0:
+            continue
+
+        invoice = Invoice(key.decode("utf-8").split(":", 1)[1])
+        try:
+            invoice.decode(data)
+        except (AssertionError, KeyError, TypeError, ValueError):
+            logger.error(f"Could not decode {key}, skipping")
+            continue
+
+        if not dry_run:
+            redis.cache.set(key, invoice.encode(), ex=ttl if ttl > 0 else config.invoice_expiry)
+        num += 1
+    return num
+
+
+def migrate_users(dry_run: bool) -> int:
+    num = 0
+    for key in redis.cache.scan_iter("user:*", count=500):
+        if redis.cache.type(key) != b"hash":
+            continue
+
+        data = redis.cache.hget(key, "userdata")
+        if data is None or data.startswith(USER_ENCODING) or data == b"null":
+            continue
+
+        user = User(key.decode("utf-8").split(":", 1)[1])
+        try:
+            user.decode(data)
+        except (AssertionError, KeyError, TypeError, ValueError):
+            logger.error(f"Could not decode {key}, skipping")
+            continue
+
+        if not dry_run:
+            redis.cache.hset(key, "userdata", user.encode())
+        num += 1
+    return num
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Migrate invoices and users to the compact encoding")
+    parser.add_argument("--dry-run", action="store_true", help="only count the keys that would be migrated")
+    args = parser.parse_args()
+
+    logger.info(f"Invoices migrated: {migrate_invoices(args.dry_run)}")
+    logger.info(f"Users migrated: {migrate_users(args.dry_run)}")